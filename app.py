@@ -1,8 +1,11 @@
+import json
 import logging
 import os
+import queue
+import threading
 from datetime import datetime
 import yaml
-from flask import Flask, render_template, request, redirect, session, jsonify, send_from_directory, url_for
+from flask import Flask, render_template, request, redirect, session, jsonify, send_from_directory, url_for, Response
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_wtf.csrf import CSRFProtect
@@ -12,7 +15,8 @@ from urllib.parse import unquote
 from iagents.sql import *
 from iagents.mode import Mode
 from iagents.util import iAgentsLogger
-from iagents.llamaindex import LlamaIndexer
+from iagents.profile import get_friend_names, get_profile_cache, get_user_field
+from iagents.resources import get_resources
 from flask_wtf.csrf import generate_csrf
 import shutil
 import requests
@@ -68,15 +72,15 @@ def get_profile_image_url(name):
     """
     if name.endswith("'s Agent"):
         user_name = name.replace("'s Agent", "")
-        result = exec_sql("SELECT agent_profile_image_path FROM users WHERE name=%s", params=(user_name,))
-        if result and result[0][0]:
-            return url_for('static', filename=result[0][0], _external=True)
+        agent_profile_image_path = get_user_field("agent_profile_image_path", user_name)
+        if agent_profile_image_path:
+            return url_for('static', filename=agent_profile_image_path, _external=True)
         else:
             return url_for('static', filename='default_agent.png', _external=True)
     else:
-        result = exec_sql("SELECT profile_image_path FROM users WHERE name=%s", params=(name,))
-        if result and result[0][0]:
-            return url_for('static', filename=result[0][0], _external=True)
+        profile_image_path = get_user_field("profile_image_path", name)
+        if profile_image_path:
+            return url_for('static', filename=profile_image_path, _external=True)
         else:
             return url_for('static', filename='default.png', _external=True)
 
@@ -129,6 +133,8 @@ def register():
                 """,
                 params=(name, hashed_password, '', 'default.png', 'default_agent.png', 0),
                 mode="write")
+            # lookups of the name before it was registered may have been cached
+            get_profile_cache().invalidate_user(name)
             return redirect(url_for('login'))
         except mysql.connector.IntegrityError:
             return render_template('login.html', error='Username already exists. Please choose a different one.')
@@ -179,6 +185,8 @@ def add_friend():
         exec_sql("INSERT INTO friendships (user_id, friend_id) VALUES (%s, %s), (%s, %s)",
                  params=(session['user_id'], friend_id, friend_id, session['user_id']),
                  mode="write")
+        get_profile_cache().invalidate("friends", session['name'])
+        get_profile_cache().invalidate("friends", friend_name)
     else:
         return 'Friend not found'
 
@@ -297,6 +305,7 @@ def upload_avatar():
         exec_sql("UPDATE users SET profile_image_path=%s WHERE name=%s",
                  params=(relative_path, session['name']),
                  mode="write")
+        get_profile_cache().set("profile_image_path", session['name'], relative_path)
 
         return redirect('/chat')
 
@@ -317,7 +326,7 @@ def upload_file():
 
     user_directory = os.path.join(app.root_path, 'userfiles', session['name'])
     os.makedirs(user_directory, exist_ok=True)
-    llama_indexer = LlamaIndexer(session['name'])
+    llama_indexer = get_resources().get_llamaindexer(session['name'])
 
     if request.content_type == 'application/json':
         data = request.get_json()
@@ -428,6 +437,7 @@ def upload_agent_avatar():
             exec_sql("UPDATE users SET agent_profile_image_path=%s WHERE name=%s",
                      params=(relative_path, session['name']),
                      mode="write")
+            get_profile_cache().set("agent_profile_image_path", session['name'], relative_path)
 
             return redirect('/chat')
 
@@ -455,17 +465,14 @@ def chat_page():
     if 'name' not in session:
         return redirect('/login')
 
-    friend_list = exec_sql(
-        "SELECT name FROM users WHERE id IN (SELECT friend_id FROM friendships WHERE user_id=%s)",
-        params=(session['user_id'],))
+    friend_list = get_friend_names(session['name'])
     
     # Sort the friend list alphabetically
     sorted_friend_list = sorted(friend_list, key=lambda x: lazy_pinyin(x[0]))
     
     friend_name = request.args.get('chat')
 
-    current_user_avatar_path = exec_sql("SELECT profile_image_path FROM users WHERE name=%s",
-                                        params=(session['name'],))[0][0]
+    current_user_avatar_path = get_user_field("profile_image_path", session['name'])
 
     # Fetch guide_seen status
     guide_seen = exec_sql("SELECT guide_seen FROM users WHERE name = %s",
@@ -507,6 +514,57 @@ def execute_agent():
     else:
         return jsonify({'error': 'No chat receiver specified'}), 400
 
+@app.route('/execute_agent_stream')
+@csrf.exempt
+def execute_agent_stream():
+    """Server-Sent Events version of /execute_agent
+
+    The communication runs in a background thread, each agent message ("agent_message")
+    and each chunk of the conclusion ("conclusion_chunk") is pushed as soon as it is produced,
+    the stream ends with a "done" event carrying the same payload as /execute_agent,
+    or a "failed" event if the communication raised.
+    """
+    if 'name' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    receiver = request.args.get('receiver')
+    message = request.args.get('message')
+    sender = session['name']  # Use session's username as sender
+
+    if not receiver:
+        return jsonify({'error': 'No chat receiver specified'}), 400
+    if not message:
+        return jsonify({'error': 'No message specified'}), 400
+    task_prompt = message.lstrip("@")
+
+    user_directory_root = os.path.join(app.root_path, 'userfiles')
+    events = queue.Queue()
+
+    def run_communication():
+        try:
+            mode = Mode(sender=sender, receiver=receiver, task=task_prompt, global_config=global_config, user_directory_root=user_directory_root)
+            communication = mode.get_communication()
+            communication.add_listener(lambda event, data: events.put((event, data)))
+            conclusion = communication.communicate()
+            communication_history = "\t".join(communication.communication_history)
+            communication_history = communication_history.replace("\n", " ")
+            events.put(("done", {'agent_response': conclusion, 'communication_history': communication_history}))
+        except Exception as e:
+            logging.exception("Streaming agent communication failed")
+            events.put(("failed", {'error': str(e)}))
+
+    threading.Thread(target=run_communication, daemon=True).start()
+
+    def generate():
+        while True:
+            event, data = events.get()
+            yield "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+            if event in ("done", "failed"):
+                break
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/execute_agent_cultivate')
 @csrf.exempt
 def execute_agent_cultivate():
@@ -554,7 +612,7 @@ Here are some feedback from human on your agent's previous cooperation and commu
 {}
 the improved agent profile prompt should begin with 'As the personal agent of {}, you should ... '
 Now focus on the requirements of "{}" and previous requirements, you must return only the improved profile prompt
-""".format(cultivate_prompt, message, feedback_message, sender, cultivate_prompt))
+""".format(cultivate_prompt, message, feedback_message, sender, cultivate_prompt), call_site="cultivate", use_cache=False)
     else:
         improved_system_prompt = mode.query_func(
 """
@@ -563,11 +621,12 @@ The previous requirements are shown below, do not forget to satisfy previous req
 {}
 the improved agent profile prompt should begin with 'As the personal agent of {}, you should ... '
 Now focus on the requirements of "{}" and previous requirements, you must return only the improved profile prompt
-""".format(cultivate_prompt, message, sender, cultivate_prompt))
+""".format(cultivate_prompt, message, sender, cultivate_prompt), call_site="cultivate", use_cache=False)
 
     exec_sql("UPDATE users SET system_prompt=%s WHERE name=%s",
               params=(improved_system_prompt, session['name']),
               mode="write")
+    get_profile_cache().set("system_prompt", session['name'], improved_system_prompt)
 
     agent_response = "Ok, now your agent profile prompt is:\n<--------------->\n **{}** \n<----------------->\n1. Feel free to customize more on your agent by keep talking in this chat.\n2. Input @ to automatically optimize your agent profile prompt using the feedback data".format(improved_system_prompt)
 
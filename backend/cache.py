@@ -0,0 +1,459 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import yaml
+
+from backend.governor import resolve_future
+from backend.structured import is_structured_rejected, record_structured_error
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+CACHE_CONFIG = global_config.get("cache") or {}
+
+
+def make_cache_key(provider, model, temperature, prompt, extra=None) -> str:
+    """content address of one LLM request
+
+    Args:
+        provider (str): backend provider name
+        model (str): model name used by the provider
+        temperature (float): sampling temperature, None for the provider default
+        prompt (str): the prompt sent to the LLM
+        extra (dict, optional): other arguments which change the response. Defaults to None.
+
+    Returns:
+        str: sha256 hex digest
+    """
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    key = json.dumps([provider, model, temperature, prompt_hash, extra or {}], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class LLMCache():
+    """two-tier (in-memory LRU + on-disk SQLite) cache of LLM responses
+
+    the memory tier is bounded by entry count, the disk tier by entry count and ttl,
+    entries are evicted by the least recent access. The disk tier keeps an estimate of its row count
+    (every write counts as a new row) and only counts the rows when the estimate is over the limit,
+    expired rows are dropped every `EXPIRE_INTERVAL` writes. The access times of disk hits are
+    written in batches of `ACCESS_BATCH`, or with the next write.
+    """
+
+    EXPIRE_INTERVAL = 1000
+    ACCESS_BATCH = 100
+
+    def __init__(self, memory_size=1024, disk_path=None, max_disk_entries=100000, ttl=0) -> None:
+        """init
+
+        Args:
+            memory_size (int, optional): max entries in memory tier. Defaults to 1024.
+            disk_path (str, optional): path of the sqlite file, None to disable the disk tier. Defaults to None.
+            max_disk_entries (int, optional): max entries in disk tier. Defaults to 100000.
+            ttl (int, optional): seconds before an entry expires, 0 for never. Defaults to 0.
+        """
+        self.memory_size = memory_size
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "writes": 0, "evictions": 0}
+
+        self.conn = None
+        if disk_path:
+            if not os.path.isabs(disk_path):
+                disk_path = os.path.join(project_path, disk_path)
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            self.conn = sqlite3.connect(disk_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache (created_at)")
+            self.conn.commit()
+        self.disk_count = self._count_disk()
+        self.writes_to_expire = 0
+        self.pending_access = {}
+
+    def _expired(self, created_at, now):
+        return self.ttl and now - created_at > self.ttl
+
+    @property
+    def has_disk(self):
+        return self.conn is not None
+
+    def get(self, key, memory_only=False):
+        """the cached response of key, None on a miss
+
+        Args:
+            key (str): cache key
+            memory_only (bool, optional): only look in the memory tier and leave the disk tier (and counting
+                the miss) to a later call, e.g. in a thread. Defaults to False.
+        """
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                response, created_at = self.memory[key]
+                if not self._expired(created_at, now):
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return response
+                del self.memory[key]
+
+            if memory_only and self.conn is not None:
+                return None
+            if self.conn is not None:
+                row = self.conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    response, created_at = row
+                    if not self._expired(created_at, now):
+                        self.pending_access[key] = now
+                        if len(self.pending_access) >= self.ACCESS_BATCH:
+                            self._flush_access()
+                            self.conn.commit()
+                        self._set_memory(key, response, created_at)
+                        self.stats["disk_hits"] += 1
+                        return response
+                    self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    self.conn.commit()
+                    self.disk_count -= 1
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key, response):
+        now = time.time()
+        with self.lock:
+            self._set_memory(key, response, now)
+            if self.conn is not None:
+                self.conn.execute("INSERT OR REPLACE INTO llm_cache (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                                  (key, response, now, now))
+                self.pending_access.pop(key, None)
+                self._flush_access()
+                self._evict_disk(now)
+                self.conn.commit()
+            self.stats["writes"] += 1
+
+    def _set_memory(self, key, response, created_at):
+        self.memory[key] = (response, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _flush_access(self):
+        if self.pending_access:
+            self.conn.executemany("UPDATE llm_cache SET accessed_at = ? WHERE key = ?",
+                                  [(accessed_at, key) for key, accessed_at in self.pending_access.items()])
+            self.pending_access.clear()
+
+    def _count_disk(self):
+        if self.conn is None:
+            return 0
+        return self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+    def _evict_disk(self, now):
+        # the estimate overcounts replaced rows, so it is only a hint to count the rows
+        self.disk_count += 1
+        self.writes_to_expire += 1
+        if self.ttl and self.writes_to_expire >= self.EXPIRE_INTERVAL:
+            self.writes_to_expire = 0
+            self.conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+            self.disk_count = self._count_disk()
+        if self.disk_count <= self.max_disk_entries:
+            return
+        count = self.disk_count = self._count_disk()
+        if count > self.max_disk_entries:
+            # evict 10% at once, so that a full cache does not count its rows again on the next writes
+            overflow = count - self.max_disk_entries + max(1, self.max_disk_entries // 10)
+            self.conn.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                              (overflow,))
+            self.disk_count = count - overflow
+            self.stats["evictions"] += overflow
+
+    def record_bypass(self):
+        with self.lock:
+            self.stats["bypassed"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.pending_access.clear()
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM llm_cache")
+                self.conn.commit()
+                self.disk_count = 0
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """get the process-wide LLM cache, built from the `cache` section of global config
+
+    Returns:
+        LLMCache: the shared cache, None if caching is disabled
+    """
+    global _llm_cache
+    if not CACHE_CONFIG.get("enable", False):
+        return None
+    if _llm_cache is None:
+        with _llm_cache_lock:
+            if _llm_cache is None:
+                _llm_cache = LLMCache(memory_size=CACHE_CONFIG.get("memory_size", 1024),
+                                      disk_path=CACHE_CONFIG.get("disk_path"),
+                                      max_disk_entries=CACHE_CONFIG.get("max_disk_entries", 100000),
+                                      ttl=CACHE_CONFIG.get("ttl", 0))
+    return _llm_cache
+
+
+class SingleFlight():
+    """coalesce identical in-flight LLM requests
+
+    the first caller of a key (the leader) issues the request, callers arriving while it is
+    in flight wait for the leader and share its response (or error) instead of issuing their own.
+    Sync waiters wait on an event, async waiters on a future of their event loop which the leader
+    resolves when it lands, so waiting never takes a thread of the loop's default executor.
+    """
+
+    class Flight():
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.async_waiters = []  # (event loop, future) of async callers
+            self.response = None
+            self.error = None
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {}
+
+    def _join(self, key, call_site):
+        """return (flight, is_leader) and count the call for its call site"""
+        with self.lock:
+            stats = self.stats.setdefault(call_site or "unknown", {"calls": 0, "saved_calls": 0})
+            stats["calls"] += 1
+            flight = self.flights.get(key)
+            if flight is not None:
+                stats["saved_calls"] += 1
+                return flight, False
+            flight = self.flights[key] = self.Flight()
+            return flight, True
+
+    def _land(self, key, flight):
+        with self.lock:
+            del self.flights[key]
+            flight.done.set()
+            async_waiters, flight.async_waiters = flight.async_waiters, []
+        for loop, future in async_waiters:
+            try:
+                loop.call_soon_threadsafe(resolve_future, future)
+            except RuntimeError:
+                # the event loop of the waiter is closed
+                pass
+
+    async def _await_landing(self, flight):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if flight.done.is_set():
+                return
+            flight.async_waiters.append((loop, future))
+        await future
+
+    def do(self, key, call_site, query):
+        flight, is_leader = self._join(key, call_site)
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        try:
+            flight.response = query()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+        return flight.response
+
+    async def ado(self, key, call_site, aquery):
+        """async version of do, the leader and the waiters may be sync or async callers"""
+        flight, is_leader = self._join(key, call_site)
+        if not is_leader:
+            await self._await_landing(flight)
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        try:
+            flight.response = await aquery()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+        return flight.response
+
+    def get_stats(self):
+        """calls and saved (coalesced) calls per call site"""
+        with self.lock:
+            return {call_site: dict(stats) for call_site, stats in self.stats.items()}
+
+
+_singleflight = SingleFlight()
+
+
+def get_singleflight():
+    """get the process-wide single-flight group, None if `cache.singleflight` is disabled"""
+    if not CACHE_CONFIG.get("singleflight", True):
+        return None
+    return _singleflight
+
+
+class CachedQueryFunc():
+    """wrap a provider query function with the LLM cache
+
+    It is called like the raw query function, with three extra keyword arguments:
+    `call_site` names the caller, only the call sites listed in `cache.call_sites` use the cache,
+    so sampled generations (actions, InfoNav, conclusions) are always fresh,
+    `use_cache=False` skips the cache for this call,
+    `validate` checks a response before it is cached, so a useless answer is not served again.
+    `stream` yields the response chunk by chunk and shares the cache with `__call__`.
+    `structured` queries the provider's structured-output mode with a JSON schema, if it has one.
+    Cache misses go through the process-wide single-flight group, so identical prompts
+    in flight at the same time are sent once (not for `use_cache=False` calls, which want a fresh response).
+    """
+
+    def __init__(self, query_func, provider, model=None, stream_func=None, structured_func=None) -> None:
+        self.query_func = query_func
+        self.stream_func = stream_func
+        self.structured_func = structured_func
+        self.provider = provider
+        self.model = model
+        self.call_sites = set(CACHE_CONFIG.get("call_sites") or [])
+
+    def get_key(self, prompt, args, kwargs):
+        extra = {"args": list(args), "kwargs": {k: v for k, v in kwargs.items() if k != "temperature"}}
+        return make_cache_key(self.provider, self.model, kwargs.get("temperature"), prompt, extra)
+
+    def lookup(self, prompt, args, kwargs, call_site, use_cache, memory_only=False):
+        """return (cache, key, cached response), cache is None when the call bypasses caching"""
+        cache = get_llm_cache()
+        if cache is None:
+            return None, None, None
+        if not use_cache or call_site not in self.call_sites:
+            cache.record_bypass()
+            return None, None, None
+        key = self.get_key(prompt, args, kwargs)
+        return cache, key, cache.get(key, memory_only=memory_only)
+
+    def __call__(self, prompt, *args, call_site=None, use_cache=True, validate=None, **kwargs):
+        return self.cached_query(self.query_func, prompt, args, kwargs, call_site, use_cache, validate)
+
+    def cached_query(self, query_func, prompt, args, kwargs, call_site, use_cache, validate=None):
+        cache, key, response = self.lookup(prompt, args, kwargs, call_site, use_cache)
+        if response is not None:
+            return response
+
+        def query():
+            response = query_func(prompt, *args, **kwargs)
+            if cache is not None and response and (validate is None or validate(response)):
+                cache.set(key, response)
+            return response
+
+        singleflight = get_singleflight()
+        if singleflight is None or not use_cache:
+            return query()
+        return singleflight.do(key or self.get_key(prompt, args, kwargs), call_site, query)
+
+    def structured(self, prompt, schema, call_site=None, use_cache=True):
+        """query with the answer constrained to a JSON schema (JSON mode / tool calling)
+
+        Args:
+            prompt (str): the prompt
+            schema (dict): JSON schema of the answer
+            call_site (str, optional): name of the caller. Defaults to None.
+            use_cache (bool, optional): False to skip the cache. Defaults to True.
+
+        Returns:
+            str: the answer as JSON text, None if the provider has no structured-output mode or rejected it before
+        """
+        if self.structured_func is None or is_structured_rejected(self.provider):
+            return None
+        # the schema is part of the cache key, so structured and plain answers never mix
+        try:
+            return self.cached_query(self.structured_func, prompt, (), {"schema": schema}, call_site, use_cache)
+        except Exception as e:
+            record_structured_error(self.provider, e)
+            raise
+
+    def stream(self, prompt, *args, call_site=None, use_cache=True, **kwargs):
+        """yield the response text chunk by chunk
+
+        a cached response is yielded as a single chunk, providers without
+        a stream function fall back to one blocking query.
+        """
+        cache, key, response = self.lookup(prompt, args, kwargs, call_site, use_cache)
+        if response is not None:
+            yield response
+            return
+        if self.stream_func is None:
+            response = self.query_func(prompt, *args, **kwargs)
+            yield response
+        else:
+            chunks = []
+            for chunk in self.stream_func(prompt, *args, **kwargs):
+                chunks.append(chunk)
+                yield chunk
+            response = "".join(chunks)
+        if cache is not None and response:
+            cache.set(key, response)
+
+
+class AsyncCachedQueryFunc(CachedQueryFunc):
+    """async version of CachedQueryFunc, wraps a coroutine query function
+
+    only the memory tier is looked up on the event loop, the SQLite reads and writes of the disk tier run in a thread.
+    """
+
+    async def __call__(self, prompt, *args, call_site=None, use_cache=True, validate=None, **kwargs):
+        cache, key, response = self.lookup(prompt, args, kwargs, call_site, use_cache, memory_only=True)
+        if response is None and cache is not None and cache.has_disk:
+            response = await asyncio.to_thread(cache.get, key)
+        if response is not None:
+            return response
+
+        async def aquery():
+            response = await self.query_func(prompt, *args, **kwargs)
+            if cache is not None and response and (validate is None or validate(response)):
+                if cache.has_disk:
+                    await asyncio.to_thread(cache.set, key, response)
+                else:
+                    cache.set(key, response)
+            return response
+
+        singleflight = get_singleflight()
+        if singleflight is None or not use_cache:
+            return await aquery()
+        return await singleflight.ado(key or self.get_key(prompt, args, kwargs), call_site, aquery)
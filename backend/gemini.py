@@ -1,28 +1,33 @@
 import os
+from functools import lru_cache
 
-import google.generativeai as genai
 import yaml
-from tenacity import retry
-from tenacity.stop import stop_after_attempt
-from tenacity.wait import wait_exponential
+
+from backend.resilience import resilient
 
 file_path = os.path.dirname(__file__)
 project_path = os.path.dirname(file_path)
 global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
 
-MAX_RETRY_TIMES = global_config.get("agent").get("max_query_retry_times", 10)
 GOOGLE_API_KEY = global_config.get("backend").get("google_api_key")
 
-genai.configure(api_key=GOOGLE_API_KEY)
+GEMINI_MODELS = {
+    'gemini-1.0-pro-latest': {"max_output_tokens": 2048},
+    'gemini-1.5-pro-latest': {"max_output_tokens": 8192},
+}
+
 
-model_10 = genai.GenerativeModel('gemini-1.0-pro-latest', generation_config={"max_output_tokens": 2048})
-model_15 = genai.GenerativeModel('gemini-1.5-pro-latest', generation_config={"max_output_tokens": 8192})
+@lru_cache(maxsize=None)
+def get_model(model_name):
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai.GenerativeModel(model_name, generation_config=GEMINI_MODELS[model_name])
 
 
-@retry(wait=wait_exponential(min=1, max=10), stop=stop_after_attempt(MAX_RETRY_TIMES))
+@resilient("gemini")
 def query_gemini(q):
     try:
-        response = model_10.generate_content(q)
+        response = get_model('gemini-1.0-pro-latest').generate_content(q)
         return response.text
     except ValueError as e:
         if hasattr(e, 'response'):
@@ -34,10 +39,26 @@ def query_gemini(q):
         else:
             raise e
 
-@retry(wait=wait_exponential(min=1, max=10), stop=stop_after_attempt(MAX_RETRY_TIMES))
+@resilient("gemini")
 def query_gemini_15(q):
     try:
-        response = model_15.generate_content(q)
+        response = get_model('gemini-1.5-pro-latest').generate_content(q)
+        return response.text
+    except ValueError as e:
+        if hasattr(e, 'response'):
+            response = e.response
+            response_text = ""
+            for candidate in response.candidates:
+                response_text += " ".join([part.text for part in candidate.content.parts])
+            return response_text
+        else:
+            raise e
+
+
+@resilient("gemini")
+async def aquery_gemini(q):
+    try:
+        response = await get_model('gemini-1.0-pro-latest').generate_content_async(q)
         return response.text
     except ValueError as e:
         if hasattr(e, 'response'):
@@ -48,3 +69,27 @@ def query_gemini_15(q):
             return response_text
         else:
             raise e
+
+@resilient("gemini")
+async def aquery_gemini_15(q):
+    try:
+        response = await get_model('gemini-1.5-pro-latest').generate_content_async(q)
+        return response.text
+    except ValueError as e:
+        if hasattr(e, 'response'):
+            response = e.response
+            response_text = ""
+            for candidate in response.candidates:
+                response_text += " ".join([part.text for part in candidate.content.parts])
+            return response_text
+        else:
+            raise e
+
+
+def stream_gemini(q):
+    for chunk in get_model('gemini-1.0-pro-latest').generate_content(q, stream=True):
+        try:
+            yield chunk.text
+        except ValueError:
+            # chunks without a valid part (e.g. blocked by safety settings) carry no text
+            continue
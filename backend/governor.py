@@ -0,0 +1,425 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+import yaml
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+GOVERNOR_CONFIG = global_config.get("governor") or {}
+
+# flow of the calls made in the current context, threads and tasks started with a copy of the context share it
+_current_flow = contextvars.ContextVar("governor_flow", default=None)
+
+
+@contextmanager
+def governor_flow(flow):
+    """make the LLM calls issued in this context one flow of the fair queues, e.g. one communication
+
+    Args:
+        flow (hashable): flow id
+    """
+    token = _current_flow.set(flow)
+    try:
+        yield
+    finally:
+        _current_flow.reset(token)
+
+
+def resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class TokenBucket():
+    """token bucket refilled continuously at `per_minute / 60` per second
+
+    `reserve` never blocks: it takes the tokens immediately (the balance may go negative)
+    and returns how long the caller has to wait before the reservation is covered,
+    so concurrent callers are served in reservation order and wait only as long as the quota requires.
+    """
+
+    def __init__(self, per_minute) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1) -> float:
+        """take `amount` tokens
+
+        Returns:
+            float: seconds to wait before the tokens are available, 0 if they are available now
+        """
+        # a single request larger than the bucket could never be served, clamp it to a full bucket
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class FairQueue():
+    """bounded number of in-flight calls, waiting callers are served round-robin across flows
+
+    a flow is one communication (see governor_flow, by default the calling thread or asyncio task),
+    so a communication issuing many calls can not starve the others.
+    Sync callers wait on a condition, async callers on a future of their event loop which the releaser resolves.
+    """
+
+    def __init__(self, max_in_flight) -> None:
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.waiting = OrderedDict()  # flow -> deque of tickets, in round-robin order
+        self.granted = set()
+        self.async_waiters = {}  # ticket -> (event loop, future) of async callers
+        self.tickets = itertools.count()
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight and self.waiting:
+            flow, tickets = self.waiting.popitem(last=False)
+            ticket = tickets.popleft()
+            self.granted.add(ticket)
+            self.in_flight += 1
+            waiter = self.async_waiters.pop(ticket, None)
+            if waiter is not None:
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(resolve_future, future)
+                except RuntimeError:
+                    # the event loop of the waiter is closed, nobody will use the slot
+                    self.granted.discard(ticket)
+                    self.in_flight -= 1
+            if tickets:
+                # the flow goes to the back of the line for its next call
+                self.waiting[flow] = tickets
+        self.cond.notify_all()
+
+    def acquire(self, flow):
+        with self.cond:
+            ticket = next(self.tickets)
+            self.waiting.setdefault(flow, deque()).append(ticket)
+            self._dispatch()
+            while ticket not in self.granted:
+                self.cond.wait()
+            self.granted.remove(ticket)
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self._dispatch()
+
+    async def aacquire(self, flow):
+        """async version of acquire, the event loop is not blocked while waiting"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.cond:
+            ticket = next(self.tickets)
+            self.waiting.setdefault(flow, deque()).append(ticket)
+            self.async_waiters[ticket] = (loop, future)
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.cond:
+                self.async_waiters.pop(ticket, None)
+                if ticket in self.granted:
+                    # granted while being cancelled, hand the slot back
+                    self.granted.remove(ticket)
+                    self.in_flight -= 1
+                    self._dispatch()
+                else:
+                    tickets = self.waiting.get(flow)
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self.waiting[flow]
+            raise
+        with self.cond:
+            self.granted.remove(ticket)
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(tickets) for tickets in self.waiting.values())
+
+
+class Governor():
+    """flow control of one (provider, model): requests/tokens per minute and in-flight calls
+
+    every call (every attempt of a retried call, see GovernedCall) first waits for a slot in the
+    fair queue, then for its share of the rpm/tpm quota, the total wait is recorded as queue-wait metrics.
+    """
+
+    def __init__(self, name, rpm=0, tpm=0, max_in_flight=0, model=None) -> None:
+        """init
+
+        Args:
+            name (str): name of the governor, usually "provider/model"
+            rpm (int, optional): requests per minute, 0 for unlimited. Defaults to 0.
+            tpm (int, optional): prompt tokens per minute, 0 for unlimited. Defaults to 0.
+            max_in_flight (int, optional): max concurrent calls, 0 for unlimited. Defaults to 0.
+            model (str, optional): model used to count prompt tokens. Defaults to None.
+        """
+        self.name = name
+        self.model = model
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.queue = FairQueue(max_in_flight) if max_in_flight else None
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=1000)
+        self.stats = {"calls": 0, "delayed_calls": 0, "total_wait": 0.0, "max_wait": 0.0, "in_flight": 0}
+
+    def count_tokens(self, prompt):
+        if self.token_bucket is None or not isinstance(prompt, str):
+            return 0
+        from backend.tokens import count_prompt_tokens
+        return count_prompt_tokens(prompt, self.model or "gpt-3.5-turbo")
+
+    def reserve(self, prompt) -> float:
+        """take the rpm/tpm quota of one call, return the seconds to wait for it"""
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.reserve(self.count_tokens(prompt)))
+        return wait
+
+    def _record(self, wait):
+        with self.lock:
+            self.waits.append(wait)
+            self.stats["calls"] += 1
+            self.stats["in_flight"] += 1
+            self.stats["total_wait"] += wait
+            self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+            if wait > 0.001:
+                self.stats["delayed_calls"] += 1
+        if wait > 1:
+            logging.info("governor {} delayed a call by {:.2f}s".format(self.name, wait))
+
+    def acquire(self, prompt, flow=None):
+        """wait for a slot of this governor and the rpm/tpm quota of one attempt, see release"""
+        start_time = time.perf_counter()
+        if self.queue is not None:
+            flow = flow if flow is not None else _current_flow.get()
+            self.queue.acquire(flow if flow is not None else threading.get_ident())
+        try:
+            wait = self.reserve(prompt)
+            if wait > 0:
+                time.sleep(wait)
+            self._record(time.perf_counter() - start_time)
+        except BaseException:
+            if self.queue is not None:
+                self.queue.release()
+            raise
+
+    async def aacquire(self, prompt, flow=None):
+        """async version of acquire"""
+        start_time = time.perf_counter()
+        if self.queue is not None:
+            flow = flow if flow is not None else _current_flow.get()
+            await self.queue.aacquire(flow if flow is not None else id(asyncio.current_task()))
+        try:
+            wait = self.reserve(prompt)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._record(time.perf_counter() - start_time)
+        except BaseException:
+            if self.queue is not None:
+                self.queue.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            self.stats["in_flight"] -= 1
+        if self.queue is not None:
+            self.queue.release()
+
+    @contextmanager
+    def slot(self, prompt, flow=None):
+        """hold a slot of this governor for the duration of one call"""
+        self.acquire(prompt, flow)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, prompt, flow=None):
+        """async version of slot"""
+        await self.aacquire(prompt, flow)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            waits = sorted(self.waits)
+        stats["queued"] = self.queue.qsize() if self.queue is not None else 0
+        stats["mean_wait"] = stats["total_wait"] / stats["calls"] if stats["calls"] else 0.0
+        stats["p50_wait"] = waits[len(waits) // 2] if waits else 0.0
+        stats["p99_wait"] = waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0
+        return stats
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(provider, model=None):
+    """get the process-wide governor of a provider and model, built from the `governor` section of global config
+
+    limits are looked up in `governor.limits` under "provider/model" first, then "provider",
+    unset values fall back to the defaults of the `governor` section.
+
+    Args:
+        provider (str): provider name, e.g. "gpt4" or "openai_embedding"
+        model (str, optional): model name. Defaults to None.
+
+    Returns:
+        Governor: the shared governor, None if the governor is disabled
+    """
+    if not GOVERNOR_CONFIG.get("enable", False):
+        return None
+    name = "{}/{}".format(provider, model) if model else provider
+    if name not in _governors:
+        with _governors_lock:
+            if name not in _governors:
+                limits = GOVERNOR_CONFIG.get("limits") or {}
+                config = dict(limits.get(provider) or {})
+                config.update(limits.get(name) or {})
+                _governors[name] = Governor(name,
+                                            rpm=config.get("rpm", GOVERNOR_CONFIG.get("rpm", 0)),
+                                            tpm=config.get("tpm", GOVERNOR_CONFIG.get("tpm", 0)),
+                                            max_in_flight=config.get("max_in_flight",
+                                                                     GOVERNOR_CONFIG.get("max_in_flight", 0)),
+                                            model=model)
+    return _governors[name]
+
+
+def get_governor_stats() -> dict:
+    """queue-wait metrics of every governor used so far"""
+    return {name: governor.get_stats() for name, governor in list(_governors.items())}
+
+
+class GovernedCall():
+    """the governor slot of one call of a governed query function
+
+    the slot is taken before the first attempt. A resilient call gives it back while it backs off
+    and takes a new one for its next attempt, which reserves its own rpm/tpm quota,
+    see release_slot and retake_slot.
+    """
+
+    def __init__(self, governor, prompt) -> None:
+        self.governor = governor
+        self.prompt = prompt
+        self.held = False
+
+    def acquire(self):
+        if not self.held:
+            self.governor.acquire(self.prompt)
+            self.held = True
+
+    async def aacquire(self):
+        if not self.held:
+            await self.governor.aacquire(self.prompt)
+            self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.governor.release()
+
+
+# the governed call made in the current context, see GovernedCall
+_current_call = contextvars.ContextVar("governor_call", default=None)
+
+
+def release_slot():
+    """give back the slot of the governed call made in this context, e.g. before a retry backs off"""
+    call = _current_call.get()
+    if call is not None:
+        call.release()
+
+
+def retake_slot():
+    """take a slot for the next attempt of the governed call made in this context, a no-op while it holds one"""
+    call = _current_call.get()
+    if call is not None:
+        call.acquire()
+
+
+async def aretake_slot():
+    """async version of retake_slot"""
+    call = _current_call.get()
+    if call is not None:
+        await call.aacquire()
+
+
+def govern(query_func, provider, model=None):
+    """wrap a sync query function (prompt as first argument) with the governor of provider and model
+
+    each attempt of a resilient query function holds a slot of its own, the backoff between them none.
+    """
+    governor = get_governor(provider, model)
+    if governor is None:
+        return query_func
+
+    @functools.wraps(query_func)
+    def governed(prompt, *args, **kwargs):
+        call = GovernedCall(governor, prompt)
+        call.acquire()
+        token = _current_call.set(call)
+        try:
+            return query_func(prompt, *args, **kwargs)
+        finally:
+            _current_call.reset(token)
+            call.release()
+    return governed
+
+
+def agovern(aquery_func, provider, model=None):
+    """async version of govern"""
+    governor = get_governor(provider, model)
+    if governor is None:
+        return aquery_func
+
+    @functools.wraps(aquery_func)
+    async def governed(prompt, *args, **kwargs):
+        call = GovernedCall(governor, prompt)
+        await call.aacquire()
+        token = _current_call.set(call)
+        try:
+            return await aquery_func(prompt, *args, **kwargs)
+        finally:
+            _current_call.reset(token)
+            call.release()
+    return governed
+
+
+def sgovern(stream_func, provider, model=None):
+    """govern a stream function, the slot is held until the stream is exhausted or closed"""
+    governor = get_governor(provider, model)
+    if governor is None:
+        return stream_func
+
+    @functools.wraps(stream_func)
+    def governed(prompt, *args, **kwargs):
+        with governor.slot(prompt):
+            yield from stream_func(prompt, *args, **kwargs)
+    return governed
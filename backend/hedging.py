@@ -0,0 +1,263 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+
+from backend.resilience import CallCancelledError, cancellable
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+HEDGING_CONFIG = global_config.get("hedging") or {}
+
+
+class LatencyTracker():
+    """rolling latency and error stats of one provider over its last `window` calls"""
+
+    def __init__(self, window=100) -> None:
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.errors = deque(maxlen=window)
+
+    def record(self, latency=None, error=False):
+        with self.lock:
+            self.errors.append(error)
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def percentile(self, p):
+        """latency percentile in seconds, None if no call succeeded yet"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    def error_rate(self):
+        with self.lock:
+            return sum(self.errors) / len(self.errors) if self.errors else 0.0
+
+    def samples(self):
+        with self.lock:
+            return len(self.latencies)
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+_stats = {"calls": 0, "hedged_calls": 0, "hedge_wins": 0, "failovers": 0}
+
+
+def get_tracker(provider) -> LatencyTracker:
+    if provider not in _trackers:
+        with _trackers_lock:
+            if provider not in _trackers:
+                _trackers[provider] = LatencyTracker(window=HEDGING_CONFIG.get("window", 100))
+    return _trackers[provider]
+
+
+def _count(name):
+    with _trackers_lock:
+        _stats[name] += 1
+
+
+def get_hedging_stats() -> dict:
+    """hedging counters and rolling latency/error stats of every provider used so far"""
+    with _trackers_lock:
+        stats = dict(_stats)
+    stats["providers"] = {name: {"samples": tracker.samples(),
+                                 "p50": tracker.percentile(50),
+                                 "p99": tracker.percentile(99),
+                                 "error_rate": tracker.error_rate()}
+                          for name, tracker in list(_trackers.items())}
+    return stats
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _trackers_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HEDGING_CONFIG.get("max_workers", 32),
+                                               thread_name_prefix="hedging")
+    return _executor
+
+
+class HedgedQueryFunc():
+    """query the primary provider, hedge to a secondary one when it is slow or failing
+
+    The call goes to the best ranked provider (the primary `backend.provider` unless its recent
+    error rate exceeds `hedging.max_error_rate`). If it has not answered after the
+    `hedging.percentile` of its recent latency, the same prompt is sent to the next provider
+    and the first successful answer wins; if it fails, the next provider is tried at once.
+    Secondaries are ranked by recent median latency.
+
+    the requests left when one answers are dropped: those not started yet are cancelled,
+    the running ones stop before their next retry. With no healthy provider to hedge to,
+    the call is made directly in the calling thread and only fails over on errors.
+    """
+
+    def __init__(self, providers) -> None:
+        """init
+
+        Args:
+            providers (list[BackendProvider]): the primary provider first, then the secondary ones
+        """
+        self.providers = providers
+        self.percentile = HEDGING_CONFIG.get("percentile", 95)
+        self.min_samples = HEDGING_CONFIG.get("min_samples", 20)
+        self.initial_delay = HEDGING_CONFIG.get("initial_delay", 10)
+        self.max_error_rate = HEDGING_CONFIG.get("max_error_rate", 0.5)
+
+    def rank(self):
+        primary = self.providers[0]
+
+        def key(provider):
+            tracker = get_tracker(provider.name)
+            median = tracker.percentile(50)
+            return (tracker.error_rate() > self.max_error_rate,
+                    provider is not primary,
+                    median if median is not None else float("inf"))
+        # sorted is stable, secondaries without stats keep their configured order
+        return sorted(self.providers, key=key)
+
+    def hedge_delay(self, provider):
+        tracker = get_tracker(provider.name)
+        if tracker.samples() < self.min_samples:
+            return self.initial_delay
+        return tracker.percentile(self.percentile)
+
+    def is_healthy(self, provider):
+        return get_tracker(provider.name).error_rate() <= self.max_error_rate
+
+    def _query(self, provider, prompt, args, kwargs, cancel_event=None):
+        tracker = get_tracker(provider.name)
+        start_time = time.perf_counter()
+        try:
+            with cancellable(cancel_event):
+                response = provider.query_func(prompt, *args, **kwargs)
+        except CallCancelledError:
+            raise
+        except Exception:
+            tracker.record(error=True)
+            raise
+        tracker.record(latency=time.perf_counter() - start_time)
+        return response
+
+    def _submit(self, executor, provider, prompt, args, kwargs, cancel_event):
+        # in a copy of the caller's context, e.g. its governor flow
+        return executor.submit(contextvars.copy_context().run, self._query, provider, prompt, args, kwargs, cancel_event)
+
+    def query_directly(self, providers, prompt, args, kwargs):
+        """query the providers in turn in the calling thread, the next one only if the previous failed"""
+        for provider in providers:
+            try:
+                return self._query(provider, prompt, args, kwargs)
+            except Exception as e:
+                error = e
+                logging.warning("{} failed: {!r}".format(provider.name, error))
+                if provider is not providers[-1]:
+                    _count("failovers")
+        raise error
+
+    def __call__(self, prompt, *args, **kwargs):
+        _count("calls")
+        first, *rest = self.rank()
+        if not any(self.is_healthy(provider) for provider in rest):
+            # hedging to a failing provider would not help, no need for a thread
+            return self.query_directly([first] + rest, prompt, args, kwargs)
+        executor = get_executor()
+        cancel_event = threading.Event()
+        pending = {self._submit(executor, first, prompt, args, kwargs, cancel_event): first}
+        delay = self.hedge_delay(first)
+        hedged = False
+        error = None
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=None if hedged or not rest else delay, return_when=FIRST_COMPLETED)
+                if not done:
+                    provider = rest.pop(0)
+                    logging.info("{} slower than {:.2f}s, hedging to {}".format(first.name, delay, provider.name))
+                    _count("hedged_calls")
+                    pending[self._submit(executor, provider, prompt, args, kwargs, cancel_event)] = provider
+                    hedged = True
+                    continue
+                for future in done:
+                    provider = pending.pop(future)
+                    if future.exception() is None:
+                        if provider is not first:
+                            _count("hedge_wins")
+                        return future.result()
+                    error = future.exception()
+                    logging.warning("{} failed: {!r}".format(provider.name, error))
+                if not pending and rest:
+                    provider = rest.pop(0)
+                    _count("failovers")
+                    pending[self._submit(executor, provider, prompt, args, kwargs, cancel_event)] = provider
+                    hedged = True
+            raise error
+        finally:
+            # the losers are not waited for, the ones still queued never start
+            cancel_event.set()
+            for future in pending:
+                future.cancel()
+
+
+class AsyncHedgedQueryFunc(HedgedQueryFunc):
+    """async version of HedgedQueryFunc, the slower request is cancelled once one answer arrives"""
+
+    async def _aquery(self, provider, prompt, args, kwargs):
+        tracker = get_tracker(provider.name)
+        start_time = time.perf_counter()
+        try:
+            response = await provider.aquery_func(prompt, *args, **kwargs)
+        except Exception:
+            tracker.record(error=True)
+            raise
+        tracker.record(latency=time.perf_counter() - start_time)
+        return response
+
+    async def __call__(self, prompt, *args, **kwargs):
+        _count("calls")
+        first, *rest = self.rank()
+        pending = {asyncio.ensure_future(self._aquery(first, prompt, args, kwargs)): first}
+        delay = self.hedge_delay(first)
+        hedged = False
+        error = None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=None if hedged or not rest else delay,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    provider = rest.pop(0)
+                    logging.info("{} slower than {:.2f}s, hedging to {}".format(first.name, delay, provider.name))
+                    _count("hedged_calls")
+                    pending[asyncio.ensure_future(self._aquery(provider, prompt, args, kwargs))] = provider
+                    hedged = True
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if provider is not first:
+                            _count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+                    logging.warning("{} failed: {!r}".format(provider.name, error))
+                if not pending and rest:
+                    provider = rest.pop(0)
+                    _count("failovers")
+                    pending[asyncio.ensure_future(self._aquery(provider, prompt, args, kwargs))] = provider
+                    hedged = True
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,29 @@
+import asyncio
+import functools
+import threading
+
+
+def cache_per_event_loop(func):
+    """like `functools.lru_cache(maxsize=None)`, but with one cache per running event loop
+
+    async SDK clients (AsyncOpenAI and its httpx connection pool) are bound to the event loop
+    they are first used on, a client shared across loops fails with "Event loop is closed" on the
+    next `asyncio.run`. The wrapped function must be called from a coroutine, the entries of closed
+    loops are dropped when a new loop builds its first entry.
+    """
+    caches = {}  # event loop -> {args: result}
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        loop = asyncio.get_running_loop()
+        with lock:
+            cache = caches.get(loop)
+            if cache is None:
+                for closed_loop in [other for other in caches if other.is_closed()]:
+                    del caches[closed_loop]
+                cache = caches[loop] = {}
+            if args not in cache:
+                cache[args] = func(*args)
+            return cache[args]
+    return wrapper
@@ -1,23 +1,48 @@
 import os
+from functools import lru_cache
 
-from llama_index.llms.ollama import Ollama
 import yaml
-from tenacity import retry
-from tenacity.stop import stop_after_attempt
-from tenacity.wait import wait_exponential
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+from backend.loops import cache_per_event_loop
+from backend.resilience import resilient
 
 file_path = os.path.dirname(__file__)
 project_path = os.path.dirname(file_path)
 global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
 
-MAX_RETRY_TIMES = global_config.get("agent").get("max_query_retry_times", 10)
 OLLAMA_MODEL_NAME = global_config.get("backend").get("ollama_model_name", "qwen2:0.5b")
 
-ollama_model = Ollama(model=OLLAMA_MODEL_NAME, request_timeout=300.0)
-ollama_embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
 
+@lru_cache(maxsize=None)
+def get_ollama_model():
+    from llama_index.llms.ollama import Ollama
+    return Ollama(model=OLLAMA_MODEL_NAME, request_timeout=300.0)
+
+
+@cache_per_event_loop
+def get_async_ollama_model():
+    # the async client of the model is bound to the event loop it is first used on
+    from llama_index.llms.ollama import Ollama
+    return Ollama(model=OLLAMA_MODEL_NAME, request_timeout=300.0)
+
+
+@lru_cache(maxsize=None)
+def get_ollama_embed_model():
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    return HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
 
-@retry(wait=wait_exponential(min=10, max=300), stop=stop_after_attempt(MAX_RETRY_TIMES))
+
+@resilient("ollama")
 def query_ollama(prompt):
-    return ollama_model.complete(prompt).text
\ No newline at end of file
+    return get_ollama_model().complete(prompt).text
+
+
+@resilient("ollama")
+async def aquery_ollama(prompt):
+    return (await get_async_ollama_model().acomplete(prompt)).text
+
+
+def stream_ollama(prompt):
+    for chunk in get_ollama_model().stream_complete(prompt):
+        if chunk.delta:
+            yield chunk.delta
@@ -0,0 +1,174 @@
+import importlib
+import logging
+import os
+import threading
+import time
+
+import yaml
+
+from backend.governor import agovern, govern, sgovern
+from backend.hedging import AsyncHedgedQueryFunc, HedgedQueryFunc
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+OLLAMA_MODEL_NAME = global_config.get("backend").get("ollama_model_name", "qwen2:0.5b")
+HEDGING_CONFIG = global_config.get("hedging") or {}
+# providers known to accept a forced tool_choice
+STRUCTURED_OUTPUT_PROVIDERS = global_config.get("backend").get("structured_output") or []
+if STRUCTURED_OUTPUT_PROVIDERS is True:
+    STRUCTURED_OUTPUT_PROVIDERS = ["gpt", "gpt4", "deepseek", "qwen"]
+STRUCTURED_OUTPUT_PROVIDERS = set(STRUCTURED_OUTPUT_PROVIDERS)
+
+
+class BackendProvider():
+    """one LLM provider in the backend registry
+
+    The provider module (and with it the provider SDK) is only imported
+    the first time one of its query functions is requested.
+    """
+
+    def __init__(self, name, module, query, aquery, stream, model, client=None, structured=None) -> None:
+        """init
+
+        Args:
+            name (str): provider name used in `backend.provider`
+            module (str): dotted path of the backend module
+            query (str): name of the sync query function in the module
+            aquery (str): name of the async query function in the module
+            stream (str): name of the generator in the module which yields the response text chunk by chunk
+            model (str): model name queried by the provider
+            client (tuple, optional): (builder name, *args) in the module which imports the SDK and builds the client. Defaults to None.
+            structured (str, optional): name of the function in the module which queries with a JSON schema
+                (JSON mode / tool calling) and returns the answer as JSON text. Defaults to None, for providers without one.
+        """
+        self.name = name
+        self.module_name = module
+        self.query_name = query
+        self.aquery_name = aquery
+        self.stream_name = stream
+        self.structured_name = structured
+        self.model = model
+        self.client = client
+        self.module = None
+        self.startup_time = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """import the provider module and build its SDK client once, record how long it took"""
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    start_time = time.perf_counter()
+                    module = importlib.import_module(self.module_name)
+                    if self.client is not None:
+                        builder_name, *builder_args = self.client
+                        getattr(module, builder_name)(*builder_args)
+                    self.startup_time = time.perf_counter() - start_time
+                    self.module = module
+                    logging.info("backend provider {} loaded in {:.3f}s".format(self.name, self.startup_time))
+        return self.module
+
+    # the query functions are handed out behind the governor of this provider and model
+
+    @property
+    def query_func(self):
+        return govern(getattr(self.load(), self.query_name), self.name, self.model)
+
+    @property
+    def aquery_func(self):
+        return agovern(getattr(self.load(), self.aquery_name), self.name, self.model)
+
+    @property
+    def stream_func(self):
+        return sgovern(getattr(self.load(), self.stream_name), self.name, self.model)
+
+    @property
+    def structured_func(self):
+        if self.structured_name is None:
+            return None
+        return govern(getattr(self.load(), self.structured_name), self.name, self.model)
+
+
+BACKEND_REGISTRY = {provider.name: provider for provider in [
+    BackendProvider("gemini", "backend.gemini", "query_gemini", "aquery_gemini", "stream_gemini",
+                    "gemini-1.0-pro-latest", client=("get_model", "gemini-1.0-pro-latest")),
+    BackendProvider("gpt", "backend.gpt", "query_gpt", "aquery_gpt", "stream_gpt",
+                    "gpt-3.5-turbo-16k", client=("get_client",), structured="query_gpt_structured"),
+    BackendProvider("gpt4", "backend.gpt", "query_gpt4", "aquery_gpt4", "stream_gpt4",
+                    "gpt-4o-mini", client=("get_client",), structured="query_gpt4_structured"),
+    BackendProvider("claude", "backend.gpt", "query_claude", "aquery_claude", "stream_claude",
+                    "claude-3-sonnet-20240229", client=("get_client",)),
+    BackendProvider("ollama", "backend.ollama", "query_ollama", "aquery_ollama", "stream_ollama",
+                    OLLAMA_MODEL_NAME, client=("get_ollama_model",)),
+    BackendProvider("deepseek", "backend.third_party", "query_deepseek", "aquery_deepseek", "stream_deepseek",
+                    "deepseek-chat", client=("get_client", "deepseek"), structured="query_deepseek_structured"),
+    BackendProvider("qwen", "backend.third_party", "query_qwen", "aquery_qwen", "stream_qwen",
+                    "qwen-max-latest", client=("get_client", "qwen"), structured="query_qwen_structured"),
+    BackendProvider("ernie", "backend.third_party", "query_ernie", "aquery_ernie", "stream_ernie",
+                    "ERNIE-Speed-128K"),
+    BackendProvider("glm", "backend.third_party", "query_glm", "aquery_glm", "stream_glm",
+                    "glm-4-flash", client=("get_client", "glm"), structured="query_glm_structured"),
+    BackendProvider("hunyuan", "backend.third_party", "query_hunyuan", "aquery_hunyuan", "stream_hunyuan",
+                    "hunyuan-lite", client=("get_client", "hunyuan")),
+    BackendProvider("spark", "backend.third_party", "query_spark", "aquery_spark", "stream_spark",
+                    "general", client=("get_client", "spark")),
+    BackendProvider("replay", "backend.replay", "query_replay", "aquery_replay", "stream_replay",
+                    "replay", client=("get_cassette",)),
+]}
+
+
+def get_provider(backend: str) -> BackendProvider:
+    """look up a provider in the registry
+
+    Args:
+        backend (str): provider name
+
+    Raises:
+        ValueError: if the provider is not registered
+
+    Returns:
+        BackendProvider: the registered provider
+    """
+    if backend not in BACKEND_REGISTRY:
+        raise ValueError(f"{backend} backend not implemented")
+    return BACKEND_REGISTRY[backend]
+
+
+def get_hedge_providers(backend: str) -> list:
+    """the providers a query of backend is hedged to, empty if hedging is disabled"""
+    if not HEDGING_CONFIG.get("enable", False):
+        return []
+    return [get_provider(name) for name in HEDGING_CONFIG.get("secondary") or [] if name != backend]
+
+
+def get_query_func(backend: str):
+    secondary_providers = get_hedge_providers(backend)
+    if secondary_providers:
+        return HedgedQueryFunc([get_provider(backend)] + secondary_providers)
+    return get_provider(backend).query_func
+
+
+def get_aquery_func(backend: str):
+    secondary_providers = get_hedge_providers(backend)
+    if secondary_providers:
+        return AsyncHedgedQueryFunc([get_provider(backend)] + secondary_providers)
+    return get_provider(backend).aquery_func
+
+
+def get_stream_func(backend: str):
+    return get_provider(backend).stream_func
+
+
+def get_structured_func(backend: str):
+    """the structured-output query function of backend, None if it has none or is not in `backend.structured_output`"""
+    if backend not in STRUCTURED_OUTPUT_PROVIDERS:
+        return None
+    return get_provider(backend).structured_func
+
+
+def get_startup_times() -> dict:
+    """import time in seconds of every provider loaded so far"""
+    return {name: provider.startup_time for name, provider in BACKEND_REGISTRY.items()
+            if provider.startup_time is not None}
@@ -0,0 +1,148 @@
+import asyncio
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from functools import lru_cache
+
+import yaml
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+REPLAY_CONFIG = global_config.get("replay") or {}
+
+
+class ReplayMissError(KeyError):
+    """raised in strict mode when a prompt was never recorded"""
+
+
+def hash_prompt(prompt) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class Cassette():
+    """recorded LLM responses keyed by prompt hash
+
+    responses are loaded from `*_llm.csv` logs written by iAgentsLogger (query and response columns)
+    or from JSONL cassettes with one {"prompt" or "prompt_hash", "response"} object per line.
+    A prompt recorded several times replays its responses in recorded order, then repeats the last one.
+    """
+
+    def __init__(self, paths, strict=False, fallback_response="", latency=0.0, latency_jitter=0.0, seed=0) -> None:
+        """init
+
+        Args:
+            paths (list[str]): log or cassette files, glob patterns and paths relative to the project are allowed
+            strict (bool, optional): raise ReplayMissError on unseen prompts. Defaults to False.
+            fallback_response (str, optional): response to unseen prompts when not strict. Defaults to "".
+            latency (float, optional): synthetic latency of every call in seconds. Defaults to 0.0.
+            latency_jitter (float, optional): uniform +/- jitter added to the latency. Defaults to 0.0.
+            seed (int, optional): seed of the jitter, so that runs are reproducible. Defaults to 0.
+        """
+        self.strict = strict
+        self.fallback_response = fallback_response
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.cursors = {}
+        self.stats = {"hits": 0, "misses": 0}
+        for path in paths:
+            if not os.path.isabs(path):
+                path = os.path.join(project_path, path)
+            for matched_path in sorted(glob.glob(path)):
+                self.load(matched_path)
+        logging.info("replay cassette loaded {} prompts".format(len(self.responses)))
+
+    def add(self, prompt_hash, response):
+        self.responses.setdefault(prompt_hash, []).append(response)
+
+    def load(self, path):
+        if path.endswith(".jsonl"):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    prompt_hash = record.get("prompt_hash") or hash_prompt(record["prompt"])
+                    self.add(prompt_hash, record["response"])
+        else:
+            # prompts in the llm logs easily exceed the default csv field limit
+            csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+            with open(path, "r", newline='', encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)  # header: timestamp, instruction, query, response
+                for row in reader:
+                    if len(row) < 4 or row[2] == "None" or row[3] == "None":
+                        continue
+                    self.add(hash_prompt(row[2]), row[3])
+
+    def lookup(self, prompt):
+        prompt_hash = hash_prompt(prompt)
+        with self.lock:
+            if prompt_hash not in self.responses:
+                self.stats["misses"] += 1
+                if self.strict:
+                    raise ReplayMissError("prompt {} was not recorded: {!r}".format(prompt_hash[:12], prompt[:200]))
+                return self.fallback_response
+            self.stats["hits"] += 1
+            responses = self.responses[prompt_hash]
+            cursor = self.cursors.get(prompt_hash, 0)
+            self.cursors[prompt_hash] = cursor + 1
+            return responses[min(cursor, len(responses) - 1)]
+
+    def sample_latency(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.latency_jitter, self.latency_jitter) if self.latency_jitter else 0.0
+        return max(0.0, self.latency + jitter)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+@lru_cache(maxsize=None)
+def get_cassette():
+    """the process-wide cassette built from the `replay` section of global config"""
+    paths = REPLAY_CONFIG.get("paths") or []
+    if isinstance(paths, str):
+        paths = [paths]
+    return Cassette(paths,
+                    strict=REPLAY_CONFIG.get("strict", False),
+                    fallback_response=REPLAY_CONFIG.get("fallback_response", ""),
+                    latency=REPLAY_CONFIG.get("latency", 0.0),
+                    latency_jitter=REPLAY_CONFIG.get("latency_jitter", 0.0),
+                    seed=REPLAY_CONFIG.get("seed", 0))
+
+
+def query_replay(prompt, *args, **kwargs):
+    cassette = get_cassette()
+    latency = cassette.sample_latency()
+    if latency:
+        time.sleep(latency)
+    return cassette.lookup(prompt)
+
+
+async def aquery_replay(prompt, *args, **kwargs):
+    cassette = get_cassette()
+    latency = cassette.sample_latency()
+    if latency:
+        await asyncio.sleep(latency)
+    return cassette.lookup(prompt)
+
+
+def stream_replay(prompt, *args, **kwargs):
+    """yield the recorded response word by word, the synthetic latency is spent before the first chunk"""
+    response = query_replay(prompt, *args, **kwargs)
+    words = response.split(" ")
+    for idx, word in enumerate(words):
+        yield word if idx == len(words) - 1 else word + " "
@@ -0,0 +1,290 @@
+import asyncio
+import contextvars
+import email.utils
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import yaml
+from tenacity import AsyncRetrying, Retrying, retry_if_exception
+from tenacity.stop import stop_after_attempt
+
+from backend.governor import aretake_slot, release_slot, retake_slot
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+MAX_RETRY_TIMES = global_config.get("agent").get("max_query_retry_times", 10)
+RESILIENCE_CONFIG = global_config.get("resilience") or {}
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# transient errors of the provider SDKs (openai, httpx, google api core), matched by class name
+# so that classifying an error never imports an SDK
+RETRYABLE_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError",
+    "ConnectError", "ConnectTimeout", "ReadTimeout", "WriteTimeout", "PoolTimeout", "RemoteProtocolError",
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "TooManyRequests",
+}
+
+
+class ProviderUnavailableError(Exception):
+    """raised without calling the provider while its circuit breaker is open"""
+
+    def __init__(self, provider, retry_in, last_error) -> None:
+        super().__init__("{} is unavailable (circuit open after repeated failures, next probe in {:.1f}s), "
+                         "last error: {!r}".format(provider, retry_in, last_error))
+        self.provider = provider
+        self.retry_in = retry_in
+        self.last_error = last_error
+
+
+class CallCancelledError(Exception):
+    """raised instead of another attempt of a call whose answer is not wanted anymore, e.g. the loser of a hedged query"""
+
+
+# set by the caller of a sync provider call which may give up on it, see cancellable
+_cancel_event = contextvars.ContextVar("resilience_cancel_event", default=None)
+
+
+@contextmanager
+def cancellable(event):
+    """the resilient calls made in this context stop retrying once the event is set
+
+    Args:
+        event (threading.Event): set it to cancel the calls
+    """
+    token = _cancel_event.set(event)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+
+def check_cancelled():
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise CallCancelledError("the call was cancelled by its caller")
+
+
+def cancellable_sleep(seconds):
+    """backoff sleep of sync retries, cut short when the call is cancelled"""
+    event = _cancel_event.get()
+    if event is None:
+        time.sleep(seconds)
+    else:
+        event.wait(seconds)
+
+
+def get_status_code(exc):
+    """HTTP status code of a provider error, None if it has none"""
+    for attr in ("status_code", "code", "http_status"):
+        status_code = getattr(exc, attr, None)
+        if isinstance(status_code, int) and 100 <= status_code < 600:
+            return status_code
+    response = getattr(exc, "response", None)
+    status_code = getattr(response, "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def is_retryable(exc) -> bool:
+    """classify an error: transient (rate limit, overload, network) errors are retried,
+    everything else (auth, bad request, bugs in our code) fails at once
+    """
+    if isinstance(exc, ProviderUnavailableError):
+        return False
+    status_code = get_status_code(exc)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    if isinstance(exc, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(exc).__mro__)
+
+
+def get_retry_after(exc):
+    """server-provided backoff in seconds (retry-after-ms / retry-after headers), None if absent"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryAfterWait():
+    """tenacity wait strategy: the server's Retry-After if given,
+    else exponential backoff with full jitter starting from a short first wait
+    """
+
+    def __init__(self, initial_wait=0.5, max_wait=60) -> None:
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+
+    def __call__(self, retry_state) -> float:
+        exc = retry_state.outcome.exception() if retry_state.outcome else None
+        retry_after = get_retry_after(exc) if exc is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_wait)
+        backoff = min(self.max_wait, self.initial_wait * 2 ** (retry_state.attempt_number - 1))
+        return random.uniform(backoff / 2, backoff)
+
+
+class CircuitBreaker():
+    """per-provider circuit breaker
+
+    after `failure_threshold` consecutive transient failures the circuit opens and calls fail at once
+    with ProviderUnavailableError, after `reset_timeout` seconds one probe call is let through
+    (half-open), its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, provider, failure_threshold=5, reset_timeout=30) -> None:
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = None
+        self.probing = False
+
+    def before_call(self):
+        with self.lock:
+            if self.state == "closed":
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == "open" and retry_in <= 0:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return
+            raise ProviderUnavailableError(self.provider, max(0.0, retry_in), self.last_error)
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logging.info("circuit of provider {} closed".format(self.provider))
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self, exc):
+        if not is_retryable(exc):
+            # a fatal error is a problem of the request, not of the provider,
+            # but it still ends a half-open probe
+            with self.lock:
+                self.probing = False
+            return
+        with self.lock:
+            self.failures += 1
+            self.last_error = exc
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logging.warning("circuit of provider {} opened after {} failures, last error: {!r}".format(
+                        self.provider, self.failures, exc))
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def get_state(self):
+        with self.lock:
+            return {"state": self.state, "failures": self.failures,
+                    "last_error": repr(self.last_error) if self.last_error is not None else None}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider) -> CircuitBreaker:
+    """get the process-wide circuit breaker of a provider"""
+    if provider not in _breakers:
+        with _breakers_lock:
+            if provider not in _breakers:
+                _breakers[provider] = CircuitBreaker(provider,
+                                                     failure_threshold=RESILIENCE_CONFIG.get("failure_threshold", 5),
+                                                     reset_timeout=RESILIENCE_CONFIG.get("reset_timeout", 30))
+    return _breakers[provider]
+
+
+def get_circuit_states() -> dict:
+    """state of every circuit breaker used so far"""
+    return {provider: breaker.get_state() for provider, breaker in list(_breakers.items())}
+
+
+def resilient(provider, max_attempts=None):
+    """decorator applying the shared resilience policy to a sync or async provider call
+
+    transient errors are retried (honoring Retry-After, jittered exponential backoff otherwise),
+    fatal errors are raised at once, and the provider's circuit breaker fails calls fast while it is open.
+    Called behind govern/agovern, every attempt holds a governor slot of its own and the backoff none.
+
+    Args:
+        provider (str): provider name, calls with the same name share one circuit breaker
+        max_attempts (int, optional): max attempts per call. Defaults to agent.max_query_retry_times.
+    """
+    breaker = get_circuit_breaker(provider)
+
+    def before_sleep(retry_state):
+        logging.warning("{} call failed (attempt {}): {!r}, retrying".format(
+            provider, retry_state.attempt_number, retry_state.outcome.exception()))
+        # the backoff holds no governor slot, the next attempt waits for a new one
+        release_slot()
+
+    def retry_kwargs(**kwargs):
+        return dict(retry=retry_if_exception(is_retryable),
+                    wait=RetryAfterWait(initial_wait=RESILIENCE_CONFIG.get("initial_wait", 0.5),
+                                        max_wait=RESILIENCE_CONFIG.get("max_wait", 60)),
+                    stop=stop_after_attempt(max_attempts or MAX_RETRY_TIMES),
+                    before_sleep=before_sleep,
+                    reraise=True,
+                    **kwargs)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                async for attempt in AsyncRetrying(**retry_kwargs()):
+                    with attempt:
+                        await aretake_slot()
+                        breaker.before_call()
+                        try:
+                            response = await func(*args, **kwargs)
+                        except Exception as e:
+                            breaker.record_failure(e)
+                            raise
+                        breaker.record_success()
+                return response
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                for attempt in Retrying(**retry_kwargs(sleep=cancellable_sleep)):
+                    with attempt:
+                        check_cancelled()
+                        retake_slot()
+                        breaker.before_call()
+                        try:
+                            response = func(*args, **kwargs)
+                        except Exception as e:
+                            breaker.record_failure(e)
+                            raise
+                        breaker.record_success()
+                return response
+        return wrapper
+    return decorator
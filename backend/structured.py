@@ -0,0 +1,106 @@
+import logging
+import threading
+
+from backend.resilience import get_status_code
+
+# a provider answering a forced tool_choice with one of these does not support it, it is not asked again
+STRUCTURED_REJECTION_STATUS_CODES = {400, 422}
+
+_rejected_providers = set()
+_rejected_providers_lock = threading.Lock()
+
+# python type of an example value -> JSON schema type
+JSON_SCHEMA_TYPES = [
+    (bool, "boolean"),
+    (int, "integer"),
+    (float, "number"),
+    (str, "string"),
+    (list, "array"),
+    (dict, "object"),
+]
+
+
+def json_schema_from_example(example) -> dict:
+    """JSON schema of an example value, e.g. the `response_json_format` dicts of the react prompts
+
+    every key of an example dict is required and no other key is allowed,
+    list items follow the schema of the first example item.
+
+    Args:
+        example (object): example value
+
+    Returns:
+        dict: JSON schema
+    """
+    for python_type, schema_type in JSON_SCHEMA_TYPES:
+        if isinstance(example, python_type):
+            break
+    else:
+        return {"type": "string"}
+    schema = {"type": schema_type}
+    if schema_type == "object":
+        schema["properties"] = {key: json_schema_from_example(value) for key, value in example.items()}
+        schema["required"] = list(example)
+        schema["additionalProperties"] = False
+    elif schema_type == "array":
+        schema["items"] = json_schema_from_example(example[0]) if example else {"type": "string"}
+    return schema
+
+
+def build_tool(schema, name="respond"):
+    """a single function tool whose parameters are the schema, the model is forced to call it"""
+    tools = [{"type": "function",
+              "function": {"name": name,
+                           "description": "Return the answer as the arguments of this function.",
+                           "parameters": schema}}]
+    tool_choice = {"type": "function", "function": {"name": name}}
+    return tools, tool_choice
+
+
+def get_tool_arguments(completion) -> str:
+    """the JSON arguments of the forced tool call, the message content if the model answered in text"""
+    message = completion.choices[0].message
+    if message.tool_calls:
+        return message.tool_calls[0].function.arguments
+    return message.content
+
+
+def structured_chat_completion(client, schema, **kwargs) -> str:
+    """chat completion of an OpenAI-compatible client with the answer forced into the schema by tool calling
+
+    Args:
+        client (openai.OpenAI): client of the provider
+        schema (dict): JSON schema of the answer
+        kwargs: other arguments of `chat.completions.create` (model, messages, ...)
+
+    Returns:
+        str: the answer as JSON text
+    """
+    tools, tool_choice = build_tool(schema)
+    completion = client.chat.completions.create(tools=tools, tool_choice=tool_choice, **kwargs)
+    return get_tool_arguments(completion)
+
+
+def is_structured_rejected(provider) -> bool:
+    """whether the provider rejected a structured-output request before"""
+    with _rejected_providers_lock:
+        return provider in _rejected_providers
+
+
+def record_structured_error(provider, exc) -> bool:
+    """remember the provider as not supporting structured output if the error is a rejection of the request
+
+    Args:
+        provider (str): provider name
+        exc (Exception): error of the structured-output request
+
+    Returns:
+        bool: True if the provider is not asked for structured output anymore
+    """
+    if get_status_code(exc) not in STRUCTURED_REJECTION_STATUS_CODES:
+        return False
+    with _rejected_providers_lock:
+        if provider not in _rejected_providers:
+            _rejected_providers.add(provider)
+            logging.warning("{} rejected structured output ({!r}), using plain text from now on".format(provider, exc))
+    return True
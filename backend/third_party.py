@@ -1,10 +1,11 @@
-from openai import OpenAI
 import os
+from functools import lru_cache
+
 import yaml
-from llama_index.llms.openai_like import OpenAILike
-from llama_index.llms.dashscope import DashScope, DashScopeGenerationModels
-import qianfan
 
+from backend.loops import cache_per_event_loop
+from backend.resilience import resilient
+from backend.structured import structured_chat_completion
 
 file_path = os.path.dirname(__file__)
 project_path = os.path.dirname(file_path)
@@ -21,23 +22,51 @@ os.environ["DASHSCOPE_API_KEY"] = QWEN_API_KEY
 os.environ["QIANFAN_ACCESS_KEY"] = QIANFAN_ACCESS_KEY
 os.environ["QIANFAN_SECRET_KEY"] = QIANFAN_SECRET_KEY
 
-client_deepseek = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
-client_deepseek_llama_index = OpenAILike(api_key=DEEPSEEK_API_KEY, api_base="https://api.deepseek.com/beta", model="deepseek-chat")
+# (api key, base url) of the OpenAI-compatible endpoints,
+# SDK clients are only imported and built the first time a provider is queried
+OPENAI_COMPATIBLE_ENDPOINTS = {
+    "deepseek": (DEEPSEEK_API_KEY, "https://api.deepseek.com"),
+    "qwen": (QWEN_API_KEY, "https://dashscope.aliyuncs.com/compatible-mode/v1"),
+    "glm": (GLM_API_KEY, "https://open.bigmodel.cn/api/paas/v4/"),
+    "hunyuan": (HUNYUAN_API_KEY, "https://api.hunyuan.cloud.tencent.com/v1"),
+    "spark": (SPARK_API_KEY, "https://spark-api-open.xf-yun.com/v1"),
+}
+
+
+@lru_cache(maxsize=None)
+def get_client(provider):
+    from openai import OpenAI
+    api_key, base_url = OPENAI_COMPATIBLE_ENDPOINTS[provider]
+    return OpenAI(api_key=api_key, base_url=base_url)
+
 
-client_qwen = OpenAI(api_key=QWEN_API_KEY, base_url="https://dashscope.aliyuncs.com/compatible-mode/v1")
-client_qwen_llama_index = DashScope(model_name=DashScopeGenerationModels.QWEN_MAX, api_key=QWEN_API_KEY)
+@cache_per_event_loop
+def get_async_client(provider):
+    from openai import AsyncOpenAI
+    api_key, base_url = OPENAI_COMPATIBLE_ENDPOINTS[provider]
+    return AsyncOpenAI(api_key=api_key, base_url=base_url)
 
-client_glm = OpenAI(api_key=GLM_API_KEY, base_url="https://open.bigmodel.cn/api/paas/v4/") 
-client_glm_llama_index = OpenAILike(api_key=GLM_API_KEY, api_base="https://open.bigmodel.cn/api/paas/v4/", model="glm-4-flash", is_chat_model=True, is_function_calling_model=False)
 
-client_hunyuan = OpenAI(api_key=HUNYUAN_API_KEY, base_url="https://api.hunyuan.cloud.tencent.com/v1")
-client_hunyuan_llama_index = OpenAILike(api_key=HUNYUAN_API_KEY, api_base="https://api.hunyuan.cloud.tencent.com/v1", model="hunyuan-lite", is_chat_model=True, is_function_calling_model=False)
+@lru_cache(maxsize=None)
+def get_llama_index_llm(provider):
+    if provider == "qwen":
+        from llama_index.llms.dashscope import DashScope, DashScopeGenerationModels
+        return DashScope(model_name=DashScopeGenerationModels.QWEN_MAX, api_key=QWEN_API_KEY)
 
-client_spark = OpenAI(api_key=SPARK_API_KEY, base_url='https://spark-api-open.xf-yun.com/v1')
-client_spark_llama_index = OpenAILike(api_key=SPARK_API_KEY, api_base='https://spark-api-open.xf-yun.com/v1', model="general", is_chat_model=True, is_function_calling_model=False)
+    from llama_index.llms.openai_like import OpenAILike
+    if provider == "deepseek":
+        return OpenAILike(api_key=DEEPSEEK_API_KEY, api_base="https://api.deepseek.com/beta", model="deepseek-chat")
+    elif provider == "glm":
+        return OpenAILike(api_key=GLM_API_KEY, api_base="https://open.bigmodel.cn/api/paas/v4/", model="glm-4-flash", is_chat_model=True, is_function_calling_model=False)
+    elif provider == "hunyuan":
+        return OpenAILike(api_key=HUNYUAN_API_KEY, api_base="https://api.hunyuan.cloud.tencent.com/v1", model="hunyuan-lite", is_chat_model=True, is_function_calling_model=False)
+    elif provider == "spark":
+        return OpenAILike(api_key=SPARK_API_KEY, api_base='https://spark-api-open.xf-yun.com/v1', model="general", is_chat_model=True, is_function_calling_model=False)
+    raise ValueError("{} has no llama_index llm".format(provider))
 
+@resilient("deepseek")
 def query_deepseek(prompt):
-    response = client_deepseek.chat.completions.create(
+    response = get_client("deepseek").chat.completions.create(
         model="deepseek-chat",
         messages=[
             {"role": "system", "content": "You are a helpful assistant"},
@@ -50,8 +79,9 @@ def query_deepseek(prompt):
 
 
 
+@resilient("qwen")
 def query_qwen(prompt, model="qwen-max-latest"):
-    completion = client_qwen.chat.completions.create(
+    completion = get_client("qwen").chat.completions.create(
         model=model,
         messages=[
             {'role': 'system', 'content': 'You are a helpful assistant.'},
@@ -61,7 +91,9 @@ def query_qwen(prompt, model="qwen-max-latest"):
     return completion.choices[0].message.content
 
 
+@resilient("ernie")
 def query_ernie(prompt):
+    import qianfan
     chat_comp = qianfan.ChatCompletion()
 
     resp = chat_comp.do(model="ERNIE-Speed-128K", messages=[{
@@ -72,8 +104,9 @@ def query_ernie(prompt):
     return resp["body"]["result"]
 
 
+@resilient("glm")
 def query_glm(prompt):
-    completion = client_glm.chat.completions.create(
+    completion = get_client("glm").chat.completions.create(
         model="glm-4-flash",  
         messages=[    
             {"role": "system", "content": "You are a helpful assistant."},    
@@ -85,8 +118,9 @@ def query_glm(prompt):
     return completion.choices[0].message.content
 
 
+@resilient("hunyuan")
 def query_hunyuan(prompt):  
-    completion = client_hunyuan.chat.completions.create(
+    completion = get_client("hunyuan").chat.completions.create(
         model="hunyuan-lite",
         messages=[
             {
@@ -97,8 +131,90 @@ def query_hunyuan(prompt):
     )
     return completion.choices[0].message.content
 
+@resilient("spark")
 def query_spark(prompt):    
-    completion = client_spark.chat.completions.create(
+    completion = get_client("spark").chat.completions.create(
+        model='general',
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    )
+    return completion.choices[0].message.content
+
+
+@resilient("deepseek")
+async def aquery_deepseek(prompt):
+    response = await get_async_client("deepseek").chat.completions.create(
+        model="deepseek-chat",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant"},
+            {"role": "user", "content": prompt},
+        ],
+        stream=False
+    )
+
+    return response.choices[0].message.content
+
+
+@resilient("qwen")
+async def aquery_qwen(prompt, model="qwen-max-latest"):
+    completion = await get_async_client("qwen").chat.completions.create(
+        model=model,
+        messages=[
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': prompt}],
+        )
+
+    return completion.choices[0].message.content
+
+
+@resilient("ernie")
+async def aquery_ernie(prompt):
+    import qianfan
+    chat_comp = qianfan.ChatCompletion()
+
+    resp = await chat_comp.ado(model="ERNIE-Speed-128K", messages=[{
+        "role": "user",
+        "content": prompt
+    }])
+
+    return resp["body"]["result"]
+
+
+@resilient("glm")
+async def aquery_glm(prompt):
+    completion = await get_async_client("glm").chat.completions.create(
+        model="glm-4-flash",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}],
+            top_p=0.7,
+            temperature=0.9
+        )
+
+    return completion.choices[0].message.content
+
+
+@resilient("hunyuan")
+async def aquery_hunyuan(prompt):
+    completion = await get_async_client("hunyuan").chat.completions.create(
+        model="hunyuan-lite",
+        messages=[
+            {
+                "role": "user",
+                "content": prompt,
+            },
+        ]
+    )
+    return completion.choices[0].message.content
+
+
+@resilient("spark")
+async def aquery_spark(prompt):
+    completion = await get_async_client("spark").chat.completions.create(
         model='general',
         messages=[
             {
@@ -107,4 +223,102 @@ def query_spark(prompt):
             }
         ]
     )
-    return completion.choices[0].message.content
\ No newline at end of file
+    return completion.choices[0].message.content
+
+
+def stream_openai_compatible(provider, **kwargs):
+    """yield the text chunks of a streamed chat completion from an OpenAI-compatible provider"""
+    for chunk in get_client(provider).chat.completions.create(stream=True, **kwargs):
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def stream_deepseek(prompt):
+    yield from stream_openai_compatible(
+        "deepseek",
+        model="deepseek-chat",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant"},
+            {"role": "user", "content": prompt},
+        ])
+
+
+def stream_qwen(prompt, model="qwen-max-latest"):
+    yield from stream_openai_compatible(
+        "qwen",
+        model=model,
+        messages=[
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': prompt}])
+
+
+def stream_ernie(prompt):
+    import qianfan
+    chat_comp = qianfan.ChatCompletion()
+
+    for resp in chat_comp.do(model="ERNIE-Speed-128K", messages=[{
+        "role": "user",
+        "content": prompt
+    }], stream=True):
+        yield resp["body"]["result"]
+
+
+def stream_glm(prompt):
+    yield from stream_openai_compatible(
+        "glm",
+        model="glm-4-flash",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}],
+        top_p=0.7,
+        temperature=0.9)
+
+
+def stream_hunyuan(prompt):
+    yield from stream_openai_compatible(
+        "hunyuan",
+        model="hunyuan-lite",
+        messages=[{"role": "user", "content": prompt}])
+
+
+def stream_spark(prompt):
+    yield from stream_openai_compatible(
+        "spark",
+        model='general',
+        messages=[{"role": "user", "content": prompt}])
+
+
+# tool calling forces the answer into a JSON schema; glm only accepts tool_choice auto,
+# so it is left out of backend.structured_output by default
+
+@resilient("deepseek")
+def query_deepseek_structured(prompt, schema):
+    return structured_chat_completion(
+        get_client("deepseek"), schema,
+        model="deepseek-chat",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant"},
+            {"role": "user", "content": prompt},
+        ])
+
+
+@resilient("qwen")
+def query_qwen_structured(prompt, schema, model="qwen-max-latest"):
+    return structured_chat_completion(
+        get_client("qwen"), schema,
+        model=model,
+        messages=[
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': prompt}])
+
+
+@resilient("glm")
+def query_glm_structured(prompt, schema):
+    return structured_chat_completion(
+        get_client("glm"), schema,
+        model="glm-4-flash",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}],
+        top_p=0.7,
+        temperature=0.9)
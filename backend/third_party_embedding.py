@@ -1,11 +1,7 @@
-from llama_index.embeddings.dashscope import (
-    DashScopeEmbedding,
-    DashScopeTextEmbeddingModels,
-    DashScopeTextEmbeddingType,
-)
 import yaml
 import os
 import emoji
+from functools import lru_cache
 from typing import Any, List
 from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.embeddings import BaseEmbedding
@@ -22,10 +18,18 @@ os.environ["DASHSCOPE_API_KEY"] = QWEN_API_KEY
 GLM_API_KEY = global_config.get("backend").get("glm_api_key")
 os.environ["ZHIPU_API_KEY"] = GLM_API_KEY
 
-dashscope_embedder = DashScopeEmbedding(
-    model_name=DashScopeTextEmbeddingModels.TEXT_EMBEDDING_V2,
-    text_type=DashScopeTextEmbeddingType.TEXT_TYPE_DOCUMENT,
-)
+
+@lru_cache(maxsize=None)
+def get_dashscope_embedder():
+    from llama_index.embeddings.dashscope import (
+        DashScopeEmbedding,
+        DashScopeTextEmbeddingModels,
+        DashScopeTextEmbeddingType,
+    )
+    return DashScopeEmbedding(
+        model_name=DashScopeTextEmbeddingModels.TEXT_EMBEDDING_V2,
+        text_type=DashScopeTextEmbeddingType.TEXT_TYPE_DOCUMENT,
+    )
 
 
 class ZhipuEmbeddings(BaseEmbedding):
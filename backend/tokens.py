@@ -0,0 +1,146 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import yaml
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+DEFAULT_ENCODING = "cl100k_base"
+# tokens reserved for the role/separator overhead of each chat message
+GAP_BETWEEN_SEND_RECEIVE = 15
+
+CONTEXT_LIMITS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k-0613": 16384,
+    "gpt-4": 8192,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4-turbo": 128000,
+    "claude-3-sonnet-20240229": 200000,
+    "gpt-4o-mini": 128000,
+}
+CONTEXT_LIMITS.update(global_config.get("backend").get("context_limits") or {})
+DEFAULT_CONTEXT_LIMIT = global_config.get("backend").get("default_context_limit", 8192)
+
+MAX_COMPLETION_TOKENS = {
+    "gpt-4-0125-preview": 4096,
+    "gpt-4-turbo": 4096,
+    "gpt-4o-mini": 4096,
+}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """process-wide tiktoken encoder of a model, unknown models fall back to cl100k_base"""
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text, model="gpt-3.5-turbo") -> int:
+    """count tokens of a text, see count_prompt_tokens for prompts which mostly repeat earlier ones"""
+    if not text:
+        return 0
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+class LineTokenCounter():
+    """token count of prompts, line by line with a bounded LRU memo of the lines
+
+    consecutive prompts share most of their lines (prompt templates, communication history,
+    retrieved chats), so only the lines not seen recently are encoded. Lines are counted apart
+    and joined by one token each, a little above the count of the prompt encoded at once.
+    """
+
+    def __init__(self, model="gpt-3.5-turbo", max_lines=8192) -> None:
+        self.model = model
+        self.max_lines = max_lines
+        self.lines = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count_line(self, line) -> int:
+        if not line:
+            return 0
+        with self.lock:
+            tokens = self.lines.get(line)
+            if tokens is not None:
+                self.lines.move_to_end(line)
+                return tokens
+        tokens = count_tokens(line, self.model)
+        with self.lock:
+            self.lines[line] = tokens
+            while len(self.lines) > self.max_lines:
+                self.lines.popitem(last=False)
+        return tokens
+
+    def count(self, text) -> int:
+        if not text:
+            return 0
+        lines = text.split("\n")
+        return sum(self.count_line(line) for line in lines) + len(lines) - 1
+
+
+_line_token_counters = {}
+_line_token_counters_lock = threading.Lock()
+
+
+def count_prompt_tokens(text, model="gpt-3.5-turbo") -> int:
+    """count tokens of a prompt with the process-wide LineTokenCounter of the model"""
+    counter = _line_token_counters.get(model)
+    if counter is None:
+        with _line_token_counters_lock:
+            counter = _line_token_counters.setdefault(model, LineTokenCounter(model))
+    return counter.count(text)
+
+
+def get_context_limit(model) -> int:
+    return CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+
+
+def count_message_tokens(messages, model) -> int:
+    """tokens of a chat message list, only the lines not in recent prompts are encoded"""
+    num_prompt_tokens = sum(count_prompt_tokens(message["content"], model) for message in messages)
+    num_prompt_tokens += max(len(messages) - 1, 0)  # the "\n" joining messages
+    num_prompt_tokens += GAP_BETWEEN_SEND_RECEIVE * len(messages)
+    return num_prompt_tokens
+
+
+def calc_max_token(messages, model) -> int:
+    """completion token budget left after the prompt in the model's context window"""
+    num_max_completion_tokens = get_context_limit(model) - count_message_tokens(messages, model)
+    if model in MAX_COMPLETION_TOKENS:
+        num_max_completion_tokens = min(num_max_completion_tokens, MAX_COMPLETION_TOKENS[model])
+    return num_max_completion_tokens
+
+
+class IncrementalTokenCounter():
+    """token count of an append-only list of texts (e.g. communication history)
+
+    only the entries appended since the last call are encoded,
+    the count restarts if the list was shortened or replaced.
+    """
+
+    def __init__(self, model="gpt-3.5-turbo") -> None:
+        self.model = model
+        self.counted_entries = 0
+        self.total_tokens = 0
+        self.last_entry = None
+
+    def count(self, entries) -> int:
+        if len(entries) < self.counted_entries or \
+                (self.counted_entries and entries[self.counted_entries - 1] is not self.last_entry):
+            self.counted_entries = 0
+            self.total_tokens = 0
+        for entry in entries[self.counted_entries:]:
+            # entries are joined with "\n" when rendered into prompts
+            self.total_tokens += count_tokens(entry, self.model) + 1
+        self.counted_entries = len(entries)
+        self.last_entry = entries[-1] if entries else None
+        return self.total_tokens
@@ -1,15 +1,18 @@
+import asyncio
 import json
 import os
 import re
 from abc import ABC, abstractmethod
 import yaml
 
-from backend.gemini import query_gemini
-from backend.gpt import query_claude, query_gpt, query_gpt4
-from backend.third_party import *
-from iagents.tool import FaissTool, JsonFormatTool, MindFillTool, SqlTool
+from backend.registry import get_provider
+from backend.tokens import count_prompt_tokens, get_context_limit
+from iagents.tool import MindFillTool
 from iagents.util import iAgentsLogger
-from iagents.llamaindex import LlamaIndexer
+from iagents.packer import get_context_packer
+from iagents.prompt import render_full_history, render_history
+from iagents.resources import get_resources
+from iagents.retrieval import get_retrieval_executor
 
 # Load global config
 file_path = os.path.dirname(__file__)
@@ -23,6 +26,11 @@ except FileNotFoundError:
 except yaml.YAMLError as exc:
     raise yaml.YAMLError(f"Error in configuration file: {exc}")
 
+def render_memory_message(message) -> str:
+    """render a (id, timestamp, sender, receiver, message) row of the distinct memory as it appears in the prompt"""
+    return f"from {message[2]} to {message[3]}: {message[4]}\n"
+
+
 class Agent(ABC):
     """The Base class for Agent.
     It defines the backend LLM of agent and how to assemble the prompt of agents.    
@@ -42,74 +50,107 @@ class Agent(ABC):
         self.task = task
         self.agent_chat_history = []
         self.backend = backend
-        self.query_func = self._get_query_func(backend)
+        self.model = get_provider(backend).model
         self.is_assistant = is_assistant
 
-        prompt_path = os.path.join(project_path, "prompts")
-        system_prompt_filepath = os.path.join(prompt_path, "assistant_system_prompt.json" if is_assistant else "instructor_system_prompt.json")
-        with open(system_prompt_filepath, "r") as f:
-            self.system_prompt = json.load(f)
+        # prompts, query functions and stateless tools are shared process-wide, see iagents/resources.py
+        resources = get_resources()
+        self.query_func, self.aquery_func = resources.get_query_funcs(backend)
+        self.system_prompt_filename = "assistant_system_prompt.json" if is_assistant else "instructor_system_prompt.json"
+        self.sql_tool = resources.get_sql_tool()
+        self.json_tool = resources.get_json_tool(backend)
+        self.mindfill_tool = MindFillTool(self.query_func, json_tool=self.json_tool)
 
-        with open(os.path.join(project_path, "prompts", "tool_prompt.json"), "r") as f:
-            self.tool_prompt = json.load(f)
+        # background retrieval started by prefetch, keyed by stage name
+        self.prefetched = {}
+        self.prefetch_key = None
 
-        self.sql_tool = SqlTool()
-        self.json_tool = JsonFormatTool(self.query_func)
-        self.mindfill_tool = MindFillTool(self.query_func)
+    @property
+    def system_templates(self):
+        return get_resources().get_prompt_templates(self.system_prompt_filename)
 
-    def _get_query_func(self, backend: str):
-        """Get the query function based on the backend LLM.
+    @property
+    def tool_templates(self):
+        return get_resources().get_prompt_templates("tool_prompt.json")
+
+    def set_master(self, master: str) -> None:
+        """Set the master of the agent.
 
         Args:
-            backend (str): Name of the backend LLM.
+            master (str): Name of the human master of agent.
+        """
+        self.master = master
+
+    def get_init_params(self) -> dict:
+        """The constructor arguments of the agent, the agent factory builds and pools agents by them.
 
         Returns:
-            function: Query function for the specified backend.
-
-        Raises:
-            ValueError: If the backend is not implemented.
-        """
-        if backend == "gemini":
-            return query_gemini
-        elif backend == "gpt":
-            return query_gpt
-        elif backend == "gpt4":
-            return query_gpt4
-        elif backend == "claude":
-            return query_claude
-        elif backend == "ollama":
-            from backend.ollama import query_ollama
-            return query_ollama
-        elif backend == "deepseek":
-            return query_deepseek
-        elif backend == "qwen":
-            return query_qwen
-        elif backend == "ernie":
-            return query_ernie
-        elif backend == "glm":
-            return query_glm
-        elif backend == "hunyuan":
-            return query_hunyuan
-        elif backend == "spark":
-            return query_spark
-        else:
-            raise ValueError(f"{backend} backend not implemented")
+            dict: keyword arguments of __init__
+        """
+        return {"master": self.master, "backend": self.backend, "task": self.task, "is_assistant": self.is_assistant}
 
-    def set_master(self, master: str) -> None:
-        """Set the master of the agent.
+    def reset(self, master: str, task: str) -> None:
+        """Clear the per-conversation state, so that a pooled agent can serve a new conversation.
 
         Args:
             master (str): Name of the human master of agent.
+            task (str): Task prompt.
         """
-        self.master = master
+        self.set_master(master)
+        self.task = task
+        self.agent_chat_history = []
+        self.mindfill_tool.set_state({})
+        self.prefetched = {}
+        self.prefetch_key = None
+
+    def get_state(self) -> dict:
+        """the per-conversation state of the agent as a JSON serializable dict, for communication checkpoints
+
+        Returns:
+            dict: the state, restored by set_state
+        """
+        return {"master": self.master,
+                "task": self.task,
+                "agent_chat_history": list(self.agent_chat_history),
+                "mindfill": self.mindfill_tool.get_state()}
+
+    def set_state(self, state: dict) -> None:
+        """restore the state saved by get_state
+
+        Args:
+            state (dict): the saved state
+        """
+        self.set_master(state["master"])
+        self.task = state["task"]
+        self.agent_chat_history = list(state.get("agent_chat_history", []))
+        self.mindfill_tool.set_state(state.get("mindfill", {}))
+
+    def count_prompt_tokens(self, prompt: str) -> int:
+        """Count the tokens of a prompt with the tokenizer of the backend model.
+
+        Args:
+            prompt (str): Prompt to be sent to the backend LLM.
+
+        Returns:
+            int: Number of prompt tokens.
+        """
+        return count_prompt_tokens(prompt, self.model)
+
+    def get_context_limit(self) -> int:
+        """Get the context window of the backend model, configured in backend.context_limits.
+
+        Returns:
+            int: Max number of tokens in the context window.
+        """
+        return get_context_limit(self.model)
 
     @abstractmethod
-    def get_other_chat_history(self, receiver: str, communication_history: list[str] = None) -> str:
+    def get_other_chat_history(self, receiver: str, agent_communication: str = None) -> str:
         """Get the context from chatting with other friends.
 
         Args:
             receiver (str): The name of user in current chatting.
-            communication_history (list[str], optional): The chat history between two agents. Defaults to None.
+            agent_communication (str, optional): The rendered chat history between two agents, a snapshot taken before the stages start. Defaults to None.
 
         Returns:
             str: Retrieved chat history as the context for assembling the query prompt.
@@ -117,18 +158,127 @@ class Agent(ABC):
         pass
 
     @abstractmethod
-    def get_current_chat_history(self, receiver: str, communication_history: list[str]) -> str:
+    def get_current_chat_history(self, receiver: str, agent_communication: str) -> str:
         """Get the context from current chatting.
 
         Args:
             receiver (str): The name of user in current chatting.
-            communication_history (list[str]): The chat history between two agents.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
 
         Returns:
             str: Retrieved chat history as the context for assembling the query prompt.
         """
         pass
 
+    def get_current_chat_history_stages(self, receiver: str, agent_communication: str) -> list:
+        """Split the retrieval of the current chat history into independent stages.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
+
+        Returns:
+            list[tuple[str, callable]]: (stage name, stage function), the joined stage results form the context.
+        """
+        return [("current_chat_history", lambda: self.use_prefetched(
+            "current_chat_history", receiver, lambda: self.get_current_chat_history(receiver, agent_communication)))]
+
+    def get_other_chat_history_stages(self, receiver: str, agent_communication: str) -> list:
+        """Split the retrieval of the chat history with other friends into independent stages.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
+
+        Returns:
+            list[tuple[str, callable]]: (stage name, stage function), the joined stage results form the context.
+        """
+        return [("other_chat_history", lambda: self.use_prefetched(
+            "other_chat_history", receiver, lambda: self.get_other_chat_history(receiver, agent_communication)))]
+
+    def get_prefetch_stages(self, receiver: str) -> list:
+        """Retrieval stages which only depend on the master, the receiver and the task, so they can start before the first turn.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+
+        Returns:
+            list[tuple[str, callable]]: (stage name, stage function)
+        """
+        return [("agent_profile_prompt", lambda: self.sql_tool.get_agent_profile_prompt(self.master))]
+
+    def prefetch(self, receiver: str) -> None:
+        """Start the prefetch stages in the background, their results are used by the first turn with the receiver.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+        """
+        executor = get_retrieval_executor()
+        self.prefetch_key = (self.master, receiver)
+        self.prefetched = {name: executor.submit(name, func) for name, func in self.get_prefetch_stages(receiver)}
+
+    def use_prefetched(self, name: str, receiver: str, func):
+        """Take the prefetched result of a stage, or run the stage if it was not prefetched (each result is used once).
+
+        Args:
+            name (str): Stage name.
+            receiver (str): The name of user in current chatting.
+            func (callable): The stage function.
+
+        Returns:
+            The stage result.
+        """
+        if self.prefetch_key == (self.master, receiver):
+            future = self.prefetched.pop(name, None)
+            if future is not None:
+                return future.result()
+        return func()
+
+    def render_agent_communication(self, communication_history: list[str]) -> str:
+        """Render the agents' communication with the known facts once, in the calling thread.
+
+        The retrieval stages run on other threads while fill_mind updates the known facts,
+        they get this snapshot so that their prompts do not depend on thread timing.
+
+        Args:
+            communication_history (list[str]): The chat history between two agents.
+
+        Returns:
+            str: The rendered chat history.
+        """
+        return render_history(communication_history, self.mindfill_tool.get_known_facts())
+
+    def start_retrieval(self, receiver: str, communication_history: list[str]) -> tuple[list, list]:
+        """Start all retrieval stages in the background, so that they overlap with other work (e.g. InfoNav LLM calls).
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            communication_history (list[str]): The chat history between two agents.
+
+        Returns:
+            tuple[list[Future], list[Future]]: Futures of the current chat history stages and of the other chat history stages.
+        """
+        executor = get_retrieval_executor()
+        agent_communication = self.render_agent_communication(communication_history)
+        return (executor.start(self.get_current_chat_history_stages(receiver, agent_communication)),
+                executor.start(self.get_other_chat_history_stages(receiver, agent_communication)))
+
+    def retrieve_chat_history(self, receiver: str, communication_history: list[str]) -> tuple[str, str]:
+        """Run all retrieval stages concurrently, the latency is the slowest stage instead of the sum.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            communication_history (list[str]): The chat history between two agents.
+
+        Returns:
+            tuple[str, str]: The current chat history and the chat history with other friends.
+        """
+        agent_communication = self.render_agent_communication(communication_history)
+        current_stages = self.get_current_chat_history_stages(receiver, agent_communication)
+        other_stages = self.get_other_chat_history_stages(receiver, agent_communication)
+        results = get_retrieval_executor().run(current_stages + other_stages)
+        return "".join(results[:len(current_stages)]), "".join(results[len(current_stages):])
+
     def assemble_prompt(self, receiver: str, communication_history: list[str]) -> str:
         """Assemble the query prompt.
 
@@ -139,17 +289,17 @@ class Agent(ABC):
         Returns:
             str: Assembled prompt.
         """
-        current_chat_history = self.get_current_chat_history(receiver, communication_history)
-        other_chat_history = self.get_other_chat_history(receiver, communication_history)
-        agent_profile_prompt = self.sql_tool.get_agent_profile_prompt(self.master)
+        current_chat_history, other_chat_history = self.retrieve_chat_history(receiver, communication_history)
+        agent_profile_prompt = self.use_prefetched("agent_profile_prompt", receiver,
+                                                   lambda: self.sql_tool.get_agent_profile_prompt(self.master))
 
         system_prompt = "\n".join([
             agent_profile_prompt,
-            "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
-            "\n".join(self.system_prompt['chat_history']).format(master=self.master, contact=receiver, current_chat_history=current_chat_history, other_chat_history=other_chat_history),
-            "\n".join(self.system_prompt['task']).format(contact=receiver, task=self.task),
-            "\n".join(self.system_prompt['agent_chat_history']).format(contact=receiver, agent_chat_history="\n".join(communication_history), master=self.master),
-            "\n".join(self.system_prompt['return_format']),
+            self.system_templates['role'].format(master=self.master, contact=receiver),
+            self.system_templates['chat_history'].format(master=self.master, contact=receiver, current_chat_history=current_chat_history, other_chat_history=other_chat_history),
+            self.system_templates['task'].format(contact=receiver, task=self.task),
+            self.system_templates['agent_chat_history'].format(contact=receiver, agent_chat_history=render_history(communication_history, self.mindfill_tool.get_known_facts()), master=self.master),
+            self.system_templates['return_format'].text,
         ])
 
         return system_prompt
@@ -165,7 +315,7 @@ class Agent(ABC):
             str: LLM response.
         """
         query_str = self.assemble_prompt(receiver, communication_history)
-        response = self.query_func(query_str)
+        response = self.query_func(query_str, call_site="action")
         iAgentsLogger.log(query_str, response, f"Query to generate message from {self.master} to {receiver}")
         return response
 
@@ -184,17 +334,82 @@ class Agent(ABC):
         iAgentsLogger.log(instruction=f"response generated from {self.master} to {receiver}\nthe reformatted message:\n{response}")
         return response
 
-    def conclusion(self, communication_history: list[str]) -> str:
+    async def _aquery(self, receiver: str, communication_history: list[str]) -> str:
+        """Async version of _query. Prompt assembling involves blocking SQL calls, so it runs in a worker thread.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            communication_history (list[str]): The chat history between two agents.
+
+        Returns:
+            str: LLM response.
+        """
+        query_str = await asyncio.to_thread(self.assemble_prompt, receiver, communication_history)
+        response = await self.aquery_func(query_str, call_site="action")
+        iAgentsLogger.log(query_str, response, f"Query to generate message from {self.master} to {receiver}")
+        return response
+
+    async def aquery(self, receiver: str, communication_history: list[str]) -> str:
+        """Async version of query.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            communication_history (list[str]): The chat history between two agents.
+
+        Returns:
+            str: LLM response in JSON string.
+        """
+        raw_response = await self._aquery(receiver, communication_history)
+        response = raw_response
+        iAgentsLogger.log(instruction=f"response generated from {self.master} to {receiver}\nthe reformatted message:\n{response}")
+        return response
+
+    def stream_query(self, query_str: str, call_site: str, on_chunk) -> str:
+        """Query the backend LLM in streaming mode.
+
+        Args:
+            query_str (str): The prompt.
+            call_site (str): Name of the caller, used by the LLM cache.
+            on_chunk (callable): Called with every text chunk as soon as it arrives.
+
+        Returns:
+            str: The full response.
+        """
+        chunks = []
+        for chunk in self.query_func.stream(query_str, call_site=call_site):
+            chunks.append(chunk)
+            on_chunk(chunk)
+        return "".join(chunks)
+
+    def conclusion(self, communication_history: list[str], on_chunk=None) -> str:
         """Summarize the agents' communication and give the final answer to the task.
 
+        Args:
+            communication_history (list[str]): The chat history between two agents.
+            on_chunk (callable, optional): Stream the conclusion and call it with every text chunk. Defaults to None.
+
+        Returns:
+            str: Final answer to the task.
+        """
+        query_str = self.tool_templates['conclusion'].format(agent_communication=render_full_history(communication_history), task=self.task)
+        if on_chunk is not None:
+            response = self.stream_query(query_str, "conclusion", on_chunk)
+        else:
+            response = self.query_func(query_str, call_site="conclusion")
+        iAgentsLogger.log(query_str, response, "[Conclusion]")
+        return response
+
+    async def aconclusion(self, communication_history: list[str]) -> str:
+        """Async version of conclusion.
+
         Args:
             communication_history (list[str]): The chat history between two agents.
 
         Returns:
             str: Final answer to the task.
         """
-        query_str = "\n".join(self.tool_prompt['conclusion']).format(agent_communication="\n".join(communication_history), task=self.task)
-        response = self.query_func(query_str)
+        query_str = self.tool_templates['conclusion'].format(agent_communication=render_full_history(communication_history), task=self.task)
+        response = await self.aquery_func(query_str, call_site="conclusion")
         iAgentsLogger.log(query_str, response, "[Conclusion]")
         return response
 
@@ -214,14 +429,21 @@ class Agent(ABC):
 class VanillaAgent(Agent):
     """VanillaAgent uses SQL tool to get context."""
 
-    def get_other_chat_history(self, receiver: str, communication_history: list[str] = None) -> str:
+    def get_prefetch_stages(self, receiver: str) -> list:
+        # the SQL chat histories do not depend on the agents' communication, all of them can be prefetched
+        return super().get_prefetch_stages(receiver) + [
+            ("current_chat_history", lambda: self.get_current_chat_history(receiver, None)),
+            ("other_chat_history", lambda: self.get_other_chat_history(receiver, None)),
+        ]
+
+    def get_other_chat_history(self, receiver: str, agent_communication: str = None) -> str:
         result_str = "\n"
         sql_execute_results = self.sql_tool.get_other_chat_history(self.master, receiver)
         for message in sql_execute_results:
             result_str += f"from {message[1]} to {message[2]}: {message[3]}\n"
         return result_str
 
-    def get_current_chat_history(self, receiver: str, communication_history: list[str]) -> str:
+    def get_current_chat_history(self, receiver: str, agent_communication: str) -> str:
         result_str = "\n"
         sql_execute_results = self.sql_tool.get_current_chat_history(self.master, receiver)
         for message in sql_execute_results:
@@ -237,6 +459,22 @@ class ThinkAgent(VanillaAgent):
         self.infonav_plan = None
         self.infonav_status = 0  # 0 for init plan; 1 for mark the unknown rationales in the plan; 2 for update the unknown rationales to known rationales
 
+    def reset(self, master: str, task: str) -> None:
+        super().reset(master, task)
+        self.infonav_plan = None
+        self.infonav_status = 0
+
+    def get_state(self) -> dict:
+        state = super().get_state()
+        state["infonav_plan"] = self.infonav_plan
+        state["infonav_status"] = self.infonav_status
+        return state
+
+    def set_state(self, state: dict) -> None:
+        super().set_state(state)
+        self.infonav_plan = state.get("infonav_plan")
+        self.infonav_status = state.get("infonav_status", 0)
+
     def assemble_prompt_think(self, receiver: str, communication_history: list[str]) -> str:
         """InfoNav assembles the prompt for initializing/updating the plan.
 
@@ -248,41 +486,43 @@ class ThinkAgent(VanillaAgent):
             str: Assembled query prompt.
         """
         if self.infonav_status == 0:
-            prompt_infonav = "\n".join(self.tool_prompt['infonav_init'])
+            prompt_infonav = self.tool_templates['infonav_init'].text
             system_prompt = "\n".join([
-                "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
-                "\n".join(self.system_prompt['task']).format(contact=receiver, task=self.task), prompt_infonav
+                self.system_templates['role'].format(master=self.master, contact=receiver),
+                self.system_templates['task'].format(contact=receiver, task=self.task), prompt_infonav
             ])
             self.infonav_status += 1
         elif self.infonav_status == 1:
-            prompt_infonav = "\n".join(self.tool_prompt['infonav_mark'])
+            prompt_infonav = self.tool_templates['infonav_mark']
             system_prompt = "\n".join([
-                "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
+                self.system_templates['role'].format(master=self.master, contact=receiver),
                 prompt_infonav.format(task=self.task, infonav=self.infonav_plan)
             ])
             self.infonav_status += 1
         else:
-            prompt_infonav = "\n".join(self.tool_prompt['infonav_update']).format(infonav=self.infonav_plan,
+            prompt_infonav = self.tool_templates['infonav_update'].format(infonav=self.infonav_plan,
                                                                                   known_facts=self.mindfill_tool.get_known_facts(),
                                                                                   unknown_facts=self.mindfill_tool.get_unknown_facts())
             system_prompt = "\n".join([
-                "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
-                "\n".join(self.system_prompt['task']).format(contact=receiver, task=self.task),
-                "\n".join(self.system_prompt['agent_chat_history']).format(contact=receiver, 
-                                                                           agent_chat_history="\n".join(communication_history),
+                self.system_templates['role'].format(master=self.master, contact=receiver),
+                self.system_templates['task'].format(contact=receiver, task=self.task),
+                self.system_templates['agent_chat_history'].format(contact=receiver, 
+                                                                           # the known facts are already listed in the infonav_update prompt
+                                                                           agent_chat_history=render_history(communication_history),
                                                                            master=self.master), prompt_infonav])
 
         return system_prompt
 
     def assemble_prompt(self, receiver: str, communication_history: list[str], current_chat_history: str, other_chat_history: str) -> str:
-        agent_profile_prompt = self.sql_tool.get_agent_profile_prompt(self.master)
+        agent_profile_prompt = self.use_prefetched("agent_profile_prompt", receiver,
+                                                   lambda: self.sql_tool.get_agent_profile_prompt(self.master))
         system_prompt = "\n".join([
             agent_profile_prompt,
-            "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
-            "\n".join(self.system_prompt['chat_history']).format(master=self.master, contact=receiver, current_chat_history=current_chat_history, other_chat_history=other_chat_history),
-            "\n".join(self.system_prompt['task']).format(contact=receiver, task=self.task),
-            "\n".join(self.system_prompt['agent_chat_history']).format(contact=receiver, agent_chat_history="\n".join(communication_history), master=self.master),
-            "\n".join(self.system_prompt['return_format_withinfonav']).format(infonav=self.infonav_plan, unknown_facts=self.mindfill_tool.get_unknown_facts()),
+            self.system_templates['role'].format(master=self.master, contact=receiver),
+            self.system_templates['chat_history'].format(master=self.master, contact=receiver, current_chat_history=current_chat_history, other_chat_history=other_chat_history),
+            self.system_templates['task'].format(contact=receiver, task=self.task),
+            self.system_templates['agent_chat_history'].format(contact=receiver, agent_chat_history=render_history(communication_history, self.mindfill_tool.get_known_facts()), master=self.master),
+            self.system_templates['return_format_withinfonav'].format(infonav=self.infonav_plan, unknown_facts=self.mindfill_tool.get_unknown_facts()),
         ])
 
         return system_prompt
@@ -297,28 +537,67 @@ class ThinkAgent(VanillaAgent):
         Returns:
             str: LLM response.
         """
-        current_chat_history = self.get_current_chat_history(receiver, communication_history)
-        other_chat_history = self.get_other_chat_history(receiver, communication_history)
+        # retrieval runs in the background while the InfoNav plan is generated
+        current_futures, other_futures = self.start_retrieval(receiver, communication_history)
 
         if self.infonav_status < 2:
             query_think = self.assemble_prompt_think(receiver, communication_history)
-            self.infonav_plan = self.query_func(query_think)
+            self.infonav_plan = self.query_func(query_think, call_site="infonav_init")
             iAgentsLogger.log(query_think, self.infonav_plan, f"[Init infonav from {self.master} to {receiver}:]")
 
             query_think = self.assemble_prompt_think(receiver, communication_history)
-            self.infonav_plan = self.query_func(query_think)
+            self.infonav_plan = self.query_func(query_think, call_site="infonav_mark")
             iAgentsLogger.log(query_think, self.infonav_plan, f"[Mark infonav from {self.master} to {receiver}:]")
 
             self.mindfill_tool.set_unknown_facts(self.infonav_plan)
 
         else:
             query_think = self.assemble_prompt_think(receiver, communication_history)
-            updated_facts = self.query_func(query_think)
+            updated_facts = self.query_func(query_think, call_site="infonav_update")
             iAgentsLogger.log(query_think, updated_facts, f"[Updated facts from {self.master} to {receiver}:]")
             self.infonav_plan = self.mindfill_tool.fill_mind(self.infonav_plan, updated_facts)
 
+        current_chat_history = "".join(future.result() for future in current_futures)
+        other_chat_history = "".join(future.result() for future in other_futures)
         query_action = self.assemble_prompt(receiver, communication_history, current_chat_history, other_chat_history)
-        response = self.query_func(query_action)
+        response = self.query_func(query_action, call_site="action")
+        iAgentsLogger.log(query_action, response, f"[Query to generate message from {self.master} to {receiver}]")
+        return response
+
+    async def _aquery(self, receiver: str, communication_history: list[str]) -> str:
+        """Async version of _query, the LLM calls are awaited and the blocking retrieval runs in worker threads.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            communication_history (list[str]): The chat history between two agents.
+
+        Returns:
+            str: LLM response.
+        """
+        # retrieval runs in the background while the InfoNav plan is generated
+        current_futures, other_futures = self.start_retrieval(receiver, communication_history)
+
+        if self.infonav_status < 2:
+            query_think = self.assemble_prompt_think(receiver, communication_history)
+            self.infonav_plan = await self.aquery_func(query_think, call_site="infonav_init")
+            iAgentsLogger.log(query_think, self.infonav_plan, f"[Init infonav from {self.master} to {receiver}:]")
+
+            query_think = self.assemble_prompt_think(receiver, communication_history)
+            self.infonav_plan = await self.aquery_func(query_think, call_site="infonav_mark")
+            iAgentsLogger.log(query_think, self.infonav_plan, f"[Mark infonav from {self.master} to {receiver}:]")
+
+            self.mindfill_tool.set_unknown_facts(self.infonav_plan)
+
+        else:
+            query_think = self.assemble_prompt_think(receiver, communication_history)
+            updated_facts = await self.aquery_func(query_think, call_site="infonav_update")
+            iAgentsLogger.log(query_think, updated_facts, f"[Updated facts from {self.master} to {receiver}:]")
+            self.infonav_plan = await asyncio.to_thread(self.mindfill_tool.fill_mind, self.infonav_plan, updated_facts)
+
+        current_chat_history = "".join(await asyncio.gather(*map(asyncio.wrap_future, current_futures)))
+        other_chat_history = "".join(await asyncio.gather(*map(asyncio.wrap_future, other_futures)))
+        query_action = await asyncio.to_thread(self.assemble_prompt, receiver, communication_history, current_chat_history, other_chat_history)
+        response = await self.aquery_func(query_action, call_site="action")
         iAgentsLogger.log(query_action, response, f"[Query to generate message from {self.master} to {receiver}]")
         return response
 
@@ -326,6 +605,10 @@ class ThinkAgent(VanillaAgent):
 class MemoryAgent(ThinkAgent):
     """MemoryAgent inherits from ThinkAgent and has the mixed memory mechanism which reactively adjusts the query for distinct (SQL) memory retrieval and fuzzy (FAISS) memory retrieval."""
 
+    # the previous retrieval params and results which the reactive queries refine, kept in checkpoints
+    PREVIOUS_RETRIEVAL_FIELDS = ("previous_sql_result", "previous_sql_params", "previous_sql_result_cur",
+                                 "previous_sql_params_cur", "previous_faiss_params", "previous_faiss_result")
+
     def __init__(self, master: str, backend: str, task: str, is_assistant: bool = False, enable_distinct_memory: bool = True, enable_fuzzy_memory: bool = False, memory_name: str = "") -> None:
         super().__init__(master, backend, task, is_assistant)
 
@@ -344,15 +627,20 @@ class MemoryAgent(ThinkAgent):
         self.memory_name = memory_name
         assert self.enable_distinct_memory or self.enable_fuzzy_memory, "For MemoryAgent, either distinct memory or fuzzy memory should be enabled"
         self.memory_file_path = os.path.join(project_path, "memory", self.memory_name, master + ".tsv")
-        self.faiss_tool = FaissTool(self.memory_file_path)
-        self.stopwords = set()
-        with open(os.path.join(project_path, "iagents", "stopwords.txt"), "r") as f:
-            for line in f:
-                self.stopwords.add(line.strip())
-        
-        # load llama indexer for RAG
-        self.llamaindexer = LlamaIndexer(self.master)
 
+    @property
+    def faiss_tool(self):
+        # one FaissTool per memory file, rebuilt when the file changes
+        return get_resources().get_faiss_tool(self.memory_file_path)
+
+    @property
+    def stopwords(self):
+        return get_resources().get_stopwords()
+
+    @property
+    def llamaindexer(self):
+        # llama indexer for RAG, one per user and built on first use
+        return get_resources().get_llamaindexer(self.master)
 
     def set_master(self, master: str) -> None:
         """Set the master of the agent.
@@ -362,14 +650,36 @@ class MemoryAgent(ThinkAgent):
         """
         self.master = master
         self.memory_file_path = os.path.join(project_path, "memory", self.memory_name, master + ".tsv")
-        self.faiss_tool = FaissTool(self.memory_file_path)
 
-    def get_current_chat_history(self, receiver: str, communication_history: list[str]) -> str:
+    def get_init_params(self) -> dict:
+        params = super().get_init_params()
+        params.update(enable_distinct_memory=self.enable_distinct_memory,
+                      enable_fuzzy_memory=self.enable_fuzzy_memory,
+                      memory_name=self.memory_name)
+        return params
+
+    def reset(self, master: str, task: str) -> None:
+        super().reset(master, task)
+        for name in self.PREVIOUS_RETRIEVAL_FIELDS:
+            setattr(self, name, "None")
+
+    def get_state(self) -> dict:
+        state = super().get_state()
+        state["previous"] = {name: getattr(self, name) for name in self.PREVIOUS_RETRIEVAL_FIELDS}
+        return state
+
+    def set_state(self, state: dict) -> None:
+        super().set_state(state)
+        for name, value in state.get("previous", {}).items():
+            if name in self.PREVIOUS_RETRIEVAL_FIELDS:
+                setattr(self, name, value)
+
+    def get_current_chat_history(self, receiver: str, agent_communication: str) -> str:
         """Get the context from current chatting.
 
         Args:
             receiver (str): The name of user in current chatting.
-            communication_history (list[str]): The chat history between two agents.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
 
         Returns:
             str: Retrieved chat history as the context for assembling the query prompt.
@@ -380,31 +690,28 @@ class MemoryAgent(ThinkAgent):
         if self.enable_distinct_memory:
             response_json_format = {"keyword": "ring/alice/steal", "window": 3, "limit": 10}
             system_prompt = "\n".join([
-                "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
-                "\n".join(self.system_prompt['task']).format(contact=receiver, task=self.task)
+                self.system_templates['role'].format(master=self.master, contact=receiver),
+                self.system_templates['task'].format(contact=receiver, task=self.task)
             ])
-            query_prompt = system_prompt + "\n".join(self.tool_prompt['sql_react']).format(condition="current session (between {} and {})".format(self.master, receiver),
+            query_prompt = system_prompt + self.tool_templates['sql_react'].format(condition="current session (between {} and {})".format(self.master, receiver),
                                                                                            example_json=str(response_json_format),
                                                                                            previous_params=self.previous_sql_params_cur,
                                                                                            previous_sql_result=self.previous_sql_result_cur,
-                                                                                           agent_communication="\n".join(communication_history))
-            response = self.query_func(query_prompt)
+                                                                                           agent_communication=agent_communication)
+            response, response_json = self.json_tool.json_query(query_prompt, response_json_format, call_site="sql_react")
             iAgentsLogger.log(query_prompt, response, "[generate sql query by {}:]".format(self.master))
-            response_json = self.json_tool.json_reformat(response, response_json_format)
-            response_json = eval(response_json)
             sql_keywords = set(re.split("/| |'|\"", response_json['keyword'].lower())) - self.stopwords
             iAgentsLogger.log(instruction="[SQL Keywords Set:] {}".format(str(sql_keywords)))
-            distinct_memories = []
-            for keyword in sql_keywords:
-                sql_execute_results = self.sql_tool.get_context_bykeyword_current(keyword=keyword, 
-                                                                                  sender=self.master, 
-                                                                                  receiver=receiver, 
-                                                                                  limit=response_json['limit'], 
-                                                                                  window=response_json['window'])
-                distinct_memories += sql_execute_results
-            # TODO: Total Messages Limit
-            for message in distinct_memories[:30]:
-                result_str += f"from {message[2]} to {message[3]}: {message[4]}\n"
+            contexts, scores = self.sql_tool.get_context_bykeywords(sql_keywords,
+                                                                    sender=self.master,
+                                                                    receiver=receiver,
+                                                                    limit=response_json['limit'],
+                                                                    window=response_json['window'],
+                                                                    current=True)
+            distinct_memories = get_context_packer(self.model).pack_messages("current_memory", contexts, scores,
+                                                                              render_memory_message)
+            for message in distinct_memories:
+                result_str += render_memory_message(message)
             self.previous_sql_result_cur = result_str
             self.previous_sql_params_cur = str(response_json)
             iAgentsLogger.log(
@@ -412,84 +719,132 @@ class MemoryAgent(ThinkAgent):
 
         return result_str
 
-    def get_other_chat_history(self, receiver: str, communication_history: list[str]) -> str:
+    def get_prefetch_stages(self, receiver: str) -> list:
+        # the distinct and fuzzy memories are driven by LLM calls over the communication, only the profile and LlamaIndex can be prefetched
+        stages = Agent.get_prefetch_stages(self, receiver)
+        if global_config.get("agent").get("use_llamaindex"):
+            stages.append(("llamaindex_query", lambda: self.llamaindexer.query(self.task)))
+        return stages
+
+    def get_other_chat_history_stages(self, receiver: str, agent_communication: str) -> list:
+        """The distinct (SQL), fuzzy (FAISS) and LlamaIndex memories are independent retrieval stages.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
+
+        Returns:
+            list[tuple[str, callable]]: (stage name, stage function) of the enabled memories.
+        """
+        stages = []
+        if self.enable_distinct_memory:
+            stages.append(("distinct_memory", lambda: self.get_distinct_memory(receiver, agent_communication)))
+        if self.enable_fuzzy_memory:
+            stages.append(("fuzzy_memory", lambda: self.get_fuzzy_memory(receiver, agent_communication)))
+        if global_config.get("agent").get("use_llamaindex"):
+            stages.append(("llamaindex_memory", lambda: self.get_llamaindex_memory(receiver)))
+        return stages
+
+    def get_other_chat_history(self, receiver: str, agent_communication: str) -> str:
         """Get the context from chatting with other friends.
 
         Args:
             receiver (str): The name of user in current chatting.
-            communication_history (list[str]): The chat history between two agents.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
 
         Returns:
             str: Retrieved chat history as the context for assembling the query prompt.
         """
-        result_str = ""
+        return "".join(get_retrieval_executor().run(self.get_other_chat_history_stages(receiver, agent_communication)))
 
-        # add distinct memory
-        if self.enable_distinct_memory:
-            result_str += "<context messages related to task starts>\n"
-            response_json_format = {"keyword": "ring/alice/steal", "window": 3, "limit": 10}
-            system_prompt = "\n".join([
-                "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
-                "\n".join(self.system_prompt['task']).format(contact=receiver, task=self.task)
-            ])
-            query_prompt = system_prompt + "\n".join(self.tool_prompt['sql_react']).format(condition="sessions among {} and {}'s other friends (except {})".format(self.master, self.master, receiver),
-                                                                                           example_json=str(response_json_format),
-                                                                                           previous_params=self.previous_sql_params,
-                                                                                           previous_sql_result=self.previous_sql_result,
-                                                                                           agent_communication="\n".join(communication_history))
-            response = self.query_func(query_prompt)
-            iAgentsLogger.log(query_prompt, response, "[sql query prompt to {}:]".format(self.master))
-            response_json = self.json_tool.json_reformat(response, response_json_format)
-            response_json = eval(response_json)
-            sql_keywords = set(re.split("/| |'|\"", response_json['keyword'].lower())) - self.stopwords
-            iAgentsLogger.log(instruction="[SQL Keywords Set:] {}".format(str(sql_keywords)))
-            distinct_memories = []
-            for keyword in sql_keywords:
-                sql_execute_results = self.sql_tool.get_context_bykeyword(keyword, self.master, receiver,
-                                                                          response_json['limit'],
-                                                                          response_json['window'])
-                distinct_memories += sql_execute_results
-            # TODO: Total Max Limit
-            for message in distinct_memories[:30]:
-                result_str += f"from {message[2]} to {message[3]}: {message[4]}\n"
-            result_str += "\n<context messages related to task ends>\n"
-            self.previous_sql_result = result_str
-            self.previous_sql_params = str(response_json)
-            iAgentsLogger.log(
-                instruction="[Distinct Memory Retrieved results of {}:] \n{}".format(self.master, result_str))
+    def get_distinct_memory(self, receiver: str, agent_communication: str) -> str:
+        """Retrieve messages with other friends by the keywords the LLM chose for the SQL query.
 
-        # add fuzzy memory
-        if self.enable_fuzzy_memory:
-            result_str += "<context summary related to task starts>\n"
-            response_json_format = {"query": "{}".format(self.task), "topk": 3}
-            system_prompt = "\n".join([
-                "\n".join(self.system_prompt['role']).format(master=self.master, contact=receiver),
-                "\n".join(self.system_prompt['task']).format(contact=receiver, task=self.task)
-            ])
-            query_prompt = system_prompt + "\n".join(self.tool_prompt['faiss_react']).format(example_json=str(response_json_format),
-                                                                                             task=self.task,
-                                                                                             previous_params=self.previous_faiss_params,
-                                                                                             previous_faiss_result=self.previous_faiss_result,
-                                                                                             agent_communication="\n".join(communication_history))
-            response = self.query_func(query_prompt)
-            iAgentsLogger.log(query_prompt, response, "[faiss query prompt to {}:]".format(self.master))
-            response_json = self.json_tool.json_reformat(response, response_json_format)
-            response_json = eval(response_json)
-            query = response_json['query']
-            topk = response_json['topk']
-            ret_dis, ret_indices, ret_text = self.faiss_tool.query(query, topk)
-            result_str += "\n\n{}".format("\n".join(ret_text))
-            result_str += "\n<context summary related to task ends>\n"
-            iAgentsLogger.log(instruction="[Fuzzy Memory Retrieved results of {}:] \n{}".format(self.master, "\n".join(ret_text)))
-            self.previous_faiss_params = str(response_json)
-            self.previous_faiss_result = "\n".join(ret_text)
-        
-        # add llamaindex for memory
-        if global_config.get("agent").get("use_llamaindex"):
-            response = self.llamaindexer.query(self.task)
-            result_str += "<file information related to task starts>\n"
-            result_str += "\n{}".format(response)
-            result_str += "\n<file information related to task ends>\n"
-            iAgentsLogger.log(instruction="[Llama Index Memory Retrieved results of {}:] \n{}".format(self.master, response))
+        Args:
+            receiver (str): The name of user in current chatting.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
+
+        Returns:
+            str: Retrieved messages.
+        """
+        result_str = "<context messages related to task starts>\n"
+        response_json_format = {"keyword": "ring/alice/steal", "window": 3, "limit": 10}
+        system_prompt = "\n".join([
+            self.system_templates['role'].format(master=self.master, contact=receiver),
+            self.system_templates['task'].format(contact=receiver, task=self.task)
+        ])
+        query_prompt = system_prompt + self.tool_templates['sql_react'].format(condition="sessions among {} and {}'s other friends (except {})".format(self.master, self.master, receiver),
+                                                                                       example_json=str(response_json_format),
+                                                                                       previous_params=self.previous_sql_params,
+                                                                                       previous_sql_result=self.previous_sql_result,
+                                                                                       agent_communication=agent_communication)
+        response, response_json = self.json_tool.json_query(query_prompt, response_json_format, call_site="sql_react")
+        iAgentsLogger.log(query_prompt, response, "[sql query prompt to {}:]".format(self.master))
+        sql_keywords = set(re.split("/| |'|\"", response_json['keyword'].lower())) - self.stopwords
+        iAgentsLogger.log(instruction="[SQL Keywords Set:] {}".format(str(sql_keywords)))
+        contexts, scores = self.sql_tool.get_context_bykeywords(sql_keywords, self.master, receiver,
+                                                                response_json['limit'],
+                                                                response_json['window'])
+        distinct_memories = get_context_packer(self.model).pack_messages("distinct_memory", contexts, scores,
+                                                                          render_memory_message)
+        for message in distinct_memories:
+            result_str += render_memory_message(message)
+        result_str += "\n<context messages related to task ends>\n"
+        self.previous_sql_result = result_str
+        self.previous_sql_params = str(response_json)
+        iAgentsLogger.log(
+            instruction="[Distinct Memory Retrieved results of {}:] \n{}".format(self.master, result_str))
+
+        return result_str
+
+    def get_fuzzy_memory(self, receiver: str, agent_communication: str) -> str:
+        """Retrieve memory summaries from FAISS by the query the LLM wrote.
 
-        return result_str
\ No newline at end of file
+        Args:
+            receiver (str): The name of user in current chatting.
+            agent_communication (str): The rendered chat history between two agents, a snapshot taken before the stages start.
+
+        Returns:
+            str: Retrieved summaries.
+        """
+        result_str = "<context summary related to task starts>\n"
+        response_json_format = {"query": "{}".format(self.task), "topk": 3}
+        system_prompt = "\n".join([
+            self.system_templates['role'].format(master=self.master, contact=receiver),
+            self.system_templates['task'].format(contact=receiver, task=self.task)
+        ])
+        query_prompt = system_prompt + self.tool_templates['faiss_react'].format(example_json=str(response_json_format),
+                                                                                         task=self.task,
+                                                                                         previous_params=self.previous_faiss_params,
+                                                                                         previous_faiss_result=self.previous_faiss_result,
+                                                                                         agent_communication=agent_communication)
+        response, response_json = self.json_tool.json_query(query_prompt, response_json_format, call_site="faiss_react")
+        iAgentsLogger.log(query_prompt, response, "[faiss query prompt to {}:]".format(self.master))
+        query = response_json['query']
+        topk = response_json['topk']
+        ret_dis, ret_indices, ret_text = self.faiss_tool.query(query, topk)
+        ret_text = get_context_packer(self.model).pack_texts("fuzzy_memory", ret_text)
+        result_str += "\n\n{}".format("\n".join(ret_text))
+        result_str += "\n<context summary related to task ends>\n"
+        iAgentsLogger.log(instruction="[Fuzzy Memory Retrieved results of {}:] \n{}".format(self.master, "\n".join(ret_text)))
+        self.previous_faiss_params = str(response_json)
+        self.previous_faiss_result = "\n".join(ret_text)
+
+        return result_str
+
+    def get_llamaindex_memory(self, receiver: str) -> str:
+        """Retrieve information related to the task from the files indexed by LlamaIndex.
+
+        Args:
+            receiver (str): The name of user in current chatting.
+
+        Returns:
+            str: Retrieved file information.
+        """
+        response = self.use_prefetched("llamaindex_query", receiver, lambda: self.llamaindexer.query(self.task))
+        result_str = "<file information related to task starts>\n"
+        result_str += "\n{}".format("".join(get_context_packer(self.model).pack_texts("llamaindex_memory", [response])))
+        result_str += "\n<file information related to task ends>\n"
+        iAgentsLogger.log(instruction="[Llama Index Memory Retrieved results of {}:] \n{}".format(self.master, response))
+
+        return result_str
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import yaml
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+CHECKPOINT_CONFIG = global_config.get("checkpoint") or {}
+
+
+def make_checkpoint_id(sender, receiver, task) -> str:
+    """checkpoint id of a communication request, the same request sent again resumes its checkpoint
+    unless a live worker still runs it, see CheckpointStore.claim
+
+    Args:
+        sender (str): the user who raised the communication
+        receiver (str): the user whose agent is asked
+        task (str): the task as sent by the user
+
+    Returns:
+        str: sha256 hex digest
+    """
+    key = json.dumps([sender, receiver, task])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def make_checkpoint_owner() -> str:
+    """a nonce identifying one run of a communication (and its sub-communications) as checkpoint owner"""
+    return uuid.uuid4().hex
+
+
+class CheckpointStore():
+    """SQLite store of communication checkpoints
+
+    a communication saves its state after every agent message and deletes it once concluded,
+    so the checkpoints left are those of communications interrupted by a dead worker or a failed LLM call.
+    Checkpoints older than `ttl` seconds are dropped.
+
+    a running communication owns its checkpoint under a lease renewed by every save, identical requests
+    running at the same time can not resume, overwrite or delete each other's checkpoint. The lease of a
+    dead worker runs out after `lease` seconds, a failed communication gives its lease back at once.
+    """
+
+    def __init__(self, path, ttl=0, lease=600) -> None:
+        """init
+
+        Args:
+            path (str): path of the sqlite file, relative paths are under the project root
+            ttl (int, optional): seconds before a checkpoint is dropped, 0 for never. Defaults to 0.
+            lease (int, optional): seconds a checkpoint stays owned after its last save. Defaults to 600.
+        """
+        if not os.path.isabs(path):
+            path = os.path.join(project_path, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.stats = {"saves": 0, "loaded": 0, "finished": 0, "busy": 0}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                checkpoint_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(checkpoints)")}
+        if "owner" not in columns:
+            self.conn.execute("ALTER TABLE checkpoints ADD COLUMN owner TEXT")
+            self.conn.execute("ALTER TABLE checkpoints ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_checkpoints_owner ON checkpoints (owner)")
+        self.conn.commit()
+
+    def claim(self, checkpoint_id, owner):
+        """take the lease of a checkpoint before running its communication
+
+        Args:
+            checkpoint_id (str): checkpoint id
+            owner (str): owner nonce of the communication, see make_checkpoint_owner
+
+        Returns:
+            tuple[bool, dict]: whether the lease was taken (False while another live run owns it),
+                and the state to resume, None if there is no (unexpired) checkpoint
+        """
+        now = time.time()
+        with self.lock:
+            # BEGIN IMMEDIATE serializes the claims of the workers sharing the file
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT state, updated_at, owner, lease_until FROM checkpoints "
+                                        "WHERE checkpoint_id = ?", (checkpoint_id,)).fetchone()
+                if row is not None and row[2] != owner and row[3] > now:
+                    self.conn.rollback()
+                    self.stats["busy"] += 1
+                    return False, None
+                state = None
+                if row is not None and not (self.ttl and now - row[1] > self.ttl):
+                    state = json.loads(row[0])
+                # a claimed checkpoint without a state yet keeps identical requests from running it twice
+                self.conn.execute("""
+                    INSERT INTO checkpoints (checkpoint_id, state, updated_at, owner, lease_until) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(checkpoint_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at,
+                        owner = excluded.owner, lease_until = excluded.lease_until
+                """, (checkpoint_id, json.dumps(state, ensure_ascii=False), row[1] if state is not None else now,
+                      owner, now + self.lease))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            if state is not None:
+                self.stats["loaded"] += 1
+        return True, state
+
+    def save(self, checkpoint_id, state, owner) -> bool:
+        """save the state of a communication, replacing its previous checkpoint and renewing its lease
+
+        Args:
+            checkpoint_id (str): checkpoint id
+            state (dict): JSON serializable state of the communication
+            owner (str): owner nonce of the communication
+
+        Returns:
+            bool: False if another live run owns the checkpoint, nothing is saved then
+        """
+        data = json.dumps(state, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute("""
+                INSERT INTO checkpoints (checkpoint_id, state, updated_at, owner, lease_until) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(checkpoint_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at,
+                    owner = excluded.owner, lease_until = excluded.lease_until
+                WHERE checkpoints.owner IS excluded.owner OR checkpoints.lease_until < excluded.updated_at
+            """, (checkpoint_id, data, now, owner, now + self.lease))
+            if cursor.rowcount == 0:
+                self.conn.commit()
+                self.stats["busy"] += 1
+                return False
+            # a parent communication waiting on its sub-communications keeps its lease too
+            self.conn.execute("UPDATE checkpoints SET lease_until = ? WHERE owner = ?", (now + self.lease, owner))
+            self.conn.commit()
+            self.stats["saves"] += 1
+        return True
+
+    def load(self, checkpoint_id):
+        """the last saved state of a communication, whoever owns it
+
+        Args:
+            checkpoint_id (str): checkpoint id
+
+        Returns:
+            dict: the state, None if there is no (unexpired) checkpoint
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT state, updated_at FROM checkpoints WHERE checkpoint_id = ?",
+                                    (checkpoint_id,)).fetchone()
+        if row is None or row[0] == "null":
+            return None
+        state, updated_at = row
+        if self.ttl and time.time() - updated_at > self.ttl:
+            self.delete(checkpoint_id)
+            return None
+        with self.lock:
+            self.stats["loaded"] += 1
+        return json.loads(state)
+
+    def delete(self, checkpoint_id, owner=None) -> None:
+        """drop the checkpoint of a communication and of the sub-communications it raised
+
+        Args:
+            checkpoint_id (str): checkpoint id
+            owner (str, optional): only drop the checkpoints of this owner (or with an expired lease).
+                Defaults to None, for any owner.
+        """
+        prefix = checkpoint_id + "/"
+        with self.lock:
+            self.conn.execute("DELETE FROM checkpoints WHERE (checkpoint_id = ? OR substr(checkpoint_id, 1, ?) = ?) "
+                              "AND (? IS NULL OR owner IS ? OR lease_until < ?)",
+                              (checkpoint_id, len(prefix), prefix, owner, owner, time.time()))
+            self.conn.commit()
+
+    def release(self, checkpoint_id, owner) -> None:
+        """end the lease of a failed communication, so the request sent again resumes its checkpoint at once"""
+        prefix = checkpoint_id + "/"
+        with self.lock:
+            self.conn.execute("UPDATE checkpoints SET lease_until = 0 "
+                              "WHERE (checkpoint_id = ? OR substr(checkpoint_id, 1, ?) = ?) AND owner IS ?",
+                              (checkpoint_id, len(prefix), prefix, owner))
+            self.conn.commit()
+
+    def finish(self, checkpoint_id, owner) -> None:
+        """the communication concluded, its checkpoints are not needed anymore"""
+        self.delete(checkpoint_id, owner)
+        with self.lock:
+            self.stats["finished"] += 1
+
+    def list_checkpoints(self) -> list:
+        """(checkpoint id, updated at) of the saved checkpoints, most recent first"""
+        with self.lock:
+            rows = self.conn.execute("SELECT checkpoint_id, updated_at FROM checkpoints ORDER BY updated_at DESC").fetchall()
+        return [tuple(row) for row in rows]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["checkpoints"] = self.conn.execute("SELECT COUNT(*) FROM checkpoints").fetchone()[0]
+        return stats
+
+
+_checkpoint_store = None
+_checkpoint_store_lock = threading.Lock()
+
+
+def get_checkpoint_store():
+    """get the process-wide checkpoint store, built from the `checkpoint` section of global config
+
+    Returns:
+        CheckpointStore: the shared store, None if checkpoints are disabled
+    """
+    global _checkpoint_store
+    if not CHECKPOINT_CONFIG.get("enable", False):
+        return None
+    if _checkpoint_store is None:
+        with _checkpoint_store_lock:
+            if _checkpoint_store is None:
+                _checkpoint_store = CheckpointStore(CHECKPOINT_CONFIG.get("path") or "cache/checkpoints.sqlite",
+                                                    ttl=CHECKPOINT_CONFIG.get("ttl", 0),
+                                                    lease=CHECKPOINT_CONFIG.get("lease", 600))
+    return _checkpoint_store
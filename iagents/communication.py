@@ -1,11 +1,24 @@
+import asyncio
+import concurrent.futures
+import functools
 import json
 import os
 from abc import ABC, abstractmethod
 from datetime import datetime
-import inspect
+import re
 from iagents.agent import *
 from iagents.sql import *
 import sys
+from backend.governor import governor_flow
+from backend.tokens import IncrementalTokenCounter
+from iagents.checkpoint import get_checkpoint_store, make_checkpoint_owner
+from iagents.factory import get_agent_factory
+from iagents.history import RollingHistory
+from iagents.prompt import render_full_history
+from iagents.resources import get_resources
+from iagents.retrieval import (FAN_OUT_WORKERS, SUB_COMMUNICATION_WORKERS, get_fan_out_executor,
+                               get_sub_communication_executor)
+from iagents.stop import FanOutBudget, FanOutPolicy, build_stop_policies
 
 sys.path.append("..")
 
@@ -22,6 +35,36 @@ except yaml.YAMLError as exc:
     print("Error in configuration file:", exc)
     raise
 
+FAN_OUT_CONFIG = global_config.get("fan_out") or {}
+DEFAULT_FAN_OUT_WEIGHTS = {"llm": 2.0, "keywords": 1.0, "recent": 0.5}
+
+
+def run_communication(method):
+    """wrap a (a)communicate method: the LLM calls of the communication are one governor flow, so the
+    governors' fair queues serve communications round-robin whatever thread or task they run on,
+    and a failed run gives its checkpoint lease back, so the request sent again resumes at once
+    """
+    if asyncio.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            with governor_flow(id(self)):
+                try:
+                    return await method(self, *args, **kwargs)
+                except BaseException:
+                    await asyncio.to_thread(self.release_checkpoint)
+                    raise
+    else:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with governor_flow(id(self)):
+                try:
+                    return method(self, *args, **kwargs)
+                except BaseException:
+                    self.release_checkpoint()
+                    raise
+    return wrapper
+
+
 class BaseCommunication(ABC):
     """The base class of communication
     A communication class hold the process of dialogue between two agents,
@@ -40,20 +83,22 @@ class BaseCommunication(ABC):
         self.instructor = instructor
         self.assistant = assistant
         self.max_round = max_round
-        self.communication_history = ['']
+        self.communication_history = RollingHistory([''])
+        self.history_token_counter = IncrementalTokenCounter(model=instructor.model)
+        self.listeners = []
+        self.stop_policies = build_stop_policies()
+        self.stop_reason = None
+        # last completed step: rounds started and messages sent in the last one (2 when it is done)
+        self.round_index = 0
+        self.turn = 0
+        self.checkpoint_id = None
+        self.checkpoint_owner = None
         assert isinstance(self.instructor, Agent) and isinstance(self.assistant, Agent), "instructor and assistant must be Agent instances"
         assert self.instructor.task == self.assistant.task, "Tasks of instructor and assistant must match"
         self.task = instructor.task
-
-        try:
-            with open(os.path.join(project_path, "prompts", "tool_prompt.json"), "r") as f:
-                self.tool_prompt = json.load(f)
-        except FileNotFoundError:
-            print("Tool prompt file not found.")
-            raise
-        except json.JSONDecodeError as exc:
-            print("Error decoding JSON file:", exc)
-            raise
+        # the first turn's context retrieval starts now instead of on the critical path of the first turn
+        self.instructor.prefetch(self.assistant.master)
+        self.assistant.prefetch(self.instructor.master)
 
     @abstractmethod
     def communicate(self) -> str:
@@ -86,6 +131,151 @@ class BaseCommunication(ABC):
         """
         pass
 
+    def add_listener(self, listener):
+        """subscribe to the events of this communication, used to stream the communication to the web UI
+
+        Args:
+            listener (callable): called as listener(event, data) with the events
+                "agent_message" ({"sender", "receiver", "message"}) when an agent message is sent and
+                "conclusion_chunk" ({"text"}) for every streamed chunk of the conclusion
+        """
+        self.listeners.append(listener)
+
+    def emit(self, event, data):
+        for listener in self.listeners:
+            listener(event, data)
+
+    def emit_conclusion_chunk(self, chunk):
+        self.emit("conclusion_chunk", {"text": chunk})
+
+    @property
+    def tool_templates(self):
+        return get_resources().get_prompt_templates("tool_prompt.json")
+
+    def get_history_tokens(self) -> int:
+        """number of tokens in the communication history, only newly appended messages are encoded
+
+        Returns:
+            int: token count of the communication history
+        """
+        return self.history_token_counter.count(self.communication_history)
+
+    def start_stop_policies(self):
+        for policy in self.stop_policies:
+            policy.start(self)
+
+    def check_stop(self, round_index) -> bool:
+        """ask the stop policies whether the communication can skip its remaining rounds and conclude
+
+        Args:
+            round_index (int): number of rounds done
+
+        Returns:
+            bool: whether to stop, the reason is kept in self.stop_reason
+        """
+        if round_index >= self.max_round:
+            return False
+        for policy in self.stop_policies:
+            reason = policy.check(self, round_index)
+            if reason:
+                self.stop_reason = "{}: {}".format(policy.name, reason)
+                iAgentsLogger.log(instruction="[Stop Check Round {}]: stop after {} of {} rounds, {}".format(
+                    round_index, round_index, self.max_round, self.stop_reason))
+                return True
+        if self.stop_policies:
+            iAgentsLogger.log(instruction="[Stop Check Round {}]: continue".format(round_index))
+        return False
+
+    def get_state(self) -> dict:
+        """the state of the communication as a JSON serializable dict, saved in checkpoints
+
+        Returns:
+            dict: the state, restored by set_state
+        """
+        return {"type": type(self).__name__,
+                "task": self.task,
+                "round_index": self.round_index,
+                "turn": self.turn,
+                "stop_reason": self.stop_reason,
+                "communication_history": list(self.communication_history),
+                "instructor": self.instructor.get_state(),
+                "assistant": self.assistant.get_state()}
+
+    def set_state(self, state: dict) -> None:
+        """restore the state saved by get_state, communicate() then goes on from the last completed step
+
+        Args:
+            state (dict): the saved state
+        """
+        self.task = state["task"]
+        self.round_index = state["round_index"]
+        self.turn = state["turn"]
+        self.stop_reason = state.get("stop_reason")
+        self.communication_history = RollingHistory(state["communication_history"])
+        self.instructor.set_state(state["instructor"])
+        self.assistant.set_state(state["assistant"])
+
+    def set_checkpoint(self, checkpoint_id, owner=None) -> bool:
+        """checkpoint this communication under the id after every agent message, resuming its last checkpoint if any
+
+        a checkpoint owned by another live run of the same request is neither resumed nor overwritten,
+        this communication then runs without checkpoints.
+
+        Args:
+            checkpoint_id (str): checkpoint id, see make_checkpoint_id
+            owner (str, optional): owner nonce, sub-communications share the one of their parent. Defaults to a new one.
+
+        Returns:
+            bool: whether a checkpoint was resumed
+        """
+        store = get_checkpoint_store()
+        if store is None:
+            return False
+        owner = owner or make_checkpoint_owner()
+        claimed, state = store.claim(checkpoint_id, owner)
+        if not claimed:
+            iAgentsLogger.log(instruction="[Checkpoint]: {} is run by another worker, run without checkpoints".format(
+                checkpoint_id))
+            return False
+        self.checkpoint_id = checkpoint_id
+        self.checkpoint_owner = owner
+        if state is None:
+            return False
+        if state.get("type") != type(self).__name__:
+            # the next save replaces it
+            iAgentsLogger.log(instruction="[Checkpoint]: {} was saved by {}, start over as {}".format(
+                checkpoint_id, state.get("type"), type(self).__name__))
+            return False
+        self.set_state(state)
+        iAgentsLogger.log(instruction="[Checkpoint]: resume {} after round {} ({} of its messages sent)".format(
+            checkpoint_id, self.round_index, self.turn))
+        return True
+
+    def save_checkpoint(self, round_index, turn):
+        """record the completed step and save the checkpoint
+
+        Args:
+            round_index (int): rounds started
+            turn (int): messages sent in the last round
+        """
+        self.round_index = round_index
+        self.turn = turn
+        if self.checkpoint_id is not None and \
+                not get_checkpoint_store().save(self.checkpoint_id, self.get_state(), self.checkpoint_owner):
+            # the lease ran out and another worker took the checkpoint over
+            iAgentsLogger.log(instruction="[Checkpoint]: {} was taken over by another worker, stop checkpointing".format(
+                self.checkpoint_id))
+            self.checkpoint_id = None
+
+    def finish_checkpoint(self):
+        if self.checkpoint_id is not None:
+            get_checkpoint_store().finish(self.checkpoint_id, self.checkpoint_owner)
+
+    def release_checkpoint(self):
+        """give the checkpoint lease back after a failure"""
+        if self.checkpoint_id is not None:
+            get_checkpoint_store().release(self.checkpoint_id, self.checkpoint_owner)
+
     def get_time(self):
         current_time = datetime.now()
         formatted_time = current_time.strftime("%Y-%m-%d %H:%M:%S")
@@ -112,25 +302,31 @@ class VanillaCommunication(BaseCommunication):
         if self.is_consensus_conclusion:
             assert isinstance(self.instructor, ThinkAgent) and isinstance(self.assistant, ThinkAgent), "Consensus Conclusion is only avaiable when two agents are ThinkAgent"
 
+    @run_communication
     def communicate(self) -> str:
-        round_index = 0
-        while round_index < self.max_round:
-            iAgentsLogger.log(instruction="[Comm Round: {}]".format(round_index))
-            round_index += 1
-
-            # if round_index == 1:
-                # add the task prompt at the start of agent's communication
-                # self.send_message_agent(self.instructor, 
-                #                         self.assistant,
-                #                         "[Trigger Agents Communication for Task Solving, Task Prompt]: " + self.task)
-
-            # instructor sends message to assistant
-            instructor_response = self.instructor.query(self.assistant.master, 
-                                                        self.communication_history)
-            self.communication_history.append(self.format_agent_history(self.instructor, 
-                                                                        self.assistant, 
-                                                                        instructor_response))
-            self.send_message_agent(self.instructor, self.assistant, instructor_response)
+        # (0, 0) for a new communication, else the last completed step of the resumed checkpoint
+        round_index, turn = self.round_index, self.turn
+        self.start_stop_policies()
+        while not self.stop_reason and (round_index < self.max_round or turn == 1):
+            if turn != 1:
+                iAgentsLogger.log(instruction="[Comm Round: {}]".format(round_index))
+                round_index += 1
+
+                # if round_index == 1:
+                    # add the task prompt at the start of agent's communication
+                    # self.send_message_agent(self.instructor, 
+                    #                         self.assistant,
+                    #                         "[Trigger Agents Communication for Task Solving, Task Prompt]: " + self.task)
+
+                # instructor sends message to assistant
+                instructor_response = self.instructor.query(self.assistant.master, 
+                                                            self.communication_history)
+                self.communication_history.append(self.format_agent_history(self.instructor, 
+                                                                            self.assistant, 
+                                                                            instructor_response))
+                self.send_message_agent(self.instructor, self.assistant, instructor_response)
+                self.save_checkpoint(round_index, 1)
+            turn = 0
 
             # assistant sends message to instructor
             assistant_response = self.assistant.query(self.instructor.master, 
@@ -140,14 +336,65 @@ class VanillaCommunication(BaseCommunication):
                                                                         assistant_response))
             self.send_message_agent(self.assistant, self.instructor, assistant_response)
 
+            self.check_stop(round_index)
+            self.save_checkpoint(round_index, 2)
+
         # get conclusion
         if self.is_consensus_conclusion:
             conclusion = self.consensus_conclusion(self.communication_history, 
                                                    self.instructor.infonav_plan,
                                                    self.assistant.infonav_plan)
         else:
-            conclusion = self.instructor.conclusion(self.communication_history)
+            conclusion = self.instructor.conclusion(self.communication_history,
+                                                    on_chunk=self.emit_conclusion_chunk if self.listeners else None)
         iAgentsLogger.log(instruction="[conclusion]:\n{}".format(conclusion))
+        self.finish_checkpoint()
+        return conclusion
+
+    @run_communication
+    async def acommunicate(self) -> str:
+        """async version of communicate, agents' LLM calls are awaited so that many communications can share one event loop
+
+        Returns:
+            str: the output conclusion of this communication
+        """
+        round_index, turn = self.round_index, self.turn
+        self.start_stop_policies()
+        while not self.stop_reason and (round_index < self.max_round or turn == 1):
+            if turn != 1:
+                iAgentsLogger.log(instruction="[Comm Round: {}]".format(round_index))
+                round_index += 1
+
+                # instructor sends message to assistant
+                instructor_response = await self.instructor.aquery(self.assistant.master,
+                                                                   self.communication_history)
+                self.communication_history.append(self.format_agent_history(self.instructor,
+                                                                            self.assistant,
+                                                                            instructor_response))
+                await asyncio.to_thread(self.send_message_agent, self.instructor, self.assistant, instructor_response)
+                await asyncio.to_thread(self.save_checkpoint, round_index, 1)
+            turn = 0
+
+            # assistant sends message to instructor
+            assistant_response = await self.assistant.aquery(self.instructor.master,
+                                                             self.communication_history)
+            self.communication_history.append(self.format_agent_history(self.assistant,
+                                                                        self.instructor,
+                                                                        assistant_response))
+            await asyncio.to_thread(self.send_message_agent, self.assistant, self.instructor, assistant_response)
+
+            self.check_stop(round_index)
+            await asyncio.to_thread(self.save_checkpoint, round_index, 2)
+
+        # get conclusion
+        if self.is_consensus_conclusion:
+            conclusion = await self.aconsensus_conclusion(self.communication_history,
+                                                          self.instructor.infonav_plan,
+                                                          self.assistant.infonav_plan)
+        else:
+            conclusion = await self.instructor.aconclusion(self.communication_history)
+        iAgentsLogger.log(instruction="[conclusion]:\n{}".format(conclusion))
+        await asyncio.to_thread(self.finish_checkpoint)
         return conclusion
 
     def send_message_agent(self, sender, receiver, message):
@@ -156,6 +403,7 @@ class VanillaCommunication(BaseCommunication):
         _ = exec_sql("INSERT INTO chats (sender, receiver, message, communication_history) VALUES (%s, %s, %s, %s)",
                      params=(sender, receiver, message, ""),
                      mode="write")
+        self.emit("agent_message", {"sender": sender, "receiver": receiver, "message": message})
 
     def format_agent_history(self, sender, receiver, message):
         message = "from {} to {}: {}".format(sender.master + "'s Agent", 
@@ -175,12 +423,34 @@ class VanillaCommunication(BaseCommunication):
             infonav_assistant (str): infonav plan from assistant agent
         """
 
-        query_str = "\n".join(self.tool_prompt['consensus_conclusion']).format(
+        query_str = self.tool_templates['consensus_conclusion'].format(
             task=self.task,
-            agent_communication="\n".join(communication_history),
+            agent_communication=render_full_history(communication_history),
             infonav_instructor=infonav_instructor,
             infonav_assistant=infonav_assistant)
-        response = self.instructor.query_func(query_str)
+        if self.listeners:
+            response = self.instructor.stream_query(query_str, "consensus_conclusion", self.emit_conclusion_chunk)
+        else:
+            response = self.instructor.query_func(query_str, call_site="consensus_conclusion")
+
+        iAgentsLogger.log(query_str, response, "[consensus_conclusion]")
+        return response
+
+    async def aconsensus_conclusion(self, communication_history, infonav_instructor, infonav_assistant):
+        """async version of consensus_conclusion
+
+        Args:
+            communication_history (list[str]): the chat history between two agents
+            infonav_instructor (str): infonav plan from instructor agent
+            infonav_assistant (str): infonav plan from assistant agent
+        """
+
+        query_str = self.tool_templates['consensus_conclusion'].format(
+            task=self.task,
+            agent_communication=render_full_history(communication_history),
+            infonav_instructor=infonav_instructor,
+            infonav_assistant=infonav_assistant)
+        response = await self.instructor.aquery_func(query_str, call_site="consensus_conclusion")
 
         iAgentsLogger.log(query_str, response, "[consensus_conclusion]")
         return response
@@ -194,14 +464,10 @@ class MultiPartyCommunication(VanillaCommunication):
     def __init__(self, instructor, assistant, max_round, is_consensus_conclusion=False) -> None:
         super().__init__(instructor, assistant, max_round, is_consensus_conclusion)
 
-    def get_agent_params(self, agent):
-        signature = inspect.signature(agent.__init__)
-        args = [param for param in signature.parameters.keys() if param != 'self']
-        init_params = {}
-        for param_name in args:
-            param_value = getattr(agent, param_name)
-            init_params[param_name] = param_value
-        return init_params
+    def forward_agent_message(self, event, data):
+        """forward the agent messages (but not the conclusion chunks) of a raised sub-communication"""
+        if event == "agent_message":
+            self.emit(event, data)
 
     def raise_new_comm(self, agent, current_talking_agent):
         """make the agent to actively start a new communication with other agents
@@ -219,16 +485,28 @@ class MultiPartyCommunication(VanillaCommunication):
         friends_set = {item.lower() for item in friends_set}
         friends = ",".join(friends_set)
 
-        query_friends = "\n".join(self.tool_prompt['raise_new_communication']).format(
+        query_friends = self.tool_templates['raise_new_communication'].format(
             task=self.task, friends=friends, yourself=agent.master, contact=current_talking_agent.master)
 
-        chosen_friend = agent.query_func(query_friends)
+        chosen_friend = agent.query_func(query_friends, call_site="raise_new_communication")
         if not chosen_friend:
             chosen_friend = "None"
         chosen_friend = chosen_friend.lower().strip()
         iAgentsLogger.log(query_friends, chosen_friend,
                          "choose third-party friends from {}".format(agent.master))
 
+        if FAN_OUT_CONFIG.get("enable", False):
+            friends = self.rank_friends(agent, friends_set, chosen_friend)
+            if friends:
+                self.send_message_agent(
+                    agent, current_talking_agent,
+                    "[Trigger {}'s Agents Raising New Communication with {}]".format(agent.master, ", ".join(friends)))
+                communications, budget = self.build_fan_out(agent, friends)
+                conclusions = self.run_fan_out(communications, budget)
+                return self.join_fan_out(agent, friends, conclusions, budget)
+            # no friend ranked, fall through to the failure below
+            chosen_friend = "None"
+
         if chosen_friend not in friends_set:
             iAgentsLogger.log(instruction="Failed to find third-party for {}".format(agent.master))
             self.send_message_agent(
@@ -240,54 +518,217 @@ class MultiPartyCommunication(VanillaCommunication):
             self.send_message_agent(
                 agent, current_talking_agent,
                 "[Trigger {}'s Agents Raising New Communication with {}]".format(agent.master, chosen_friend))
-            # inspect the Agent type of instructor and assistant, apply the same agent type with different master
-            # the raised new communication is a normal communication (not MultiCommunication)
-            agent_type_instructor = type(self.instructor)
-            agent_type_assistant = type(self.assistant)
-            agent_params_instructor = self.get_agent_params(self.instructor)
-            agent_params_assistant = self.get_agent_params(self.assistant)
-
-            agent_instructor = agent_type_instructor(**agent_params_instructor)
-            agent_assistant = agent_type_assistant(**agent_params_assistant)
-            agent_instructor.set_master(agent.master)
-            agent_assistant.set_master(chosen_friend)
-
-            communication = VanillaCommunication(
-                instructor=agent_instructor,
-                assistant=agent_assistant,
-                max_round=global_config.get("agent").get("max_communication_turns"),
-                is_consensus_conclusion=True)
-            response = communication.communicate()
+            communication = self.build_sub_communication(agent, chosen_friend)
+            try:
+                response = communication.communicate()
+            finally:
+                self.release_sub_communications([communication])
             return chosen_friend, response
 
-    def communicate(self) -> str:
-        round_index = 0
-        while round_index < self.max_round:
-            iAgentsLogger.log(instruction="[MultiComm Round: {}]".format(round_index))
-            round_index += 1
+    def build_sub_communication(self, agent, friend):
+        """the communication between the agent's master and a third-party friend
 
-            if round_index == 1:
-                # add the task prompt at the start of agent's communication
-                # self.send_message_agent(
-                #     self.instructor, self.assistant,
-                #     "[Trigger Agents Communication for Task Solving, Task Prompt]: " + self.task)
-
-                # instructor starts the new communication
-                chosen_friend_instructor, new_comm_instructor_conclusion = self.raise_new_comm(
-                    self.instructor, self.assistant)
-                self.communication_history.append(
-                    self.format_agent_history(
+        Args:
+            agent (Agent): the agent who raises the new communication
+            friend (str): the chosen third-party friend
+
+        Returns:
+            VanillaCommunication: the new communication, resumed from its checkpoint if it was interrupted
+        """
+        # agents of the same type and settings as instructor and assistant, with different masters, from the agent pool
+        # the raised new communication is a normal communication (not MultiCommunication)
+        factory = get_agent_factory()
+        agent_instructor = factory.acquire_like(self.instructor, agent.master)
+        agent_assistant = factory.acquire_like(self.assistant, friend)
+
+        communication = VanillaCommunication(
+            instructor=agent_instructor,
+            assistant=agent_assistant,
+            max_round=global_config.get("agent").get("max_communication_turns"),
+            is_consensus_conclusion=True)
+        communication.add_listener(self.forward_agent_message)
+        if self.checkpoint_id is not None:
+            # an interrupted sub-communication resumes too
+            communication.set_checkpoint("{}/{}/{}".format(self.checkpoint_id, agent.master, friend),
+                                         owner=self.checkpoint_owner)
+        return communication
+
+    def release_sub_communications(self, communications):
+        """return the agents of finished sub-communications to the agent pool"""
+        factory = get_agent_factory()
+        for communication in communications:
+            factory.release(communication.instructor)
+            factory.release(communication.assistant)
+
+    def get_task_keywords(self) -> set:
+        stopwords = get_resources().get_stopwords()
+        return {word for word in re.findall(r"\w+", self.task.lower()) if len(word) > 2 and word not in stopwords}
+
+    def rank_friends(self, agent, friends_set, answer) -> list:
+        """rank the third-party friends of a fan-out
+
+        friends are scored by being named in the LLM answer (no exact match needed), the task keywords
+        found in their chats with the agent's master and how recently they chatted with the master.
+
+        Args:
+            agent (Agent): the agent who raises the new communications
+            friends_set (set[str]): lowercased candidate friends
+            answer (str): the lowercased LLM answer to raise_new_communication
+
+        Returns:
+            list[str]: the top_k friends with a positive score, best first
+        """
+        weights = dict(DEFAULT_FAN_OUT_WEIGHTS, **(FAN_OUT_CONFIG.get("weights") or {}))
+        named = {friend for friend in friends_set if re.search(r"\b{}\b".format(re.escape(friend)), answer)}
+        activity = agent.sql_tool.get_friend_activity(agent.master, friends_set, self.get_task_keywords())
+        max_hits = max((hits for hits, _ in activity.values()), default=0)
+        by_recency = sorted((friend for friend in activity if activity[friend][1] is not None),
+                            key=lambda friend: activity[friend][1])
+        recency = {friend: (position + 1) / len(by_recency) for position, friend in enumerate(by_recency)}
+
+        scores = {}
+        for friend in friends_set:
+            hits = activity.get(friend, (0, None))[0]
+            scores[friend] = (weights["llm"] * (friend in named)
+                              + weights["keywords"] * (hits / max_hits if max_hits else 0.0)
+                              + weights["recent"] * recency.get(friend, 0.0))
+        ranked = sorted((friend for friend in friends_set if scores[friend] > 0),
+                        key=lambda friend: (-scores[friend], friend))
+        ranked = ranked[:FAN_OUT_CONFIG.get("top_k", 3)]
+        iAgentsLogger.log(instruction="Ranked third-parties for {}: {}".format(
+            agent.master, ", ".join("{} ({:.2f})".format(friend, scores[friend]) for friend in ranked) or "None"))
+        return ranked
+
+    def build_fan_out(self, agent, friends):
+        """the sub-communications with the ranked friends, sharing one budget which stops them all
+
+        Args:
+            agent (Agent): the agent who raises the new communications
+            friends (list[str]): the ranked friends
+
+        Returns:
+            tuple[list[VanillaCommunication], FanOutBudget]: the sub-communications in friend order and their budget
+        """
+        budget = FanOutBudget(max_history_tokens=FAN_OUT_CONFIG.get("max_history_tokens", 0),
+                              max_seconds=FAN_OUT_CONFIG.get("max_seconds", 0),
+                              enough_facts=FAN_OUT_CONFIG.get("enough_facts", 0))
+        communications = []
+        for friend in friends:
+            communication = self.build_sub_communication(agent, friend)
+            communication.stop_policies.append(FanOutPolicy(budget))
+            communications.append(communication)
+        return communications, budget
+
+    def run_fan_out(self, communications, budget) -> list:
+        """run the sub-communications of a fan-out in parallel, their agents go back to the pool once all of them are done
+
+        Args:
+            communications (list[VanillaCommunication]): the sub-communications
+            budget (FanOutBudget): their shared budget, cancelled when one of them fails
+
+        Returns:
+            list[str]: the conclusions in the order of communications, the first error is raised
+        """
+        futures = get_fan_out_executor().start(
+            [("fan_out_communication", communication.communicate) for communication in communications])
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            budget.cancel("a sub-communication of the fan-out failed")
+            raise
+        finally:
+            # siblings still running would change the state of agents handed out again by the pool
+            concurrent.futures.wait(futures)
+            self.release_sub_communications(communications)
+
+    async def arun_fan_out(self, communications, budget) -> list:
+        """async version of run_fan_out, at most fan_out.workers sub-communications run at once"""
+        semaphore = asyncio.Semaphore(max(FAN_OUT_WORKERS, 1))
+
+        async def acommunicate(communication):
+            async with semaphore:
+                try:
+                    return await communication.acommunicate()
+                except BaseException:
+                    budget.cancel("a sub-communication of the fan-out failed")
+                    raise
+
+        results = await asyncio.gather(*(acommunicate(communication) for communication in communications),
+                                       return_exceptions=True)
+        # every sub-communication is done here, their agents can go back to the pool
+        self.release_sub_communications(communications)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def join_fan_out(self, agent, friends, conclusions, budget):
+        """join the conclusions of a fan-out in friend order, as the result of raise_new_comm
+
+        Returns:
+            tuple[str, str]: the friends and their conclusions
+        """
+        iAgentsLogger.log(instruction="Fan-out of {} with {} finished: {}".format(
+            agent.master, ", ".join(friends), budget.get_summary()))
+        return ", ".join(friends), "\n".join("[{}]: {}".format(friend, conclusion)
+                                             for friend, conclusion in zip(friends, conclusions))
+
+    @run_communication
+    def communicate(self) -> str:
+        round_index, turn = self.round_index, self.turn
+        # the assistant's sub-communication of round 1, running alongside the instructor's
+        assistant_new_comm = None
+        self.start_stop_policies()
+        while not self.stop_reason and (round_index < self.max_round or turn == 1):
+            if turn != 1:
+                iAgentsLogger.log(instruction="[MultiComm Round: {}]".format(round_index))
+                round_index += 1
+
+                if round_index == 1:
+                    # add the task prompt at the start of agent's communication
+                    # self.send_message_agent(
+                    #     self.instructor, self.assistant,
+                    #     "[Trigger Agents Communication for Task Solving, Task Prompt]: " + self.task)
+
+                    # the two sub-communications are independent, the assistant's starts in the background
+                    executor = get_sub_communication_executor()
+                    if executor is not None:
+                        assistant_new_comm = executor.submit(
+                            "raise_new_communication", lambda: self.raise_new_comm(self.assistant, self.instructor))
+
+                    # instructor starts the new communication
+                    try:
+                        chosen_friend_instructor, new_comm_instructor_conclusion = self.raise_new_comm(
+                            self.instructor, self.assistant)
+                    except BaseException:
+                        # the assistant's sub-communication must not outlive this one
+                        if assistant_new_comm is not None:
+                            concurrent.futures.wait([assistant_new_comm])
+                        raise
+                    self.communication_history.append(
+                        self.format_agent_history(
+                            self.instructor, self.assistant,
+                            "Discussion with {}'s Agents: {} ".format(chosen_friend_instructor,
+                                                                      new_comm_instructor_conclusion)))
+                    self.send_message_agent(
                         self.instructor, self.assistant,
-                        "Discussion with {}'s Agents: {} ".format(chosen_friend_instructor,
-                                                                  new_comm_instructor_conclusion)))
-                self.send_message_agent(
-                    self.instructor, self.assistant,
-                    "[Discussion with {}'s Agents]: {} ".format(chosen_friend_instructor,
-                                                                new_comm_instructor_conclusion))
+                        "[Discussion with {}'s Agents]: {} ".format(chosen_friend_instructor,
+                                                                    new_comm_instructor_conclusion))
+                else:
+                    instructor_response = self.instructor.query(self.assistant.master, self.communication_history)
+                    self.communication_history.append(
+                        self.format_agent_history(self.instructor, self.assistant, instructor_response))
+                    self.send_message_agent(self.instructor, self.assistant, instructor_response)
+                self.save_checkpoint(round_index, 1)
+            turn = 0
 
-                # assistant star∂ts the new communication
-                chosen_friend_assistant, new_comm_assistant_conclusion = self.raise_new_comm(
-                    self.assistant, self.instructor)
+            if round_index == 1:
+                # assistant starts the new communication, its conclusion joins the history after the instructor's
+                if assistant_new_comm is not None:
+                    chosen_friend_assistant, new_comm_assistant_conclusion = assistant_new_comm.result()
+                else:
+                    chosen_friend_assistant, new_comm_assistant_conclusion = self.raise_new_comm(
+                        self.assistant, self.instructor)
                 self.communication_history.append(
                     self.format_agent_history(
                         self.assistant, self.instructor,
@@ -298,23 +739,157 @@ class MultiPartyCommunication(VanillaCommunication):
                     "[Discussion with {}'s Agents]: {} ".format(chosen_friend_assistant,
                                                                 new_comm_assistant_conclusion))
             else:
-                instructor_response = self.instructor.query(self.assistant.master, self.communication_history)
-                self.communication_history.append(
-                    self.format_agent_history(self.instructor, self.assistant, instructor_response))
-                self.send_message_agent(self.instructor, self.assistant, instructor_response)
-
                 assistant_response = self.assistant.query(self.instructor.master, self.communication_history)
                 self.communication_history.append(
                     self.format_agent_history(self.assistant, self.instructor, assistant_response))
                 self.send_message_agent(self.assistant, self.instructor, assistant_response)
 
+            self.check_stop(round_index)
+            self.save_checkpoint(round_index, 2)
+
         if self.is_consensus_conclusion:
             conclusion = self.consensus_conclusion(self.communication_history, 
                                                    self.instructor.infonav_plan,
                                                    self.assistant.infonav_plan)
         else:
-            conclusion = self.instructor.conclusion(self.communication_history)
+            conclusion = self.instructor.conclusion(self.communication_history,
+                                                    on_chunk=self.emit_conclusion_chunk if self.listeners else None)
+        iAgentsLogger.log(instruction="[conclusion]:\n{}".format(conclusion))
+        self.finish_checkpoint()
+        return conclusion
+
+
+    async def araise_new_comm(self, agent, current_talking_agent):
+        """async version of raise_new_comm, the nested communication is awaited with acommunicate
+
+        Args:
+            agent (Agent): the agent who wants to raise new communication
+            current_talking_agent (Agent): the agent of current chat partner
+        """
+        friends_set = set((await asyncio.to_thread(agent.get_friends)).split("\n"))
+        if current_talking_agent.master in friends_set:
+            friends_set.remove(current_talking_agent.master)
+        if agent.master in friends_set:
+            friends_set.remove(agent.master)
+        friends_set.remove("")
+        friends_set = {item.lower() for item in friends_set}
+        friends = ",".join(friends_set)
+
+        query_friends = self.tool_templates['raise_new_communication'].format(
+            task=self.task, friends=friends, yourself=agent.master, contact=current_talking_agent.master)
+
+        chosen_friend = await agent.aquery_func(query_friends, call_site="raise_new_communication")
+        if not chosen_friend:
+            chosen_friend = "None"
+        chosen_friend = chosen_friend.lower().strip()
+        iAgentsLogger.log(query_friends, chosen_friend,
+                         "choose third-party friends from {}".format(agent.master))
+
+        if FAN_OUT_CONFIG.get("enable", False):
+            friends = await asyncio.to_thread(self.rank_friends, agent, friends_set, chosen_friend)
+            if friends:
+                await asyncio.to_thread(
+                    self.send_message_agent, agent, current_talking_agent,
+                    "[Trigger {}'s Agents Raising New Communication with {}]".format(agent.master, ", ".join(friends)))
+                communications, budget = await asyncio.to_thread(self.build_fan_out, agent, friends)
+                conclusions = await self.arun_fan_out(communications, budget)
+                return self.join_fan_out(agent, friends, conclusions, budget)
+            # no friend ranked, fall through to the failure below
+            chosen_friend = "None"
+
+        if chosen_friend not in friends_set:
+            iAgentsLogger.log(instruction="Failed to find third-party for {}".format(agent.master))
+            await asyncio.to_thread(
+                self.send_message_agent, agent, current_talking_agent,
+                "[Trigger {}'s Agents Raising New Communication with {}]".format(agent.master, "None"))
+            return "None", "None"
+        else:
+            iAgentsLogger.log(instruction="Found third-party for {}, {}".format(agent.master, chosen_friend))
+            await asyncio.to_thread(
+                self.send_message_agent, agent, current_talking_agent,
+                "[Trigger {}'s Agents Raising New Communication with {}]".format(agent.master, chosen_friend))
+            communication = await asyncio.to_thread(self.build_sub_communication, agent, chosen_friend)
+            try:
+                response = await communication.acommunicate()
+            finally:
+                self.release_sub_communications([communication])
+            return chosen_friend, response
+
+    @run_communication
+    async def acommunicate(self) -> str:
+        round_index, turn = self.round_index, self.turn
+        assistant_new_comm = None
+        self.start_stop_policies()
+        while not self.stop_reason and (round_index < self.max_round or turn == 1):
+            if turn != 1:
+                iAgentsLogger.log(instruction="[MultiComm Round: {}]".format(round_index))
+                round_index += 1
+
+                if round_index == 1:
+                    # the two sub-communications are independent, the assistant's runs as a concurrent task
+                    if SUB_COMMUNICATION_WORKERS:
+                        assistant_new_comm = asyncio.ensure_future(self.araise_new_comm(self.assistant, self.instructor))
+
+                    # instructor starts the new communication
+                    try:
+                        chosen_friend_instructor, new_comm_instructor_conclusion = await self.araise_new_comm(
+                            self.instructor, self.assistant)
+                    except BaseException:
+                        # the assistant's sub-communication must not outlive this one
+                        if assistant_new_comm is not None:
+                            assistant_new_comm.cancel()
+                            await asyncio.gather(assistant_new_comm, return_exceptions=True)
+                        raise
+                    self.communication_history.append(
+                        self.format_agent_history(
+                            self.instructor, self.assistant,
+                            "Discussion with {}'s Agents: {} ".format(chosen_friend_instructor,
+                                                                      new_comm_instructor_conclusion)))
+                    await asyncio.to_thread(
+                        self.send_message_agent, self.instructor, self.assistant,
+                        "[Discussion with {}'s Agents]: {} ".format(chosen_friend_instructor,
+                                                                    new_comm_instructor_conclusion))
+                else:
+                    instructor_response = await self.instructor.aquery(self.assistant.master, self.communication_history)
+                    self.communication_history.append(
+                        self.format_agent_history(self.instructor, self.assistant, instructor_response))
+                    await asyncio.to_thread(self.send_message_agent, self.instructor, self.assistant, instructor_response)
+                await asyncio.to_thread(self.save_checkpoint, round_index, 1)
+            turn = 0
+
+            if round_index == 1:
+                # assistant starts the new communication, its conclusion joins the history after the instructor's
+                if assistant_new_comm is not None:
+                    chosen_friend_assistant, new_comm_assistant_conclusion = await assistant_new_comm
+                else:
+                    chosen_friend_assistant, new_comm_assistant_conclusion = await self.araise_new_comm(
+                        self.assistant, self.instructor)
+                self.communication_history.append(
+                    self.format_agent_history(
+                        self.assistant, self.instructor,
+                        "Discussion with {}'s Agents: {} ".format(chosen_friend_assistant,
+                                                                  new_comm_assistant_conclusion)))
+                await asyncio.to_thread(
+                    self.send_message_agent, self.assistant, self.instructor,
+                    "[Discussion with {}'s Agents]: {} ".format(chosen_friend_assistant,
+                                                                new_comm_assistant_conclusion))
+            else:
+                assistant_response = await self.assistant.aquery(self.instructor.master, self.communication_history)
+                self.communication_history.append(
+                    self.format_agent_history(self.assistant, self.instructor, assistant_response))
+                await asyncio.to_thread(self.send_message_agent, self.assistant, self.instructor, assistant_response)
+
+            self.check_stop(round_index)
+            await asyncio.to_thread(self.save_checkpoint, round_index, 2)
+
+        if self.is_consensus_conclusion:
+            conclusion = await self.aconsensus_conclusion(self.communication_history,
+                                                          self.instructor.infonav_plan,
+                                                          self.assistant.infonav_plan)
+        else:
+            conclusion = await self.instructor.aconclusion(self.communication_history)
         iAgentsLogger.log(instruction="[conclusion]:\n{}".format(conclusion))
+        await asyncio.to_thread(self.finish_checkpoint)
         return conclusion
 
 
@@ -0,0 +1,105 @@
+import os
+import threading
+
+import yaml
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+POOL_MAX_IDLE = global_config.get("agent").get("pool_max_idle", 4)
+
+
+class AgentFactory():
+    """build agents and keep the idle ones in a pool per master, for the sub-communications of multi-party communications
+
+    a released agent is reset (per-conversation state cleared) when it is acquired again, its prompts,
+    query functions, tools and retrieval resources are the shared ones of the resource registry,
+    so spawning a sub-communication from the pool does no file or index I/O.
+    """
+
+    def __init__(self, max_idle=4) -> None:
+        """init
+
+        Args:
+            max_idle (int, optional): max idle agents kept per agent type, master and settings. Defaults to 4.
+        """
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.stats = {"built": 0, "reused": 0, "released": 0, "dropped": 0}
+
+    @staticmethod
+    def get_key(agent_type, master, params):
+        return agent_type, master, tuple(sorted(params.items()))
+
+    def acquire(self, agent_type, master, task, **params):
+        """an agent of the type for the master, from the pool if one is idle
+
+        Args:
+            agent_type (type): the Agent class
+            master (str): name of the human master of agent
+            task (str): task prompt
+            **params: the other constructor arguments, e.g. backend and is_assistant
+
+        Returns:
+            Agent: an agent without per-conversation state
+        """
+        key = self.get_key(agent_type, master, params)
+        with self.lock:
+            pool = self.pools.get(key)
+            agent = pool.pop() if pool else None
+            self.stats["reused" if agent is not None else "built"] += 1
+        if agent is None:
+            return agent_type(master=master, task=task, **params)
+        agent.reset(master, task)
+        return agent
+
+    def acquire_like(self, agent, master):
+        """an agent of the same type and settings as the given one, for another master
+
+        Args:
+            agent (Agent): the agent to imitate
+            master (str): name of the human master of the new agent
+
+        Returns:
+            Agent: an agent without per-conversation state
+        """
+        params = agent.get_init_params()
+        params.pop("master")
+        task = params.pop("task")
+        return self.acquire(type(agent), master, task, **params)
+
+    def release(self, agent) -> None:
+        """return an agent which is not used anymore to the pool"""
+        params = agent.get_init_params()
+        master = params.pop("master")
+        params.pop("task")
+        key = self.get_key(type(agent), master, params)
+        with self.lock:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.max_idle and all(idle is not agent for idle in pool):
+                pool.append(agent)
+                self.stats["released"] += 1
+            else:
+                self.stats["dropped"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["idle"] = sum(len(pool) for pool in self.pools.values())
+        return stats
+
+
+_agent_factory = None
+_agent_factory_lock = threading.Lock()
+
+
+def get_agent_factory() -> AgentFactory:
+    """the process-wide agent factory, keeping at most agent.pool_max_idle idle agents per master"""
+    global _agent_factory
+    if _agent_factory is None:
+        with _agent_factory_lock:
+            if _agent_factory is None:
+                _agent_factory = AgentFactory(max_idle=POOL_MAX_IDLE)
+    return _agent_factory
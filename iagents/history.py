@@ -0,0 +1,81 @@
+import os
+import threading
+
+import yaml
+
+from iagents.prompt import HistoryBuffer
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+HISTORY_CONFIG = global_config.get("history") or {}
+
+
+class RollingHistory(HistoryBuffer):
+    """communication history whose prompt rendering stays bounded as the communication grows
+
+    the whole communication is kept (it is stored and logged as before), but prompts only get
+    the last `keep_turns` messages verbatim. Older messages are truncated: prompts get the facts
+    the agents already pinned down (MindFillTool known facts) and the first `clip_words` words of
+    each older message. Messages are clipped once, when they leave the verbatim window,
+    and only the last `max_clipped_lines` clipped messages are kept.
+    """
+
+    def __init__(self, *args, keep_turns=None, clip_words=None, max_clipped_lines=None) -> None:
+        super().__init__(*args)
+        self.keep_turns = keep_turns if keep_turns is not None else HISTORY_CONFIG.get("keep_turns", 6)
+        self.clip_words = clip_words if clip_words is not None else HISTORY_CONFIG.get("clip_words", 40)
+        self.max_clipped_lines = max_clipped_lines if max_clipped_lines is not None else \
+            HISTORY_CONFIG.get("max_clipped_lines", 20)
+        self.clipped_lines = []
+        self.clipped = 0
+        self.clipped_messages = 0
+        # the retrieval stages of a turn render the history concurrently
+        self.clip_lock = threading.Lock()
+
+    def _invalidate(self):
+        super()._invalidate()
+        with self.clip_lock:
+            self.clipped_lines = []
+            self.clipped = 0
+            self.clipped_messages = 0
+
+    def clip(self, message) -> str:
+        words = message.split()
+        if len(words) <= self.clip_words:
+            return " ".join(words)
+        return " ".join(words[:self.clip_words]) + " ..."
+
+    def render(self, known_facts="") -> str:
+        """the history as it appears in prompts
+
+        Args:
+            known_facts (str, optional): facts already known to the agent, they stand in for the details
+                cut from the older messages. Defaults to "".
+
+        Returns:
+            str: the full history while it is short, else the clipped older messages followed by the recent ones
+        """
+        if not self.keep_turns or len(self) <= self.keep_turns:
+            return self.joined()
+        clip_until = len(self) - self.keep_turns
+        with self.clip_lock:
+            for message in self[self.clipped:clip_until]:
+                if message:
+                    self.clipped_lines.append(self.clip(message))
+                    self.clipped_messages += 1
+            self.clipped = max(self.clipped, clip_until)
+            if len(self.clipped_lines) > self.max_clipped_lines:
+                del self.clipped_lines[:len(self.clipped_lines) - self.max_clipped_lines]
+            clipped_lines = list(self.clipped_lines)
+            clipped_messages = self.clipped_messages
+        if not clipped_messages:
+            return self.joined()
+        sections = ["[earlier communication, truncated ({} messages)]".format(clipped_messages)]
+        if known_facts:
+            sections.append(known_facts)
+        sections += clipped_lines
+        sections.append("[latest messages]")
+        sections += self[clip_until:]
+        return "\n".join(sections)
@@ -0,0 +1,167 @@
+import ast
+import json
+import re
+import threading
+
+CODE_FENCE = re.compile(r"```[a-zA-Z]*")
+TRAILING_COMMA = re.compile(r",\s*([}\]])")
+JSON_LITERALS = {"null": "None", "true": "True", "false": "False"}
+
+
+def extract_object(text):
+    """the first balanced {...} in the text, skipping braces inside quoted strings
+
+    LLMs often wrap the JSON in code fences or surround it with prose.
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    quote = None
+    escaped = False
+    for idx in range(start, len(text)):
+        char = text[idx]
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:idx + 1]
+    # unbalanced, most likely truncated: let the parsers report it
+    return text[start:]
+
+
+def replace_json_literals(text):
+    """null/true/false -> None/True/False outside quoted strings, so that ast.literal_eval accepts them"""
+    parts = []
+    quote = None
+    escaped = False
+    token_start = None
+    for idx, char in enumerate(text + " "):
+        if quote:
+            parts.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+            continue
+        if char.isalpha():
+            if token_start is None:
+                token_start = idx
+            continue
+        if token_start is not None:
+            token = text[token_start:idx]
+            parts.append(JSON_LITERALS.get(token, token))
+            token_start = None
+        if char in "\"'":
+            quote = char
+        parts.append(char)
+    return "".join(parts)[:-1]
+
+
+def parse_json(text):
+    """parse an LLM answer into a python object without eval
+
+    repairs code fences, prose around the object, single quotes, Python or JSON literals
+    (None/True/False, null/true/false) and trailing commas.
+
+    Args:
+        text (str): the raw LLM answer
+
+    Returns:
+        tuple[object, bool]: the parsed object and whether the text needed repairs to parse
+
+    Raises:
+        ValueError: the text could not be parsed
+    """
+    try:
+        return json.loads(text), False
+    except (TypeError, ValueError):
+        pass
+    candidate = CODE_FENCE.sub("", text).strip()
+    candidate = extract_object(candidate) or candidate
+    for attempt in (candidate, TRAILING_COMMA.sub(r"\1", candidate)):
+        try:
+            return json.loads(attempt), True
+        except ValueError:
+            pass
+        try:
+            return ast.literal_eval(attempt), True
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            pass
+        try:
+            return ast.literal_eval(replace_json_literals(attempt)), True
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            pass
+    raise ValueError("can not parse JSON from: {!r}".format(text[:200]))
+
+
+def replace_none(value, placeholder="Error"):
+    """replace null values with a placeholder string, as the prompts expect strings everywhere"""
+    if value is None:
+        return placeholder
+    if isinstance(value, dict):
+        return {key: replace_none(item, placeholder) for key, item in value.items()}
+    if isinstance(value, list):
+        return [replace_none(item, placeholder) for item in value]
+    return value
+
+
+def conform(value, json_format):
+    """check a parsed object against a reference example dict, converting scalars to str where a str is expected
+
+    Args:
+        value (object): parsed object
+        json_format (dict): reference example, every key must be present with the type of its example value
+
+    Returns:
+        dict: the conformed object, None if it does not match the reference
+    """
+    if not isinstance(value, dict):
+        return None
+    conformed = dict(value)
+    for key, example in json_format.items():
+        if key not in conformed:
+            return None
+        if isinstance(example, str) and isinstance(conformed[key], (int, float, bool)):
+            conformed[key] = str(conformed[key])
+        if not isinstance(conformed[key], type(example)):
+            return None
+    return conformed
+
+
+class JsonStats():
+    """how JSON answers were parsed, to report the fraction needing an LLM reformat round-trip"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "structured": 0, "parsed": 0, "repaired": 0, "llm_reformatted": 0,
+                      "llm_reformat_calls": 0, "failed": 0}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["llm_reformat_rate"] = stats["llm_reformatted"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
+
+
+json_stats = JsonStats()
+
+
+def get_json_stats() -> dict:
+    return json_stats.get_stats()
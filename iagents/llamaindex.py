@@ -1,19 +1,4 @@
 import os
-from llama_index.core import (VectorStoreIndex, StorageContext,
-                              load_index_from_storage)
-from llama_index.readers.file import (
-    DocxReader,
-    HWPReader,
-    PDFReader,
-    EpubReader,
-    FlatReader,
-    HTMLTagReader,
-    IPYNBReader,
-    MarkdownReader,
-    MboxReader,
-    PandasCSVReader,
-    XMLReader,
-)
 from pathlib import Path
 import yaml
 
@@ -21,38 +6,54 @@ file_path = os.path.dirname(__file__)
 project_path = os.path.dirname(file_path)
 global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
 
-from backend.third_party import *
-from backend.third_party_embedding import *
-from backend.gpt import *
-
-
-file_path = os.path.dirname(__file__)
-project_path = os.path.dirname(file_path)
 
 class LlamaIndexer():
 
     def __init__(self, username) -> None:
+        # llama_index and the provider SDKs are imported here instead of at module level to keep startup fast
+        from llama_index.core import VectorStoreIndex
+        from llama_index.readers.file import (
+            DocxReader,
+            HWPReader,
+            PDFReader,
+            EpubReader,
+            FlatReader,
+            HTMLTagReader,
+            IPYNBReader,
+            MarkdownReader,
+            MboxReader,
+            PandasCSVReader,
+            XMLReader,
+        )
+
         if global_config.get("backend").get("provider") == "ollama":
-            from backend.ollama import ollama_model, ollama_embed_model
-            self.llm = ollama_model
-            self.embed_model = ollama_embed_model
+            from backend.ollama import get_ollama_embed_model, get_ollama_model
+            self.llm = get_ollama_model()
+            self.embed_model = get_ollama_embed_model()
         elif global_config.get("backend").get("provider") == "deepseek":
-            self.llm = client_deepseek_llama_index
             raise NotImplementedError("DEEPSEEK backend for llama_index not implemented")
         elif global_config.get("backend").get("provider") == "qwen":
-            self.llm = client_qwen_llama_index
-            self.embed_model = dashscope_embedder
+            from backend.third_party import get_llama_index_llm
+            from backend.third_party_embedding import get_dashscope_embedder
+            self.llm = get_llama_index_llm("qwen")
+            self.embed_model = get_dashscope_embedder()
         elif global_config.get("backend").get("provider") == "glm":
-            self.llm = client_glm_llama_index
+            from backend.third_party import get_llama_index_llm
+            from backend.third_party_embedding import ZhipuEmbeddings
+            self.llm = get_llama_index_llm("glm")
             self.embed_model = ZhipuEmbeddings()
         elif global_config.get("backend").get("provider") == "hunyuan":
-            self.llm = client_hunyuan_llama_index
             raise NotImplementedError("HUNYUAN backend for llama_index not implemented")
         elif global_config.get("backend").get("provider") == "spark":
-            self.llm = client_spark_llama_index
             raise NotImplementedError("SPARK backend for llama_index not implemented")
         elif global_config.get("backend").get("provider") == "ernie":
             raise NotImplementedError("ERNIE backend for llama_index not implemented")
+        elif global_config.get("backend").get("provider") == "replay":
+            # offline benchmarking: deterministic mock models, no network
+            from llama_index.core.embeddings import MockEmbedding
+            from llama_index.core.llms import MockLLM
+            self.llm = MockLLM()
+            self.embed_model = MockEmbedding(embed_dim=256)
         
         self.username = username
 
@@ -98,6 +99,7 @@ class LlamaIndexer():
                 f.write(file + "\n")
 
     def get_index(self):
+        from llama_index.core import StorageContext, VectorStoreIndex, load_index_from_storage
         if os.listdir(self.persist_dir):
             storage_context = StorageContext.from_defaults(persist_dir=self.persist_dir)
             self.index = load_index_from_storage(storage_context, embed_model=self.embed_model)
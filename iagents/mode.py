@@ -1,5 +1,16 @@
 from iagents.agent import *
 from iagents.communication import *
+from backend.cache import get_llm_cache, get_singleflight
+from backend.governor import get_governor_stats
+from backend.hedging import get_hedging_stats
+from backend.registry import get_startup_times
+from backend.resilience import get_circuit_states
+from iagents.checkpoint import get_checkpoint_store, make_checkpoint_id
+from iagents.factory import get_agent_factory
+from iagents.jsonparse import get_json_stats
+from iagents.packer import get_packer_stats
+from iagents.profile import get_profile_cache
+from iagents.resources import get_resources
 import logging
 
 # load global config
@@ -34,41 +45,17 @@ class Mode():
         self.user_directory_root = user_directory_root
 
         # load backend
-        if self.backend == "gemini":
-            self.query_func = query_gemini
-        elif self.backend == "gpt":
-            self.query_func = query_gpt
-        elif self.backend == "gpt4":
-            self.query_func = query_gpt4
-        elif self.backend == "claude":
-            self.query_func = query_claude
-        elif self.backend == "ollama":
-            self.query_func = query_ollama
-        elif self.backend == "deepseek":
-            self.query_func = query_deepseek
-        elif self.backend == "qwen":
-            self.query_func = query_qwen
-        elif self.backend == "ernie":
-            self.query_func = query_ernie
-        elif self.backend == "glm":
-            self.query_func = query_glm
-        elif self.backend == "hunyuan":
-            self.query_func = query_hunyuan
-        elif self.backend == "spark":
-            self.query_func = query_spark
-        else:
-            raise ValueError("{} backend not implemented".format(self.backend))
+        self.query_func = get_resources().get_query_funcs(self.backend)[0]
 
         # load tool prompts
-        with open(os.path.join(project_path, "prompts", "tool_prompt.json"), "r") as f:
-            self.tool_prompt = json.load(f)
+        self.tool_templates = get_resources().get_prompt_templates("tool_prompt.json")
 
         # rewrite the task
         if self.rewrite_prompt:
-            query_prompt = "\n".join(self.tool_prompt['rewrite_task']).format(sender=sender,
+            query_prompt = self.tool_templates['rewrite_task'].format(sender=sender,
                                                                               receiver=receiver,
                                                                               task=self.task)
-            self.task = self.query_func(query_prompt)
+            self.task = self.query_func(query_prompt, call_site="rewrite_task")
             iAgentsLogger.log(query_prompt, self.task, "[rewrite task]")
 
         self.realized_modes = {"Base", "RAG"}
@@ -81,6 +68,24 @@ class Mode():
         global_config_str += "Global Agent Config:\n{}".format(str(self.global_config.get("agent"))) + "\n"
         global_config_str += "Global Mode Config:\n{}".format(str(self.global_config.get("mode"))) + "\n"
         global_config_str += "Global Database Config:\n{}".format(str(self.global_config.get("mysql").get("database"))) + "\n"
+        global_config_str += "Backend Startup Time (s):\n{}".format(str(get_startup_times())) + "\n"
+        global_config_str += "Backend Governor Stats:\n{}".format(str(get_governor_stats())) + "\n"
+        global_config_str += "Backend Circuit States:\n{}".format(str(get_circuit_states())) + "\n"
+        if self.global_config.get("hedging", {}).get("enable", False):
+            global_config_str += "Backend Hedging Stats:\n{}".format(str(get_hedging_stats())) + "\n"
+        if self.backend == "replay":
+            from backend.replay import get_cassette
+            global_config_str += "Replay Stats:\n{}".format(str(get_cassette().get_stats())) + "\n"
+        if get_singleflight() is not None:
+            global_config_str += "LLM Single-flight Stats:\n{}".format(str(get_singleflight().get_stats())) + "\n"
+        if get_llm_cache() is not None:
+            global_config_str += "LLM Cache Stats:\n{}".format(str(get_llm_cache().get_stats())) + "\n"
+        global_config_str += "JSON Parsing Stats:\n{}".format(str(get_json_stats())) + "\n"
+        global_config_str += "Context Packer Stats:\n{}".format(str(get_packer_stats())) + "\n"
+        global_config_str += "Profile Cache Stats:\n{}".format(str(get_profile_cache().get_stats())) + "\n"
+        global_config_str += "Agent Pool Stats:\n{}".format(str(get_agent_factory().get_stats())) + "\n"
+        if get_checkpoint_store() is not None:
+            global_config_str += "Checkpoint Stats:\n{}".format(str(get_checkpoint_store().get_stats())) + "\n"
         iAgentsLogger.log(instruction=global_config_str)
 
     def get_instructor_agent(self):
@@ -95,7 +100,7 @@ class Mode():
         elif self.mode_name in {'RAG'}:
             return MemoryAgent(master=self.receiver, backend=self.backend, task=self.task, is_assistant=True)
 
-    def get_communication(self, is_offline=False):
+    def get_communication(self, is_offline=False, checkpoint_id=None):
         """choose communication
 
         some combinations:
@@ -107,6 +112,9 @@ class Mode():
 
         Args:
             is_offline (bool, optional): whether offline. Defaults to False.
+            checkpoint_id (str, optional): checkpoint id of an online communication, its last checkpoint is resumed
+                unless another worker is running it.
+                Defaults to the id of this sender, receiver and task.
 
         Returns:
             Communication: constructed communication based on the mode
@@ -127,6 +135,7 @@ class Mode():
                     assistant=assistant_agent,
                     max_round=global_config.get("agent").get("max_communication_turns"),
                     is_consensus_conclusion=True)
+                comm.set_checkpoint(checkpoint_id or make_checkpoint_id(self.sender, self.receiver, self.raw_task))
 
         # print the rewritten task
         # if self.rewrite_prompt:
@@ -0,0 +1,149 @@
+import os
+import threading
+
+import yaml
+
+from backend.tokens import count_prompt_tokens, get_encoding
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+PACKER_CONFIG = global_config.get("packer") or {}
+DEFAULT_BUDGETS = {"current_memory": 1500, "distinct_memory": 1500, "fuzzy_memory": 800, "llamaindex_memory": 800}
+DEFAULT_WEIGHTS = {"hits": 1.0, "recency": 0.5, "distance": 0.25}
+
+
+class ContextPacker():
+    """fill the retrieved context sections of a prompt up to a token budget per section
+
+    chat messages are deduplicated by id and ranked by keyword hits, recency and distance
+    to the nearest hit, the best ones that fit are kept in chat order. Text sections
+    (FAISS summaries, LlamaIndex answers) keep their relevance order and are cut at the budget.
+    """
+
+    def __init__(self, model, budgets=None, weights=None) -> None:
+        self.model = model
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, section, candidates, kept, tokens):
+        with self.lock:
+            stats = self.stats.setdefault(section, {"packs": 0, "candidates": 0, "kept": 0, "dropped": 0,
+                                                    "tokens": 0})
+            stats["packs"] += 1
+            stats["candidates"] += candidates
+            stats["kept"] += kept
+            stats["dropped"] += candidates - kept
+            stats["tokens"] += tokens
+
+    def rank_messages(self, contexts, scores) -> list:
+        """rank the messages of get_context_bykeywords, best first
+
+        Args:
+            contexts (dict): keyword to (id, timestamp, sender, receiver, message) rows
+            scores (dict): message id to the number of keywords whose windows contain it
+
+        Returns:
+            list[tuple]: deduplicated rows, best ranked first
+        """
+        messages = {}
+        hit_positions = []
+        for rows in contexts.values():
+            for row in rows:
+                messages.setdefault(row[0], row)
+        message_ids = sorted(messages)
+        for position, message_id in enumerate(message_ids):
+            text = str(messages[message_id][4]).lower()
+            if any(keyword.lower() in text for keyword in contexts):
+                hit_positions.append(position)
+
+        def score(position):
+            message_id = message_ids[position]
+            recency = position / (len(message_ids) - 1) if len(message_ids) > 1 else 1.0
+            distance = min((abs(position - hit) for hit in hit_positions), default=0)
+            return (self.weights["hits"] * scores.get(message_id, 1)
+                    + self.weights["recency"] * recency
+                    - self.weights["distance"] * distance)
+        ranked = sorted(range(len(message_ids)), key=lambda position: (-score(position), -position))
+        return [messages[message_ids[position]] for position in ranked]
+
+    def pack_messages(self, section, contexts, scores, render) -> list:
+        """the best ranked messages within the section budget, in chat order
+
+        Args:
+            section (str): section name, the key of its budget in `packer.budgets`
+            contexts (dict): keyword to (id, timestamp, sender, receiver, message) rows
+            scores (dict): message id to hit score
+            render (callable): renders a row as it appears in the prompt, to count its tokens
+
+        Returns:
+            list[tuple]: kept rows in chat order
+        """
+        ranked = self.rank_messages(contexts, scores)
+        budget = self.budgets.get(section)
+        kept = []
+        tokens = 0
+        for row in ranked:
+            row_tokens = count_prompt_tokens(render(row), self.model)
+            if budget is not None and tokens + row_tokens > budget:
+                continue
+            kept.append(row)
+            tokens += row_tokens
+        self.record(section, len(ranked), len(kept), tokens)
+        return sorted(kept, key=lambda row: row[0])
+
+    def pack_texts(self, section, texts) -> list:
+        """the leading texts (in relevance order) within the section budget, the first text that
+        does not fit is cut at the budget
+
+        Args:
+            section (str): section name, the key of its budget in `packer.budgets`
+            texts (list[str]): texts, most relevant first
+
+        Returns:
+            list[str]: kept texts
+        """
+        budget = self.budgets.get(section)
+        kept = []
+        tokens = 0
+        for text in texts:
+            text = str(text)
+            text_tokens = count_prompt_tokens(text, self.model)
+            if budget is not None and tokens + text_tokens > budget:
+                remaining = budget - tokens
+                if remaining > 0:
+                    encoding = get_encoding(self.model)
+                    kept.append(encoding.decode(encoding.encode(text, disallowed_special=())[:remaining]))
+                    tokens += remaining
+                break
+            kept.append(text)
+            tokens += text_tokens
+        self.record(section, len(texts), len(kept), tokens)
+        return kept
+
+    def get_stats(self):
+        """packs, candidates, kept and dropped candidates and packed tokens per section"""
+        with self.lock:
+            return {section: dict(stats) for section, stats in self.stats.items()}
+
+
+_packers = {}
+_packers_lock = threading.Lock()
+
+
+def get_context_packer(model) -> ContextPacker:
+    """the process-wide context packer of a model, with the budgets and weights of the `packer` config"""
+    if model not in _packers:
+        with _packers_lock:
+            if model not in _packers:
+                _packers[model] = ContextPacker(model,
+                                                budgets=PACKER_CONFIG.get("budgets"),
+                                                weights=PACKER_CONFIG.get("weights"))
+    return _packers[model]
+
+
+def get_packer_stats() -> dict:
+    return {model: packer.get_stats() for model, packer in list(_packers.items())}
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import yaml
+
+from iagents.sql import exec_sql
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+PROFILE_CACHE_CONFIG = global_config.get("profile_cache") or {}
+
+# columns of the users table served from the cache
+USER_FIELDS = ("system_prompt", "profile_image_path", "agent_profile_image_path")
+
+
+class ProfileCache():
+    """per-worker cache of user profile data: agent profile prompts, avatar paths and friend lists
+
+    entries are updated by the write paths of this worker (cultivate, avatar upload) and dropped
+    when friendships change; the TTL bounds how long a write made by another worker stays unseen.
+    """
+
+    def __init__(self, ttl=300, max_entries=10000) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "updates": 0, "invalidations": 0}
+
+    def get(self, kind, name, loader):
+        """the cached value of (kind, name), `loader()` is called on a miss or an expired entry"""
+        key = (kind, name)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (not self.ttl or now - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+        value = loader()
+        self._put(key, value, now)
+        return value
+
+    def set(self, kind, name, value):
+        """write-through after the database row was updated"""
+        self._put((kind, name), value, time.monotonic())
+        with self.lock:
+            self.stats["updates"] += 1
+
+    def invalidate(self, kind, name):
+        with self.lock:
+            if self.entries.pop((kind, name), None) is not None:
+                self.stats["invalidations"] += 1
+
+    def invalidate_user(self, name):
+        for kind in USER_FIELDS + ("friends",):
+            self.invalidate(kind, name)
+
+    def _put(self, key, value, created_at):
+        with self.lock:
+            self.entries[key] = (created_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+        return stats
+
+
+_profile_cache = None
+_profile_cache_lock = threading.Lock()
+
+
+def get_profile_cache() -> ProfileCache:
+    """the process-wide profile cache"""
+    global _profile_cache
+    if _profile_cache is None:
+        with _profile_cache_lock:
+            if _profile_cache is None:
+                _profile_cache = ProfileCache(ttl=PROFILE_CACHE_CONFIG.get("ttl", 300),
+                                              max_entries=PROFILE_CACHE_CONFIG.get("max_entries", 10000))
+    return _profile_cache
+
+
+def get_user_field(field, name):
+    """cached column of a user's row, None if the user does not exist
+
+    Args:
+        field (str): one of USER_FIELDS
+        name (str): user name
+
+    Returns:
+        str: the column value
+    """
+    assert field in USER_FIELDS, "{} is not a cached user field".format(field)
+
+    def load():
+        result = exec_sql("SELECT {} FROM users WHERE name=%s".format(field), params=(name,))
+        return result[0][0] if result else None
+    return get_profile_cache().get(field, name, load)
+
+
+def get_friend_names(name) -> list:
+    """cached names of a user's friends
+
+    Args:
+        name (str): user name
+
+    Returns:
+        list[tuple[str]]: one (name,) row per friend, as returned by the friends query
+    """
+    def load():
+        return tuple(exec_sql("""
+        SELECT users.name
+            FROM friendships
+            JOIN users ON friendships.friend_id = users.id
+            WHERE friendships.user_id = (
+                SELECT id FROM users WHERE name = %s
+            )
+        """, params=(name,)))
+    return list(get_profile_cache().get("friends", name, load))
@@ -0,0 +1,141 @@
+import json
+import threading
+from string import Formatter
+
+
+class PromptTemplate():
+    """a prompt section compiled once from its list-of-lines JSON form
+
+    the lines are joined and the format string is parsed at compile time,
+    `format` only concatenates the literal parts with the given values.
+    """
+
+    def __init__(self, lines) -> None:
+        self.text = "\n".join(lines) if isinstance(lines, list) else lines
+        self.parts = []
+        self.simple = True
+        for literal, field_name, format_spec, conversion in Formatter().parse(self.text):
+            if field_name is not None and (format_spec or conversion or not field_name.isidentifier()):
+                # indexed/attribute fields or format specs: leave them to str.format
+                self.simple = False
+            self.parts.append((literal, field_name))
+        self.field_names = {field_name for _, field_name in self.parts if field_name}
+
+    def format(self, **kwargs) -> str:
+        """same result as `self.text.format(**kwargs)`"""
+        if not self.simple:
+            return self.text.format(**kwargs)
+        rendered = []
+        for literal, field_name in self.parts:
+            rendered.append(literal)
+            if field_name is not None:
+                rendered.append(str(kwargs[field_name]))
+        return "".join(rendered)
+
+    def __str__(self) -> str:
+        return self.text
+
+
+def compile_prompt_file(path) -> dict:
+    """compile every section of a prompt file, see ResourceRegistry.get_prompt_templates for the cached version
+
+    Args:
+        path (str): path of the JSON prompt file
+
+    Returns:
+        dict[str, PromptTemplate]: section name to compiled template
+    """
+    with open(path, "r") as f:
+        return {name: PromptTemplate(lines) for name, lines in json.load(f).items()}
+
+
+class HistoryBuffer(list):
+    """append-only communication history which renders itself incrementally
+
+    `joined()` equals `"\\n".join(self)`, but only the entries appended since the last call
+    are concatenated; any other mutation drops the rendered text. The retrieval stages of a turn
+    render the history concurrently, the rendered text is updated under a lock.
+    """
+
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+        self._render_lock = threading.Lock()
+        self._rendered = None
+        self._rendered_len = 0
+
+    def joined(self) -> str:
+        with self._render_lock:
+            entries = self[:]
+            rendered = self._rendered
+            if rendered is None or self._rendered_len == 0 or len(entries) < self._rendered_len:
+                rendered = "\n".join(entries)
+            elif len(entries) > self._rendered_len:
+                rendered = "\n".join([rendered] + entries[self._rendered_len:])
+            self._rendered, self._rendered_len = rendered, len(entries)
+        return rendered
+
+    def render(self, known_facts="") -> str:
+        """the history as it appears in prompts, see RollingHistory for a bounded rendering"""
+        return self.joined()
+
+    # the rendered text is dropped after the mutation, so a concurrent joined() can not keep the old entries
+
+    def _invalidate(self):
+        with self._render_lock:
+            self._rendered = None
+
+    def __setitem__(self, *args):
+        super().__setitem__(*args)
+        self._invalidate()
+
+    def __delitem__(self, *args):
+        super().__delitem__(*args)
+        self._invalidate()
+
+    def insert(self, *args):
+        super().insert(*args)
+        self._invalidate()
+
+    def remove(self, *args):
+        super().remove(*args)
+        self._invalidate()
+
+    def pop(self, *args):
+        item = super().pop(*args)
+        self._invalidate()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._invalidate()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._invalidate()
+
+    def reverse(self):
+        super().reverse()
+        self._invalidate()
+
+
+def render_history(communication_history, known_facts="") -> str:
+    """join the communication history with newlines, incrementally (and bounded for a RollingHistory) for a HistoryBuffer
+
+    Args:
+        communication_history (list[str]): the chat history between two agents
+        known_facts (str, optional): facts known to the agent, they stand in for the truncated messages. Defaults to "".
+    """
+    if isinstance(communication_history, HistoryBuffer):
+        return communication_history.render(known_facts)
+    return "\n".join(communication_history)
+
+
+def render_full_history(communication_history) -> str:
+    """the whole communication history without folding, for the conclusion prompts which reason over every message
+
+    Args:
+        communication_history (list[str]): the chat history between two agents
+    """
+    if isinstance(communication_history, HistoryBuffer):
+        return communication_history.joined()
+    return "\n".join(communication_history)
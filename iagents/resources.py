@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+import time
+
+import yaml
+
+from iagents.prompt import compile_prompt_file
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+RESOURCES_CONFIG = global_config.get("resources") or {}
+
+
+def load_stopwords(path) -> frozenset:
+    with open(path, "r") as f:
+        return frozenset(line.strip() for line in f)
+
+
+class ResourceRegistry():
+    """process-wide, read-only resources shared by every agent, communication and tool
+
+    prompt templates, stopwords, FAISS memories and LlamaIndexers are loaded once and reloaded when their
+    file (or the user's upload directory) changes (the mtime is checked at most every `resources.check_interval`
+    seconds). Stateless tools and query functions are built once per backend, so building an agent only
+    allocates its own per-conversation state.
+    """
+
+    def __init__(self, check_interval=2.0) -> None:
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.files = {}
+        self.objects = {}
+        self.stats = {"loads": 0, "reloads": 0, "reload_errors": 0}
+
+    def _load(self, path, loader):
+        """the cached result of `loader(path)`, loaded again if the file changed since
+
+        a failed reload (e.g. a prompt file caught in the middle of a save) keeps the previous version.
+        """
+        now = time.monotonic()
+        entry = self.files.get(path)
+        if entry is not None and now - entry["checked_at"] < self.check_interval:
+            return entry["value"]
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None and now - entry["checked_at"] < self.check_interval:
+                return entry["value"]
+            mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            if entry is not None and entry["mtime"] == mtime:
+                entry["checked_at"] = now
+                return entry["value"]
+            try:
+                value = loader(path)
+            except Exception as e:
+                if entry is None:
+                    raise
+                self.stats["reload_errors"] += 1
+                logging.warning("failed to reload {}, keeping the loaded version: {!r}".format(path, e))
+                entry["checked_at"] = now
+                return entry["value"]
+            if entry is None:
+                self.stats["loads"] += 1
+            else:
+                self.stats["reloads"] += 1
+                logging.info("reloaded {}".format(path))
+            self.files[path] = {"mtime": mtime, "checked_at": now, "value": value}
+            return value
+
+    def _get_object(self, key, builder):
+        """build an object once per key"""
+        if key not in self.objects:
+            with self.lock:
+                if key not in self.objects:
+                    self.objects[key] = builder()
+        return self.objects[key]
+
+    def get_prompt_templates(self, filename) -> dict:
+        """compiled templates of a prompt file in `prompts/`, e.g. "tool_prompt.json"
+
+        Returns:
+            dict[str, PromptTemplate]: section name to compiled template
+        """
+        return self._load(os.path.join(project_path, "prompts", filename), compile_prompt_file)
+
+    def get_stopwords(self) -> frozenset:
+        return self._load(os.path.join(project_path, "iagents", "stopwords.txt"), load_stopwords)
+
+    def get_query_funcs(self, backend):
+        """(sync, async) cached query functions of a backend, with streaming and structured output on the sync one"""
+        def build():
+            from backend.cache import AsyncCachedQueryFunc, CachedQueryFunc
+            from backend.registry import (get_aquery_func, get_provider, get_query_func, get_stream_func,
+                                          get_structured_func)
+            model = get_provider(backend).model
+            return (CachedQueryFunc(get_query_func(backend), provider=backend, model=model,
+                                    stream_func=get_stream_func(backend),
+                                    structured_func=get_structured_func(backend)),
+                    AsyncCachedQueryFunc(get_aquery_func(backend), provider=backend, model=model))
+        return self._get_object(("query_funcs", backend), build)
+
+    def get_sql_tool(self):
+        from iagents.tool import SqlTool
+        return self._get_object(("sql_tool",), SqlTool)
+
+    def get_json_tool(self, backend):
+        from iagents.tool import JsonFormatTool
+        return self._get_object(("json_tool", backend),
+                                lambda: JsonFormatTool(self.get_query_funcs(backend)[0]))
+
+    def get_faiss_tool(self, memory_file_path):
+        """FAISS memory of one memory file, rebuilt when the file changes"""
+        from iagents.tool import FaissTool
+        return self._load(memory_file_path, FaissTool)
+
+    def get_llamaindexer(self, username):
+        """LlamaIndexer of a user, rebuilt when files are uploaded to or deleted from the user's directory"""
+        from iagents.llamaindex import LlamaIndexer
+        user_directory = os.path.join(project_path, "userfiles", username)
+        # made here, so that building the indexer does not change the mtime of the directory
+        os.makedirs(os.path.join(user_directory, "storage"), exist_ok=True)
+        return self._load(user_directory, lambda path: LlamaIndexer(username))
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["files"] = len(self.files)
+            stats["objects"] = len(self.objects)
+        return stats
+
+
+_resources = None
+_resources_lock = threading.Lock()
+
+
+def get_resources() -> ResourceRegistry:
+    """the process-wide resource registry"""
+    global _resources
+    if _resources is None:
+        with _resources_lock:
+            if _resources is None:
+                _resources = ResourceRegistry(check_interval=RESOURCES_CONFIG.get("check_interval", 2.0))
+    return _resources
@@ -0,0 +1,134 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import yaml
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+RETRIEVAL_WORKERS = global_config.get("agent").get("retrieval_workers", 8)
+SUB_COMMUNICATION_WORKERS = global_config.get("agent").get("sub_communication_workers", 2)
+FAN_OUT_WORKERS = (global_config.get("fan_out") or {}).get("workers", 4)
+
+
+class RetrievalExecutor():
+    """run independent retrieval stages (SQL lookups, sql_react/faiss_react calls, LlamaIndex queries) concurrently
+
+    stages are (name, callable) pairs, results are returned in stage order whatever order they finish in,
+    so the assembled prompt is deterministic. The first stage runs in the calling thread.
+    Stages started from inside a stage run serially, so nested retrieval can not exhaust the pool.
+    """
+
+    def __init__(self, max_workers=8, thread_name_prefix="retrieval") -> None:
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _run_stage(self, name, func):
+        in_stage = getattr(self.local, "in_stage", False)
+        self.local.in_stage = True
+        start_time = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.local.in_stage = in_stage
+            elapsed = time.perf_counter() - start_time
+            with self.lock:
+                stats = self.stats.setdefault(name, {"calls": 0, "total_time": 0.0, "max_time": 0.0})
+                stats["calls"] += 1
+                stats["total_time"] += elapsed
+                stats["max_time"] = max(stats["max_time"], elapsed)
+
+    def run(self, stages) -> list:
+        """run the stages and return their results in stage order
+
+        Args:
+            stages (list[tuple[str, callable]]): (stage name, function without arguments)
+
+        Returns:
+            list: result of every stage, the error of the first failed stage (in stage order) is raised
+        """
+        if len(stages) <= 1 or getattr(self.local, "in_stage", False):
+            return [self._run_stage(name, func) for name, func in stages]
+        futures = [self.submit(name, func) for name, func in stages[1:]]
+        first_name, first_func = stages[0]
+        results = [self._run_stage(first_name, first_func)]
+        results += [future.result() for future in futures]
+        return results
+
+    def submit(self, name, func) -> Future:
+        """start one stage in the background, in a copy of the caller's context (e.g. its governor flow)"""
+        return self.pool.submit(contextvars.copy_context().run, self._run_stage, name, func)
+
+    def start(self, stages) -> list:
+        """start all stages in the background, e.g. to overlap them with LLM calls
+
+        Args:
+            stages (list[tuple[str, callable]]): (stage name, function without arguments)
+
+        Returns:
+            list[Future]: futures of the stages, in stage order
+        """
+        return [self.submit(name, func) for name, func in stages]
+
+    def get_stats(self):
+        """calls, total and max seconds per stage name"""
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+
+_retrieval_executor = None
+_retrieval_executor_lock = threading.Lock()
+
+
+def get_retrieval_executor() -> RetrievalExecutor:
+    """the process-wide retrieval executor, sized by agent.retrieval_workers"""
+    global _retrieval_executor
+    if _retrieval_executor is None:
+        with _retrieval_executor_lock:
+            if _retrieval_executor is None:
+                _retrieval_executor = RetrievalExecutor(max_workers=RETRIEVAL_WORKERS)
+    return _retrieval_executor
+
+
+_sub_communication_executor = None
+
+
+def get_sub_communication_executor():
+    """the process-wide executor running the sub-communications raised by multi-party communications
+    alongside each other, sized by agent.sub_communication_workers
+
+    Returns:
+        RetrievalExecutor: the shared executor, None if sub-communications run one after another
+    """
+    global _sub_communication_executor
+    if not SUB_COMMUNICATION_WORKERS:
+        return None
+    if _sub_communication_executor is None:
+        with _retrieval_executor_lock:
+            if _sub_communication_executor is None:
+                _sub_communication_executor = RetrievalExecutor(max_workers=SUB_COMMUNICATION_WORKERS,
+                                                                thread_name_prefix="sub_communication")
+    return _sub_communication_executor
+
+
+_fan_out_executor = None
+
+
+def get_fan_out_executor() -> RetrievalExecutor:
+    """the process-wide executor running the parallel sub-communications of a fan-out, sized by fan_out.workers
+
+    it is not the sub-communication executor, so a fan-out started from a sub-communication thread still runs in parallel.
+    """
+    global _fan_out_executor
+    if _fan_out_executor is None:
+        with _retrieval_executor_lock:
+            if _fan_out_executor is None:
+                _fan_out_executor = RetrievalExecutor(max_workers=max(FAN_OUT_WORKERS, 1),
+                                                      thread_name_prefix="fan_out")
+    return _fan_out_executor
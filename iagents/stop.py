@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import yaml
+
+file_path = os.path.dirname(__file__)
+project_path = os.path.dirname(file_path)
+global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.yaml"), "r"))
+
+STOP_POLICY_CONFIG = global_config.get("stop_policy") or {}
+
+
+class StopPolicy(ABC):
+    """decides after each round whether a communication can skip its remaining rounds and conclude"""
+
+    name = "stop_policy"
+
+    def start(self, communication):
+        """called when the communication starts"""
+        pass
+
+    @abstractmethod
+    def check(self, communication, round_index):
+        """check the communication after a round
+
+        Args:
+            communication (BaseCommunication): the running communication
+            round_index (int): number of rounds done
+
+        Returns:
+            str: the reason to stop, None to go on
+        """
+        pass
+
+
+def get_infonav_agents(communication) -> list:
+    """the agents of the communication which hold an InfoNav plan"""
+    return [agent for agent in (communication.instructor, communication.assistant)
+            if getattr(agent, "infonav_plan", "")]
+
+
+class FactsResolvedPolicy(StopPolicy):
+    """stop once every fact of both agents' InfoNav plans is resolved"""
+
+    name = "facts_resolved"
+
+    def check(self, communication, round_index):
+        agents = get_infonav_agents(communication)
+        if len(agents) < 2:
+            return None
+        known = sum(len(agent.mindfill_tool.know_facts) for agent in agents)
+        # a plan without any marked fact has nothing to resolve, keep talking
+        if known and all(not agent.mindfill_tool.unknown_facts for agent in agents):
+            return "all InfoNav facts resolved ({} known facts)".format(known)
+        return None
+
+
+class NoProgressPolicy(StopPolicy):
+    """stop when no new fact was pinned down for `patience` rounds"""
+
+    name = "no_progress"
+
+    def __init__(self, patience=2) -> None:
+        self.patience = patience
+        self.known_facts = 0
+        self.stale_rounds = 0
+
+    def start(self, communication):
+        self.known_facts = 0
+        self.stale_rounds = 0
+
+    def check(self, communication, round_index):
+        agents = get_infonav_agents(communication)
+        if not agents or not self.patience:
+            return None
+        known_facts = sum(len(agent.mindfill_tool.know_facts) for agent in agents)
+        if known_facts > self.known_facts:
+            self.known_facts = known_facts
+            self.stale_rounds = 0
+            return None
+        self.stale_rounds += 1
+        if self.stale_rounds >= self.patience:
+            return "no new fact for {} rounds ({} known facts)".format(self.stale_rounds, known_facts)
+        return None
+
+
+class BudgetPolicy(StopPolicy):
+    """stop when the communication history or the elapsed time exceeds its budget, 0 for no budget
+
+    the token budget counts the tokens of the messages in the communication history, not the
+    tokens spent on LLM calls (prompts with their retrieved context, tool calls, sub-communications).
+    """
+
+    name = "budget"
+
+    def __init__(self, max_history_tokens=0, max_seconds=0) -> None:
+        self.max_history_tokens = max_history_tokens
+        self.max_seconds = max_seconds
+        self.start_time = time.perf_counter()
+
+    def start(self, communication):
+        self.start_time = time.perf_counter()
+
+    def check(self, communication, round_index):
+        if self.max_history_tokens:
+            history_tokens = communication.get_history_tokens()
+            if history_tokens >= self.max_history_tokens:
+                return "history token budget spent ({} >= {})".format(history_tokens, self.max_history_tokens)
+        if self.max_seconds:
+            elapsed = time.perf_counter() - self.start_time
+            if elapsed >= self.max_seconds:
+                return "time budget spent ({:.1f}s >= {}s)".format(elapsed, self.max_seconds)
+        return None
+
+
+STOP_POLICIES = {
+    FactsResolvedPolicy.name: lambda config: FactsResolvedPolicy(),
+    NoProgressPolicy.name: lambda config: NoProgressPolicy(patience=config.get("patience", 2)),
+    BudgetPolicy.name: lambda config: BudgetPolicy(max_history_tokens=config.get("max_history_tokens", 0),
+                                                   max_seconds=config.get("max_seconds", 0)),
+}
+
+
+def build_stop_policies(config=None) -> list:
+    """the stop policies named in `stop_policy.policies`, a new instance per communication
+
+    Args:
+        config (dict, optional): stop policy config. Defaults to the `stop_policy` section of global config.
+
+    Returns:
+        list[StopPolicy]: the policies
+    """
+    config = STOP_POLICY_CONFIG if config is None else config
+    policies = []
+    for name in config.get("policies") or []:
+        if name not in STOP_POLICIES:
+            raise ValueError("stop policy {} not implemented, choose from {}".format(name, list(STOP_POLICIES)))
+        policies.append(STOP_POLICIES[name](config))
+    return policies
+
+
+class FanOutBudget():
+    """token and time budget shared by the sub-communications of one fan-out, which also stops the
+    stragglers once enough facts are gathered
+
+    the first sub-communication which resolves all its InfoNav facts, or the sub-communications together
+    knowing `enough_facts` facts, or the budget being spent, stops every sub-communication at its next check.
+    """
+
+    def __init__(self, max_history_tokens=0, max_seconds=0, enough_facts=0) -> None:
+        self.max_history_tokens = max_history_tokens
+        self.max_seconds = max_seconds
+        self.enough_facts = enough_facts
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.history_tokens = {}
+        self.known_facts = {}
+        self.reason = None
+
+    def update(self, communication, round_index):
+        """record the progress of a sub-communication
+
+        Args:
+            communication (BaseCommunication): the sub-communication
+            round_index (int): number of rounds done
+
+        Returns:
+            str: the reason to stop the sub-communications, None to go on
+        """
+        history_tokens = communication.get_history_tokens()
+        known_facts = sum(len(agent.mindfill_tool.know_facts) for agent in get_infonav_agents(communication))
+        resolved = FactsResolvedPolicy().check(communication, round_index)
+        with self.lock:
+            self.history_tokens[id(communication)] = history_tokens
+            self.known_facts[id(communication)] = known_facts
+            if self.reason:
+                return self.reason
+            total_tokens = sum(self.history_tokens.values())
+            total_facts = sum(self.known_facts.values())
+            elapsed = time.perf_counter() - self.start_time
+            if resolved:
+                self.reason = "{}'s Agent resolved its InfoNav facts".format(communication.assistant.master)
+            elif self.enough_facts and total_facts >= self.enough_facts:
+                self.reason = "enough facts gathered ({} >= {})".format(total_facts, self.enough_facts)
+            elif self.max_history_tokens and total_tokens >= self.max_history_tokens:
+                self.reason = "token budget spent ({} >= {})".format(total_tokens, self.max_history_tokens)
+            elif self.max_seconds and elapsed >= self.max_seconds:
+                self.reason = "time budget spent ({:.1f}s >= {}s)".format(elapsed, self.max_seconds)
+            return self.reason
+
+    def cancel(self, reason) -> None:
+        """stop every sub-communication at its next check"""
+        with self.lock:
+            if not self.reason:
+                self.reason = reason
+
+    def get_summary(self) -> dict:
+        with self.lock:
+            return {"history_tokens": sum(self.history_tokens.values()),
+                    "known_facts": sum(self.known_facts.values()),
+                    "seconds": round(time.perf_counter() - self.start_time, 2),
+                    "stop_reason": self.reason}
+
+
+class FanOutPolicy(StopPolicy):
+    """stop a fan-out sub-communication when its shared FanOutBudget says so"""
+
+    name = "fan_out"
+
+    def __init__(self, budget) -> None:
+        self.budget = budget
+
+    def check(self, communication, round_index):
+        return self.budget.update(communication, round_index)
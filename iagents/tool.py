@@ -1,22 +1,21 @@
+import contextlib
 import json
 import logging
 import os
 import re
 from abc import ABC
 from time import sleep
-import faiss
-import numpy as np
-import pandas as pd
 
 import yaml
 
+from backend.governor import get_governor
+from backend.resilience import resilient
+from backend.structured import json_schema_from_example
+from iagents.jsonparse import conform, json_stats, parse_json, replace_none
+from iagents.profile import get_friend_names, get_user_field
+from iagents.resources import get_resources
 from iagents.sql import *
 from iagents.util import iAgentsLogger
-from openai import OpenAI
-
-from tenacity import retry
-from tenacity.stop import stop_after_attempt
-from tenacity.wait import wait_exponential
 
 file_path = os.path.dirname(__file__)
 project_path = os.path.dirname(file_path)
@@ -24,7 +23,6 @@ global_config = yaml.safe_load(open(os.path.join(project_path, "config/global.ya
 OPENAI_API_KEY = global_config.get("backend").get("openai_api_key")
 BASE_URL = global_config.get("backend").get("base_url", None)
 max_tool_retry_times = global_config.get("agent").get("max_tool_retry_times")
-MAX_RETRY_TIMES = global_config.get("agent").get("max_query_retry_times", 10)
 
 
 class Tool(ABC):
@@ -36,8 +34,11 @@ class Tool(ABC):
         super().__init__()
         self.tool_name = tool_name
         self.max_tool_retry_times = max_tool_retry_times
-        with open(os.path.join(project_path, "prompts", "tool_prompt.json"), "r") as f:
-            self.tool_prompt = json.load(f)
+
+    @property
+    def tool_templates(self):
+        # shared by all tools and reloaded when tool_prompt.json changes
+        return get_resources().get_prompt_templates("tool_prompt.json")
 
 
 class FaissTool(Tool):
@@ -46,6 +47,11 @@ class FaissTool(Tool):
 
     def __init__(self, memory_file_path, tool_name="faiss") -> None:
         super().__init__(tool_name)
+        # faiss, pandas and the embedding SDK are only imported when a FaissTool is built
+        import faiss
+        import numpy as np
+        import pandas as pd
+        from openai import OpenAI
         self.emb_client = OpenAI(api_key=OPENAI_API_KEY, base_url=BASE_URL)
         self.memory_file_path = memory_file_path
         self.exist_memory = True
@@ -60,20 +66,27 @@ class FaissTool(Tool):
         else:
             self.exist_memory = False
 
-    @retry(wait=wait_exponential(min=10, max=300), stop=stop_after_attempt(MAX_RETRY_TIMES))
+    @resilient("openai_embedding")
     def _get_embedding_v2(self, text, model="text-embedding-ada-002"):
         if not text or len(text) == 0:
             text = "None"
         text = text.replace("\n", " ")
-        return self.emb_client.embeddings.create(model=model, input=text,
-                                                 encoding_format="float").data[0].embedding[:256]
+        with self.governed(text, model):
+            return self.emb_client.embeddings.create(model=model, input=text,
+                                                     encoding_format="float").data[0].embedding[:256]
 
-    @retry(wait=wait_exponential(min=10, max=300), stop=stop_after_attempt(MAX_RETRY_TIMES))
+    @resilient("openai_embedding")
     def _get_embedding(self, text, model="text-embedding-3-small"):
         if not text or len(text) == 0:
             text = "None"
         text = text.replace("\n", " ")
-        return self.emb_client.embeddings.create(input=[text], model=model, dimensions=256).data[0].embedding
+        with self.governed(text, model):
+            return self.emb_client.embeddings.create(input=[text], model=model, dimensions=256).data[0].embedding
+
+    def governed(self, text, model):
+        """slot of the embedding governor, a no-op context if the governor is disabled"""
+        governor = get_governor("openai_embedding", model)
+        return governor.slot(text) if governor is not None else contextlib.nullcontext()
 
     def query(self, text, topk=3):
         # return distances, indices and text, all in the shape of [topk]
@@ -83,6 +96,7 @@ class FaissTool(Tool):
         topk = max(1, topk)
 
         if self.exist_memory:
+            import numpy as np
             query_emb = self._get_embedding(text)
             query = np.asarray([query_emb])
             query /= np.linalg.norm(query)
@@ -184,18 +198,130 @@ class SqlTool(Tool):
         sql_execute_results = self.execute_sql(sql_command, params)
         return sql_execute_results
 
-    def get_friends(self, master):
+    def get_context_bykeywords(self, keywords, sender, receiver, limit=40, window=2, current=False):
+        """retrieve the context windows of messages matching any of the keywords in one query
+
+        every message of the conversations is matched against all keywords in a single pass,
+        the context windows (`window` messages before and after each hit) are limited to `limit`
+        rows per keyword and deduplicated.
+
+        Args:
+            keywords (iterable[str]): keywords, empty ones are ignored
+            sender (str): the agent's master
+            receiver (str): the current contact
+            limit (int, optional): max context rows per keyword. Defaults to 40.
+            window (int, optional): messages before and after a hit. Defaults to 2.
+            current (bool, optional): search the current session between sender and receiver instead of
+                the sessions of sender with other friends. Defaults to False.
+
+        Returns:
+            tuple[dict, dict]: keyword to its (id, timestamp, sender, receiver, message) rows in chat order,
+                and message id to hit score, the number of keywords whose context windows contain it
+        """
+        keywords = sorted({keyword for keyword in keywords if keyword})
+        if not keywords:
+            return {}, {}
+        if current:
+            conversation = "((sender = %s AND receiver = %s) OR (sender = %s AND receiver = %s))"
+        else:
+            conversation = "((sender = %s AND receiver != %s) OR (sender != %s AND receiver = %s))"
+        keyword_rows = " UNION ALL ".join(["SELECT %s AS keyword_idx, %s AS pattern"] * len(keywords))
         sql_command = """
-        SELECT users.name
-            FROM friendships
-            JOIN users ON friendships.friend_id = users.id
-            WHERE friendships.user_id = (
-                SELECT id FROM users WHERE name = %s
+            WITH keywords AS (
+                {keyword_rows}
+            ),
+            context AS (
+                SELECT id, timestamp, sender, receiver, message,
+                    LAG(id, %s, id) OVER (ORDER BY id) AS prev_id,
+                    LEAD(id, %s, id) OVER (ORDER BY id) AS next_id
+                FROM chats
+                WHERE 
+                    {conversation}
+                    AND 
+                    (sender NOT LIKE '%Agent%' AND receiver NOT LIKE '%Agent%')
+            ),
+            hits AS (
+                SELECT k.keyword_idx, c.id AS hit_id, c.prev_id, c.next_id
+                FROM context c
+                JOIN keywords k ON c.message LIKE k.pattern
+            ),
+            windows AS (
+                SELECT DISTINCT h.keyword_idx, h.hit_id, c.id, c.timestamp, c.sender, c.receiver, c.message
+                FROM hits h
+                JOIN context c ON c.id BETWEEN h.prev_id AND h.next_id
+            ),
+            ranked AS (
+                SELECT keyword_idx, id, timestamp, sender, receiver, message,
+                    ROW_NUMBER() OVER (PARTITION BY keyword_idx ORDER BY hit_id, id) AS row_rank
+                FROM windows
             )
+            SELECT keyword_idx, id, timestamp, sender, receiver, message
+            FROM ranked
+            WHERE row_rank <= %s
+            ORDER BY keyword_idx, row_rank;
+        """.format(keyword_rows=keyword_rows, conversation=conversation)
+        window = max(window, 1)
+        limit = max(limit, 10)
+        params = []
+        for keyword_idx, keyword in enumerate(keywords):
+            params += [keyword_idx, "%" + keyword + "%"]
+        params += [window, window, sender, receiver, receiver, sender, limit]
+
+        sql_execute_results = self.execute_sql(sql_command, tuple(params))
+        contexts = {keyword: [] for keyword in keywords}
+        seen = set()
+        keyword_sets = {}
+        for keyword_idx, *row in sql_execute_results:
+            keyword = keywords[keyword_idx]
+            # windows of close hits overlap, keep every message once per keyword
+            if (keyword, row[0]) in seen:
+                continue
+            seen.add((keyword, row[0]))
+            contexts[keyword].append(tuple(row))
+            keyword_sets.setdefault(row[0], set()).add(keyword)
+        scores = {message_id: len(matched) for message_id, matched in keyword_sets.items()}
+        return contexts, scores
+
+    def get_friend_activity(self, master, friends, keywords):
+        """keyword hits and time of the last message in the chats of the master with each friend, in one query
+
+        Args:
+            master (str): the agent's master
+            friends (iterable[str]): the friends to look up
+            keywords (iterable[str]): keywords, empty ones are ignored
+
+        Returns:
+            dict: lowercased friend name to (number of messages matching any keyword, last message timestamp),
+                friends who never chatted with the master are left out
         """
-        params = (master,)
-        sql_execute_results = self.execute_sql(sql_command, params)
-        return sql_execute_results
+        friends = sorted({friend for friend in friends if friend})
+        keywords = sorted({keyword for keyword in keywords if keyword})
+        if not friends:
+            return {}
+        hit_condition = " OR ".join(["message LIKE %s"] * len(keywords)) or "0 = 1"
+        friend_marks = ", ".join(["%s"] * len(friends))
+        sql_command = """
+            SELECT
+                CASE WHEN sender = %s THEN receiver ELSE sender END AS friend,
+                SUM(CASE WHEN {hit_condition} THEN 1 ELSE 0 END) AS hits,
+                MAX(timestamp) AS last_time
+            FROM chats
+            WHERE
+                (sender = %s AND receiver IN ({friend_marks}))
+                OR
+                (receiver = %s AND sender IN ({friend_marks}))
+            GROUP BY friend;
+        """.format(hit_condition=hit_condition, friend_marks=friend_marks)
+        params = [master]
+        params += ["%" + keyword + "%" for keyword in keywords]
+        params += [master, *friends, master, *friends]
+
+        sql_execute_results = self.execute_sql(sql_command, tuple(params))
+        return {str(friend).lower(): (int(hits or 0), last_time) for friend, hits, last_time in sql_execute_results}
+
+    def get_friends(self, master):
+        # friend lists rarely change, they are served from the profile cache
+        return get_friend_names(master)
 
     def get_current_chat_history(self, sender, receiver, limit=20):
         sql_command = """
@@ -229,22 +355,13 @@ class SqlTool(Tool):
         return sql_execute_results
 
     def get_agent_profile_prompt(self, master):
-        sql_command = """
-            SELECT system_prompt
-            FROM users 
-            WHERE 
-                name = %s
-        """
-        params = (master,)
-        sql_execute_results = self.execute_sql(sql_command, params) 
-        if len(sql_execute_results) == 0:
+        # the profile prompt only changes on cultivate, which writes it through to the profile cache
+        system_prompt = get_user_field("system_prompt", master)
+        if not system_prompt:
             return ""
         else:
-            if not sql_execute_results[0][0]:
-                return ""
-            else:
-                return sql_execute_results[0][0].strip('"')
-    
+            return system_prompt.strip('"')
+
     def execute_sql(self, sql_command, params=None):
         full_sql_command = "SQL COMMAND:\n{}\nPARAMS:\n{}\n".format(str(sql_command), str(params))
         sql_results = exec_sql(sql_command=sql_command, params=params)
@@ -265,81 +382,128 @@ class JsonFormatTool(Tool):
             text (str): text
             json_format (dict): json_format
         """
-        try:
-            text_json = eval(text)
-            for key in json_format:
-                assert isinstance(text_json[key], type(json_format[key]))
-        except Exception as e:
-            return False
-        return True
+        return self.json_load(text, json_format) is not None
 
-    def json_reformat(self, text, json_format) -> str:
-        """retry and ask llm to rewrite the text in json format
+    def json_load(self, text, json_format):
+        """parse the text locally and check it against the json_format
+
+        Args:
+            text (str): text
+            json_format (dict): json_format
+
+        Returns:
+            dict: the parsed json, None if the text can not be parsed or does not match the json_format
+        """
+        try:
+            value, repaired = parse_json(text)
+        except ValueError:
+            return None
+        value = conform(replace_none(value), json_format)
+        if value is not None and repaired:
+            json_stats.count("repaired")
+        return value
+
+    def json_parse(self, text, json_format) -> dict:
+        """parse the text as json aligned with the json_format,
+        only ask llm to rewrite the text when the local repairs fail
 
         Args:
             text (str): text
             json_format (dict): json_format
 
         Returns:
-            str: llm response in json format
+            dict: parsed json, the json_format itself if every trial failed
         """
+        json_stats.count("calls")
         if not text:
-            return str(json_format)
+            json_stats.count("failed")
+            return dict(json_format)
+        text_json = self.json_load(text, json_format)
+        if text_json is not None:
+            json_stats.count("parsed")
+            return text_json
         json_format_str = str(json_format)
-        reformat_prompt = "\n".join(self.tool_prompt['json_reformat'])
-        try_idx = 0
-        while try_idx < self.max_tool_retry_times:
-            text = text.replace("null", '"Error"')
-            text = text.replace("None", '"Error"')
-            text = text.replace("```json", "")
-            text = text.replace("```", "")
-            try_idx += 1
-            if self.json_check(text, json_format):
-                return text
+        reformat_prompt = self.tool_templates['json_reformat'] if json_format else self.tool_templates['json_reformat_woreference']
+        for try_idx in range(1, self.max_tool_retry_times + 1):
+            if try_idx > 1:
+                sleep(1)
             input_text = reformat_prompt.format(text=text, json_format=json_format_str)
-            text = self.query_func(input_text)
+            parsed = {}
+
+            def validate(answer):
+                parsed[answer] = self.json_load(answer, json_format)
+                return parsed[answer] is not None
+
+            # every trial needs a fresh answer, a cached one would fail the same way;
+            # only an answer which parses is cached, so the first trial never gets a known bad one
+            text = self.query_func(input_text, call_site="json_reformat", use_cache=try_idx == 1, validate=validate)
+            json_stats.count("llm_reformat_calls")
             iAgentsLogger.log(input_text, text, "Trial {}. on reformatting json text".format(str(try_idx)))
-            sleep(1)
-        if self.json_check(text, json_format):
-            return text
-        else:
-            # for key in json_format:
-            #     json_format[key] = "Error"
-            return str(json_format)
+            text_json = parsed[text] if text in parsed else self.json_load(text, json_format)
+            if text_json is not None:
+                json_stats.count("llm_reformatted")
+                return text_json
+        json_stats.count("failed")
+        return dict(json_format)
+
+    def json_query(self, prompt, json_format, call_site=None):
+        """ask llm for json aligned with the json_format
+
+        providers with a structured-output mode answer in the schema derived from the json_format,
+        so the answer parses at once; other providers (or an answer that still does not match)
+        go through the plain query and json_parse.
+
+        Args:
+            prompt (str): the prompt, with the json_format given as example
+            json_format (dict): json_format
+            call_site (str, optional): name of the caller. Defaults to None.
+
+        Returns:
+            tuple[str, dict]: the raw answer and the parsed json
+        """
+        response = None
+        structured = getattr(self.query_func, "structured", None)
+        if structured is not None:
+            try:
+                response = structured(prompt, json_schema_from_example(json_format), call_site=call_site)
+            except Exception as e:
+                logging.warning("structured output of {} failed, falling back to plain text: {!r}".format(call_site, e))
+            if response is not None:
+                response_json = self.json_load(response, json_format)
+                if response_json is not None:
+                    json_stats.count("calls")
+                    json_stats.count("structured")
+                    return response, response_json
+        response = self.query_func(prompt, call_site=call_site)
+        return response, self.json_parse(response, json_format)
+
+    def json_reformat(self, text, json_format) -> str:
+        """parse the text as json aligned with the json_format, see json_parse
+
+        Args:
+            text (str): text
+            json_format (dict): json_format
+
+        Returns:
+            str: the parsed json as str
+        """
+        return str(self.json_parse(text, json_format))
 
     def json_reformat_woreference(self, text):
         """similar to json_reformat but reference-free
         """
-        reformat_prompt = "\n".join(self.tool_prompt['json_reformat_woreference'])
-        try_idx = 0
-        if not text:
-            return str(dict())
-        while try_idx < self.max_tool_retry_times:
-            text = text.replace("null", '"Error"')
-            text = text.replace("None", '"Error"')
-            text = text.replace("```json", "")
-            text = text.replace("```", "")
-            try_idx += 1
-            if self.json_check(text, dict()):
-                return text
-            input_text = reformat_prompt.format(text=text)
-            text = self.query_func(input_text)
-            iAgentsLogger.log(input_text, text, "Trial {} on reformatting json text".format(str(try_idx)))
-            sleep(1)
-        if self.json_check(text, dict()):
-            return text
-        else:
-            return str(dict())
+        return str(self.json_parse(text, dict()))
 
 
 class MindFillTool(Tool):
     """The tool for listing and updating the pinned facts in mindmap
     """
 
-    def __init__(self, query_func, tool_name="mind_fill") -> None:
+    def __init__(self, query_func, tool_name="mind_fill", json_tool=None) -> None:
         super().__init__(tool_name)
         self.query_func = query_func
-        self.json_tool = JsonFormatTool(query_func)
+        # the json tool is stateless, agents pass the shared one of their backend
+        self.json_tool = json_tool or JsonFormatTool(query_func)
         self.infonav_plan = ""
         self.know_facts = dict()
         self.unknown_facts = set()
@@ -363,9 +527,19 @@ class MindFillTool(Tool):
             ret.append("unknown fact: {}".format(fact))
         return "\n".join(ret)
 
+    def get_state(self) -> dict:
+        """the pinned facts as a JSON serializable dict, for communication checkpoints"""
+        return {"infonav_plan": self.infonav_plan,
+                "know_facts": dict(self.know_facts),
+                "unknown_facts": sorted(self.unknown_facts)}
+
+    def set_state(self, state) -> None:
+        self.infonav_plan = state.get("infonav_plan", "")
+        self.know_facts = dict(state.get("know_facts", {}))
+        self.unknown_facts = set(state.get("unknown_facts", []))
+
     def fill_mind(self, infonav, filled_json_text):
-        filled_json = self.json_tool.json_reformat_woreference(filled_json_text)
-        filled_json = eval(filled_json)
+        filled_json = self.json_tool.json_parse(filled_json_text, dict())
         for key in filled_json:
             if "[{}]".format(key) in infonav and key in self.unknown_facts:
                 infonav = infonav.replace("[{}]".format(key),
@@ -3,6 +3,7 @@ import os
 import yaml
 from datetime import datetime
 import csv
+import threading
 
 # Load global config with error handling
 file_path = os.path.dirname(__file__)
@@ -23,6 +24,7 @@ class iAgentsLogger:
 
     logger = None  # Class variable for the logger instance
     writer = None  # Class variable for the CSV writer
+    lock = threading.Lock()  # Serializes rows written from worker threads and async tasks
 
     @classmethod
     def set_logger(cls, logger):
@@ -75,7 +77,8 @@ class iAgentsLogger:
         response = response or "None"
 
         # Write to CSV
-        cls.writer.writerow([current_timestamp, instruction, query, response])
+        with cls.lock:
+            cls.writer.writerow([current_timestamp, instruction, query, response])
 
         # Prepare the detailed log message
         detailed_log = f"{instruction}\n>>>>>>>> Input >>>>>>>>:\n{query}\n<<<<<<<< Output <<<<<<<<:\n{response}\n"
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import backend.cache as cache_module
+from backend.cache import CachedQueryFunc, LLMCache
+
+
+class LLMCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.disk_path = os.path.join(self.directory.name, "llm_cache.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_cache(self, **kwargs):
+        llm_cache = LLMCache(disk_path=self.disk_path, **kwargs)
+        self.addCleanup(llm_cache.conn.close)
+        return llm_cache
+
+    def test_hit_and_miss(self):
+        llm_cache = self.make_cache()
+        self.assertIsNone(llm_cache.get("key"))
+        llm_cache.set("key", "response")
+        self.assertEqual(llm_cache.get("key"), "response")
+        stats = llm_cache.get_stats()
+        self.assertEqual((stats["memory_hits"], stats["misses"], stats["writes"]), (1, 1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_disk_tier_survives_a_restart(self):
+        self.make_cache().set("key", "response")
+        llm_cache = self.make_cache()
+        self.assertIsNone(llm_cache.get("key", memory_only=True))
+        self.assertEqual(llm_cache.get("key"), "response")
+        self.assertEqual(llm_cache.get("key", memory_only=True), "response")
+        stats = llm_cache.get_stats()
+        self.assertEqual((stats["disk_hits"], stats["memory_hits"]), (1, 1))
+
+    def test_expired_entries_are_dropped(self):
+        llm_cache = self.make_cache(ttl=10)
+        with mock.patch("backend.cache.time.time", return_value=1000.0):
+            llm_cache.set("key", "response")
+        with mock.patch("backend.cache.time.time", return_value=1005.0):
+            self.assertEqual(llm_cache.get("key"), "response")
+        llm_cache.memory.clear()
+        with mock.patch("backend.cache.time.time", return_value=1011.0):
+            self.assertIsNone(llm_cache.get("key"))
+        self.assertEqual(llm_cache.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        llm_cache = self.make_cache(memory_size=2, max_disk_entries=10)
+        for idx in range(3):
+            llm_cache.set("key{}".format(idx), "response{}".format(idx))
+        self.assertEqual(list(llm_cache.memory), ["key1", "key2"])
+        for idx in range(3, 12):
+            llm_cache.set("key{}".format(idx), "response{}".format(idx))
+        self.assertLessEqual(llm_cache._count_disk(), 10)
+        self.assertIsNone(llm_cache.get("key0"))
+        self.assertEqual(llm_cache.get("key11"), "response11")
+
+
+class CachedQueryFuncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.llm_cache = LLMCache(disk_path=os.path.join(self.directory.name, "llm_cache.sqlite"))
+        config = dict(cache_module.CACHE_CONFIG, enable=True, singleflight=False, call_sites=["json_reformat"])
+        patches = [mock.patch.object(cache_module, "CACHE_CONFIG", config),
+                   mock.patch.object(cache_module, "_llm_cache", self.llm_cache)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.answers = []
+
+        def query(prompt):
+            return self.answers.pop(0)
+
+        self.query_func = CachedQueryFunc(query, "test", "test-model")
+
+    def tearDown(self):
+        self.llm_cache.conn.close()
+        self.directory.cleanup()
+
+    def test_only_allowed_call_sites_are_cached(self):
+        self.answers = ["first", "second", "third"]
+        self.assertEqual(self.query_func("prompt", call_site="action"), "first")
+        self.assertEqual(self.query_func("prompt", call_site="action"), "second")
+        self.assertEqual(self.query_func("prompt", call_site="json_reformat"), "third")
+        self.assertEqual(self.query_func("prompt", call_site="json_reformat"), "third")
+        self.assertEqual(self.llm_cache.get_stats()["bypassed"], 2)
+
+    def test_an_invalid_answer_is_not_cached(self):
+        self.answers = ["not json", "{}"]
+
+        def validate(answer):
+            return answer.startswith("{")
+
+        self.assertEqual(self.query_func("prompt", call_site="json_reformat", validate=validate), "not json")
+        self.assertEqual(self.query_func("prompt", call_site="json_reformat", validate=validate), "{}")
+        self.assertEqual(self.query_func("prompt", call_site="json_reformat", validate=validate), "{}")
+
+
+if __name__ == "__main__":
+    unittest.main()
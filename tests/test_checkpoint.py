@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from iagents.checkpoint import CheckpointStore, make_checkpoint_id
+
+
+class CheckpointStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "checkpoints.sqlite")
+        self.store = self.make_store()
+
+    def make_store(self, **kwargs):
+        store = CheckpointStore(self.path, **kwargs)
+        self.addCleanup(store.conn.close)
+        return store
+
+    def test_checkpoint_id_is_stable(self):
+        self.assertEqual(make_checkpoint_id("alice", "bob", "task"), make_checkpoint_id("alice", "bob", "task"))
+        self.assertNotEqual(make_checkpoint_id("alice", "bob", "task"), make_checkpoint_id("bob", "alice", "task"))
+
+    def test_a_live_run_keeps_identical_requests_out(self):
+        self.assertEqual(self.store.claim("id", "first"), (True, None))
+        self.assertEqual(self.store.claim("id", "second"), (False, None))
+        self.assertTrue(self.store.save("id", {"round": 1}, "first"))
+        self.assertFalse(self.store.save("id", {"round": 9}, "second"))
+        self.store.delete("id", "second")
+        self.assertEqual(self.store.load("id"), {"round": 1})
+        self.assertEqual(self.store.get_stats()["busy"], 2)
+
+    def test_a_released_checkpoint_is_resumed(self):
+        self.store.claim("id", "first")
+        self.store.save("id", {"round": 2}, "first")
+        self.store.release("id", "first")
+        self.assertEqual(self.store.claim("id", "second"), (True, {"round": 2}))
+        self.assertFalse(self.store.save("id", {"round": 3}, "first"))
+
+    def test_an_expired_lease_is_taken_over(self):
+        store = self.make_store(lease=10)
+        with mock.patch("iagents.checkpoint.time.time", return_value=1000.0):
+            store.claim("id", "dead")
+            store.save("id", {"round": 1}, "dead")
+        with mock.patch("iagents.checkpoint.time.time", return_value=1005.0):
+            self.assertEqual(store.claim("id", "second"), (False, None))
+        with mock.patch("iagents.checkpoint.time.time", return_value=1011.0):
+            self.assertEqual(store.claim("id", "second"), (True, {"round": 1}))
+
+    def test_saves_renew_the_leases_of_sub_communications(self):
+        store = self.make_store(lease=10)
+        with mock.patch("iagents.checkpoint.time.time", return_value=1000.0):
+            store.claim("id", "owner")
+            store.claim("id/sub", "owner")
+        with mock.patch("iagents.checkpoint.time.time", return_value=1008.0):
+            store.save("id/sub", {"round": 1}, "owner")
+        with mock.patch("iagents.checkpoint.time.time", return_value=1012.0):
+            self.assertEqual(store.claim("id", "other"), (False, None))
+
+    def test_finish_drops_the_sub_communications(self):
+        self.store.claim("id", "owner")
+        self.store.save("id", {"round": 1}, "owner")
+        self.store.save("id/sub", {"round": 1}, "owner")
+        self.store.save("idle", {"round": 1}, "owner")
+        self.store.finish("id", "owner")
+        self.assertEqual([checkpoint_id for checkpoint_id, _ in self.store.list_checkpoints()], ["idle"])
+
+    def test_expired_checkpoints_are_not_resumed(self):
+        store = self.make_store(ttl=60)
+        with mock.patch("iagents.checkpoint.time.time", return_value=1000.0):
+            store.save("id", {"round": 1}, "owner")
+            store.release("id", "owner")
+        with mock.patch("iagents.checkpoint.time.time", return_value=1100.0):
+            self.assertIsNone(store.load("id"))
+            self.assertEqual(store.claim("id", "other"), (True, None))
+
+    def test_old_schema_is_migrated(self):
+        path = os.path.join(self.directory.name, "old.sqlite")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE checkpoints (checkpoint_id TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                     "updated_at REAL NOT NULL)")
+        conn.execute("INSERT INTO checkpoints VALUES ('id', '{\"round\": 1}', 0)")
+        conn.commit()
+        conn.close()
+        store = CheckpointStore(path)
+        self.addCleanup(store.conn.close)
+        self.assertEqual(store.claim("id", "owner"), (True, {"round": 1}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+import backend.governor as governor_module
+import backend.resilience as resilience_module
+from backend.governor import FairQueue, Governor, TokenBucket, agovern, govern, governor_flow
+from backend.resilience import CircuitBreaker, resilient
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_reservations_beyond_the_quota_wait_for_the_refill(self):
+        with mock.patch("backend.governor.time.monotonic", return_value=100.0):
+            bucket = TokenBucket(60)
+            self.assertEqual(bucket.reserve(60), 0.0)
+            # one token per second
+            self.assertAlmostEqual(bucket.reserve(1), 1.0)
+            self.assertAlmostEqual(bucket.reserve(1), 2.0)
+        with mock.patch("backend.governor.time.monotonic", return_value=103.0):
+            self.assertEqual(bucket.reserve(1), 0.0)
+
+    def test_a_request_larger_than_the_bucket_is_clamped(self):
+        with mock.patch("backend.governor.time.monotonic", return_value=100.0):
+            bucket = TokenBucket(60)
+            self.assertEqual(bucket.reserve(1000), 0.0)
+            self.assertAlmostEqual(bucket.reserve(60), 60.0)
+
+
+class FairQueueTest(unittest.TestCase):
+
+    def test_waiting_flows_are_served_round_robin(self):
+        queue = FairQueue(1)
+        queue.acquire("holder")
+        order = []
+        threads = []
+        # flow "a" queues three calls before flow "b" queues its one
+        for flow, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]:
+            def run(flow=flow, name=name):
+                queue.acquire(flow)
+                order.append(name)
+                queue.release()
+            thread = threading.Thread(target=run)
+            thread.start()
+            threads.append(thread)
+            while queue.qsize() < len(threads):
+                time.sleep(0.001)
+        queue.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ["a1", "b1", "a2", "a3"])
+
+    def test_in_flight_calls_are_bounded(self):
+        queue = FairQueue(2)
+        lock = threading.Lock()
+        state = {"in_flight": 0, "max_in_flight": 0}
+
+        def run(flow):
+            queue.acquire(flow)
+            with lock:
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            time.sleep(0.01)
+            with lock:
+                state["in_flight"] -= 1
+            queue.release()
+        threads = [threading.Thread(target=run, args=(idx % 3,)) for idx in range(9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(state["max_in_flight"], 2)
+        self.assertEqual(queue.in_flight, 0)
+
+
+class AsyncFairQueueTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_a_cancelled_waiter_gives_its_turn_away(self):
+        queue = FairQueue(1)
+        queue.acquire("holder")
+        cancelled = asyncio.ensure_future(queue.aacquire("a"))
+        waiter = asyncio.ensure_future(queue.aacquire("b"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        queue.release()
+        await asyncio.wait_for(waiter, 5)
+        self.assertEqual(queue.in_flight, 1)
+        self.assertEqual(queue.qsize(), 0)
+        queue.release()
+
+
+class GovernorTest(unittest.TestCase):
+
+    def test_slots_reserve_the_request_quota(self):
+        governor = Governor("test", rpm=60, max_in_flight=1)
+        with mock.patch("backend.governor.time.sleep") as sleep:
+            with governor_flow("flow"):
+                with governor.slot("prompt"):
+                    self.assertEqual(governor.get_stats()["in_flight"], 1)
+            sleep.assert_not_called()
+            governor.request_bucket.tokens = 0
+            with governor.slot("prompt"):
+                pass
+            sleep.assert_called_once()
+        stats = governor.get_stats()
+        self.assertEqual((stats["calls"], stats["in_flight"]), (2, 0))
+        self.assertEqual(governor.queue.in_flight, 0)
+
+    def test_a_failed_call_gives_its_slot_back(self):
+        governor = Governor("test", max_in_flight=1)
+        with self.assertRaises(RuntimeError):
+            with governor.slot("prompt"):
+                raise RuntimeError("provider failed")
+        self.assertEqual(governor.queue.in_flight, 0)
+        self.assertEqual(governor.get_stats()["in_flight"], 0)
+
+
+class TransientError(Exception):
+    status_code = 503
+
+
+class GovernedRetryTest(unittest.IsolatedAsyncioTestCase):
+    """every attempt of a resilient call behind govern takes its own slot and quota, the backoff none"""
+
+    def setUp(self):
+        self.governor = Governor("test", rpm=600, max_in_flight=1)
+        config = dict(resilience_module.RESILIENCE_CONFIG, initial_wait=0, max_wait=0)
+        breaker = CircuitBreaker("test", failure_threshold=10, reset_timeout=30)
+        for patch in [mock.patch.object(governor_module, "get_governor", return_value=self.governor),
+                      mock.patch.object(resilience_module, "RESILIENCE_CONFIG", config),
+                      mock.patch.object(resilience_module, "get_circuit_breaker", return_value=breaker)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.in_flight_while_backing_off = []
+
+    def check_backoff(self, seconds):
+        self.in_flight_while_backing_off.append(self.governor.queue.in_flight)
+
+    def test_sync_attempts(self):
+        errors = [TransientError(), TransientError()]
+
+        @resilient("test", max_attempts=3)
+        def query(prompt):
+            self.assertEqual(self.governor.queue.in_flight, 1)
+            if errors:
+                raise errors.pop(0)
+            return "answer"
+        with mock.patch.object(resilience_module, "cancellable_sleep", self.check_backoff):
+            self.assertEqual(govern(query, "test")("prompt"), "answer")
+        self.assertEqual(self.in_flight_while_backing_off, [0, 0])
+        self.assertEqual(self.governor.get_stats()["calls"], 3)
+        self.assertAlmostEqual(self.governor.request_bucket.tokens, 597, places=0)
+        self.assertEqual((self.governor.queue.in_flight, self.governor.get_stats()["in_flight"]), (0, 0))
+
+    def test_a_failed_call_gives_its_slot_back(self):
+        @resilient("test", max_attempts=2)
+        def query(prompt):
+            raise TransientError()
+        with self.assertRaises(TransientError):
+            govern(query, "test")("prompt")
+        self.assertEqual(self.governor.get_stats()["calls"], 2)
+        self.assertEqual((self.governor.queue.in_flight, self.governor.get_stats()["in_flight"]), (0, 0))
+
+    async def test_async_attempts(self):
+        errors = [TransientError()]
+
+        @resilient("test", max_attempts=3)
+        async def aquery(prompt):
+            self.assertEqual(self.governor.queue.in_flight, 1)
+            if errors:
+                raise errors.pop(0)
+            return "answer"
+
+        async def check_backoff(seconds):
+            self.check_backoff(seconds)
+        with mock.patch("asyncio.sleep", check_backoff):
+            self.assertEqual(await agovern(aquery, "test")("prompt"), "answer")
+        self.assertEqual(self.in_flight_while_backing_off, [0])
+        self.assertEqual(self.governor.get_stats()["calls"], 2)
+        self.assertEqual((self.governor.queue.in_flight, self.governor.get_stats()["in_flight"]), (0, 0))
+
+    def test_calls_without_retries_hold_one_slot(self):
+        def query(prompt):
+            self.assertEqual(self.governor.queue.in_flight, 1)
+            return "answer"
+        self.assertEqual(govern(query, "test")("prompt"), "answer")
+        self.assertEqual(self.governor.get_stats()["calls"], 1)
+        self.assertEqual(self.governor.queue.in_flight, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
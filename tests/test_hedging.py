@@ -0,0 +1,61 @@
+import threading
+import unittest
+import uuid
+from unittest import mock
+
+import backend.hedging as hedging_module
+from backend.hedging import HedgedQueryFunc, get_tracker
+
+
+class Provider():
+
+    def __init__(self, query_func) -> None:
+        # the latency trackers are process-wide, a fresh name keeps the tests apart
+        self.name = "test-{}".format(uuid.uuid4().hex[:8])
+        self.query_func = query_func
+
+
+class HedgedQueryFuncTest(unittest.TestCase):
+
+    def setUp(self):
+        config = dict(hedging_module.HEDGING_CONFIG, initial_delay=0.05, min_samples=20, max_error_rate=0.5)
+        patch = mock.patch.object(hedging_module, "HEDGING_CONFIG", config)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_a_slow_primary_is_hedged(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow(prompt):
+            release.wait(5)
+            return "slow"
+        primary, secondary = Provider(slow), Provider(lambda prompt: "fast")
+        self.assertEqual(HedgedQueryFunc([primary, secondary])("prompt"), "fast")
+        self.assertEqual(get_tracker(secondary.name).samples(), 1)
+
+    def test_a_failing_primary_fails_over(self):
+        def failing(prompt):
+            raise ConnectionError("down")
+        primary, secondary = Provider(failing), Provider(lambda prompt: "answer")
+        self.assertEqual(HedgedQueryFunc([primary, secondary])("prompt"), "answer")
+        self.assertEqual(get_tracker(primary.name).error_rate(), 1.0)
+
+    def test_an_unhealthy_primary_is_ranked_last(self):
+        primary, secondary = Provider(lambda prompt: "primary"), Provider(lambda prompt: "secondary")
+        for _ in range(3):
+            get_tracker(primary.name).record(error=True)
+        hedged = HedgedQueryFunc([primary, secondary])
+        self.assertEqual(hedged.rank(), [secondary, primary])
+        # nothing healthy to hedge to, the call is made directly
+        self.assertEqual(hedged("prompt"), "secondary")
+
+    def test_every_provider_failing_raises_the_last_error(self):
+        def failing(prompt):
+            raise ConnectionError("down")
+        with self.assertRaises(ConnectionError):
+            HedgedQueryFunc([Provider(failing), Provider(failing)])("prompt")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from iagents.history import RollingHistory
+from iagents.prompt import HistoryBuffer
+
+
+class HistoryBufferTest(unittest.TestCase):
+
+    def test_joined_follows_every_mutation(self):
+        history = HistoryBuffer(["a", "b"])
+        self.assertEqual(history.joined(), "a\nb")
+        history.append("c")
+        self.assertEqual(history.joined(), "a\nb\nc")
+        history[0] = "x"
+        self.assertEqual(history.joined(), "x\nb\nc")
+        history.pop()
+        self.assertEqual(history.joined(), "x\nb")
+        history.clear()
+        self.assertEqual(history.joined(), "")
+
+
+class RollingHistoryTest(unittest.TestCase):
+
+    def test_short_history_is_rendered_in_full(self):
+        history = RollingHistory(["a", "b"], keep_turns=2)
+        self.assertEqual(history.render("facts"), "a\nb")
+
+    def test_old_messages_are_truncated(self):
+        history = RollingHistory(["one two three four", "five", "six", "seven"], keep_turns=2, clip_words=2)
+        self.assertEqual(history.render("known facts"), "\n".join([
+            "[earlier communication, truncated (2 messages)]",
+            "known facts",
+            "one two ...",
+            "five",
+            "[latest messages]",
+            "six",
+            "seven",
+        ]))
+        # the full history is kept
+        self.assertEqual(history.joined(), "one two three four\nfive\nsix\nseven")
+
+    def test_messages_are_clipped_once(self):
+        history = RollingHistory(["a", "b", "c"], keep_turns=1, max_clipped_lines=2)
+        history.render()
+        history.append("d")
+        history.render()
+        self.assertEqual(history.clipped_messages, 3)
+        self.assertEqual(history.clipped_lines, ["b", "c"])
+
+    def test_mutations_clip_again(self):
+        history = RollingHistory(["a", "b", "c"], keep_turns=1)
+        history.render()
+        history[0] = "x"
+        self.assertIn("x\nb\n[latest messages]", history.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from iagents.jsonparse import conform, extract_object, parse_json, replace_json_literals, replace_none
+
+
+class ParseJsonTest(unittest.TestCase):
+
+    def test_valid_json_needs_no_repair(self):
+        self.assertEqual(parse_json('{"answer": "yes"}'), ({"answer": "yes"}, False))
+
+    def test_code_fences_and_prose_are_stripped(self):
+        text = 'Sure, here it is:\n```json\n{"answer": "yes", "note": "a {brace}"}\n```\nAnything else?'
+        self.assertEqual(parse_json(text), ({"answer": "yes", "note": "a {brace}"}, True))
+
+    def test_single_quotes_and_python_literals(self):
+        self.assertEqual(parse_json("{'answer': None, 'done': True}"), ({"answer": None, "done": True}, True))
+
+    def test_json_literals_mixed_with_single_quotes(self):
+        self.assertEqual(parse_json("{'answer': null, 'done': false, 'text': 'null'}"),
+                         ({"answer": None, "done": False, "text": "null"}, True))
+
+    def test_trailing_commas(self):
+        self.assertEqual(parse_json('{"facts": ["a", "b",],}'), ({"facts": ["a", "b"]}, True))
+
+    def test_unparsable_text_raises(self):
+        with self.assertRaises(ValueError):
+            parse_json("no json at all")
+        with self.assertRaises(ValueError):
+            parse_json('{"answer": "truncated')
+
+
+class HelpersTest(unittest.TestCase):
+
+    def test_extract_object_skips_braces_in_strings(self):
+        self.assertEqual(extract_object('x {"a": "}", "b": {"c": 1}} y'), '{"a": "}", "b": {"c": 1}}')
+        self.assertIsNone(extract_object("no object"))
+
+    def test_replace_json_literals_keeps_quoted_text(self):
+        self.assertEqual(replace_json_literals("[true, 'true', nullable]"), "[True, 'true', nullable]")
+
+    def test_replace_none(self):
+        self.assertEqual(replace_none({"a": None, "b": [None, "x"]}), {"a": "Error", "b": ["Error", "x"]})
+
+    def test_conform(self):
+        json_format = {"answer": "text", "facts": []}
+        self.assertEqual(conform({"answer": 3, "facts": []}, json_format), {"answer": "3", "facts": []})
+        self.assertIsNone(conform({"answer": "text"}, json_format))
+        self.assertIsNone(conform({"answer": "text", "facts": "a"}, json_format))
+        self.assertIsNone(conform(["answer"], json_format))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from backend import gpt, third_party
+from backend.loops import cache_per_event_loop
+
+
+class ChatCompletionHandler(BaseHTTPRequestHandler):
+    """a local OpenAI-compatible endpoint keeping its connections alive"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"id": "test", "object": "chat.completion", "created": 0, "model": "claude",
+                           "choices": [{"index": 0, "finish_reason": "stop",
+                                        "message": {"role": "assistant", "content": "answer"}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CachePerEventLoopTest(unittest.TestCase):
+
+    def test_each_event_loop_gets_its_own_entries(self):
+        built = []
+
+        @cache_per_event_loop
+        def get_client(name):
+            built.append(name)
+            return object()
+
+        async def get_clients():
+            return get_client("a"), get_client("a"), get_client("b")
+
+        first, same, other = asyncio.run(get_clients())
+        self.assertIs(first, same)
+        self.assertIsNot(first, other)
+        second, _, _ = asyncio.run(get_clients())
+        self.assertIsNot(first, second)
+        self.assertEqual(built, ["a", "b", "a", "b"])
+
+    def test_async_sdk_clients_are_not_shared_across_event_loops(self):
+        async def get_clients():
+            return gpt.get_async_client(), third_party.get_async_client("deepseek")
+
+        first = asyncio.run(get_clients())
+        second = asyncio.run(get_clients())
+        for client, other in zip(first, second):
+            self.assertIsNot(client, other)
+
+    def test_async_queries_work_across_event_loops(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ChatCompletionHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        messages = [{"role": "user", "content": "question"}]
+        with mock.patch.object(gpt, "BASE_URL", "http://127.0.0.1:{}/v1".format(server.server_address[1])), \
+                mock.patch.object(gpt, "OPENAI_API_KEY", "test"):
+            # e.g. one asyncio.run per request of a sync web worker
+            for _ in range(2):
+                response = asyncio.run(gpt.achat_completion_request(messages, model="claude"))
+                self.assertEqual(response["choices"][0]["message"]["content"], "answer")
+
+    def test_calls_outside_an_event_loop_fail(self):
+        with self.assertRaises(RuntimeError):
+            gpt.get_async_client()
+
+
+if __name__ == "__main__":
+    unittest.main()
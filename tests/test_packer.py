@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+
+from iagents.packer import ContextPacker
+
+
+class WordEncoding():
+    """one token per word, so that the tests need no tiktoken download"""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def count_words(text, model=None):
+    return len(text.split())
+
+
+class ContextPackerTest(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in [("count_prompt_tokens", count_words), ("get_encoding", lambda model: WordEncoding())]:
+            patch = mock.patch("iagents.packer." + name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_messages_are_deduplicated_ranked_and_kept_in_chat_order(self):
+        rows = {idx: (idx, "t{}".format(idx), "alice", "bob", text) for idx, text in
+                enumerate(["about apples", "filler words here", "more apples talk", "unrelated"])}
+        contexts = {"apples": [rows[0], rows[1], rows[2]], "talk": [rows[2], rows[3]]}
+        packer = ContextPacker("model", budgets={"current_memory": 5})
+        kept = packer.pack_messages("current_memory", contexts, {0: 1, 1: 1, 2: 2, 3: 1}, lambda row: row[4])
+        # row 2 is in both keyword windows, recency ranks row 3 above row 0 which no longer fits
+        self.assertEqual([row[0] for row in kept], [2, 3])
+        stats = packer.get_stats()["current_memory"]
+        self.assertEqual((stats["candidates"], stats["kept"], stats["tokens"]), (4, 2, 4))
+
+    def test_texts_are_cut_at_the_budget(self):
+        packer = ContextPacker("model", budgets={"fuzzy_memory": 5})
+        kept = packer.pack_texts("fuzzy_memory", ["one two three", "four five six seven", "eight"])
+        self.assertEqual(kept, ["one two three", "four five"])
+
+    def test_sections_without_budget_keep_everything(self):
+        packer = ContextPacker("model", budgets={"fuzzy_memory": None})
+        texts = ["one two", "three"]
+        self.assertEqual(packer.pack_texts("fuzzy_memory", texts), texts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+from backend.replay import Cassette, ReplayMissError, hash_prompt
+
+
+class CassetteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        with open(os.path.join(self.directory.name, "cassette.jsonl"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({"prompt": "hello", "response": "first"}) + "\n")
+            f.write(json.dumps({"prompt_hash": hash_prompt("hello"), "response": "second"}) + "\n")
+        with open(os.path.join(self.directory.name, "agent_llm.csv"), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["timestamp", "instruction", "query", "response"])
+            writer.writerow(["0", "query", "multi\nline, prompt", "logged"])
+            writer.writerow(["0", "note", "None", "None"])
+
+    def test_responses_replay_in_recorded_order(self):
+        cassette = Cassette([os.path.join(self.directory.name, "*.jsonl")])
+        self.assertEqual([cassette.lookup("hello") for _ in range(3)], ["first", "second", "second"])
+
+    def test_llm_logs_are_loaded(self):
+        cassette = Cassette([os.path.join(self.directory.name, "*_llm.csv")])
+        self.assertEqual(cassette.lookup("multi\nline, prompt"), "logged")
+        self.assertEqual(len(cassette.responses), 1)
+
+    def test_unseen_prompts(self):
+        cassette = Cassette([os.path.join(self.directory.name, "*")], fallback_response="fallback")
+        self.assertEqual(cassette.lookup("unseen"), "fallback")
+        self.assertEqual(cassette.get_stats(), {"hits": 0, "misses": 1})
+        with self.assertRaises(ReplayMissError):
+            Cassette([], strict=True).lookup("unseen")
+
+    def test_latency_is_reproducible(self):
+        samples = [Cassette([], latency=1.0, latency_jitter=0.5, seed=7).sample_latency() for _ in range(2)]
+        self.assertEqual(samples[0], samples[1])
+        self.assertTrue(0.5 <= samples[0] <= 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
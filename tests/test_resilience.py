@@ -0,0 +1,154 @@
+import unittest
+from unittest import mock
+
+import backend.resilience as resilience_module
+from backend.resilience import (CallCancelledError, CircuitBreaker, ProviderUnavailableError, cancellable,
+                                is_retryable, resilient)
+
+
+class StatusError(Exception):
+
+    def __init__(self, status_code) -> None:
+        super().__init__("status {}".format(status_code))
+        self.status_code = status_code
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class ErrorClassificationTest(unittest.TestCase):
+
+    def test_transient_errors_are_retryable(self):
+        self.assertTrue(is_retryable(StatusError(429)))
+        self.assertTrue(is_retryable(StatusError(503)))
+        self.assertTrue(is_retryable(ConnectionError()))
+        self.assertTrue(is_retryable(RateLimitError()))
+
+    def test_fatal_errors_are_not_retryable(self):
+        self.assertFalse(is_retryable(StatusError(400)))
+        self.assertFalse(is_retryable(StatusError(401)))
+        self.assertFalse(is_retryable(ValueError()))
+        self.assertFalse(is_retryable(ProviderUnavailableError("test", 1.0, None)))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch("backend.resilience.time.monotonic", return_value=100.0)
+        self.monotonic = patch.start()
+        self.addCleanup(patch.stop)
+        self.breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+
+    def test_opens_after_consecutive_transient_failures(self):
+        self.breaker.record_failure(StatusError(503))
+        self.breaker.before_call()
+        self.breaker.record_failure(StatusError(503))
+        self.assertEqual(self.breaker.get_state()["state"], "open")
+        with self.assertRaises(ProviderUnavailableError):
+            self.breaker.before_call()
+
+    def test_fatal_errors_do_not_open_it(self):
+        for _ in range(3):
+            self.breaker.record_failure(StatusError(400))
+        self.assertEqual(self.breaker.get_state()["state"], "closed")
+
+    def test_a_success_resets_the_failures(self):
+        self.breaker.record_failure(StatusError(503))
+        self.breaker.record_success()
+        self.breaker.record_failure(StatusError(503))
+        self.assertEqual(self.breaker.get_state()["state"], "closed")
+
+    def test_half_open_lets_one_probe_through(self):
+        self.breaker.record_failure(StatusError(503))
+        self.breaker.record_failure(StatusError(503))
+        self.monotonic.return_value = 131.0
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.get_state()["state"], "half_open")
+        with self.assertRaises(ProviderUnavailableError):
+            self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.get_state()["state"], "closed")
+
+    def test_a_failed_probe_opens_it_again(self):
+        self.breaker.record_failure(StatusError(503))
+        self.breaker.record_failure(StatusError(503))
+        self.monotonic.return_value = 131.0
+        self.breaker.before_call()
+        self.breaker.record_failure(StatusError(503))
+        self.assertEqual(self.breaker.get_state()["state"], "open")
+        with self.assertRaises(ProviderUnavailableError):
+            self.breaker.before_call()
+
+
+class ResilientTest(unittest.TestCase):
+
+    def setUp(self):
+        config = dict(resilience_module.RESILIENCE_CONFIG, initial_wait=0, max_wait=0)
+        patch = mock.patch.object(resilience_module, "RESILIENCE_CONFIG", config)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.breaker = CircuitBreaker("test", failure_threshold=10, reset_timeout=30)
+        patch = mock.patch.object(resilience_module, "get_circuit_breaker", return_value=self.breaker)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def make_call(self, errors, max_attempts=3):
+        calls = []
+
+        @resilient("test", max_attempts=max_attempts)
+        def call():
+            calls.append(1)
+            if errors:
+                raise errors.pop(0)
+            return "response"
+        return call, calls
+
+    def test_transient_errors_are_retried(self):
+        call, calls = self.make_call([StatusError(503), StatusError(429)])
+        self.assertEqual(call(), "response")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.breaker.get_state()["failures"], 0)
+
+    def test_fatal_errors_are_raised_at_once(self):
+        call, calls = self.make_call([StatusError(400)])
+        with self.assertRaises(StatusError):
+            call()
+        self.assertEqual(len(calls), 1)
+
+    def test_attempts_are_bounded(self):
+        call, calls = self.make_call([StatusError(503)] * 5)
+        with self.assertRaises(StatusError):
+            call()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.breaker.get_state()["failures"], 3)
+
+    def test_a_cancelled_call_stops_retrying(self):
+        call, calls = self.make_call([StatusError(503)] * 5)
+        event = mock.Mock()
+        event.is_set.side_effect = [False, True]
+        with cancellable(event):
+            with self.assertRaises(CallCancelledError):
+                call()
+        self.assertEqual(len(calls), 1)
+
+
+class AsyncResilientTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_transient_errors_are_retried(self):
+        errors = [StatusError(503)]
+        breaker = CircuitBreaker("test", failure_threshold=10, reset_timeout=30)
+        config = dict(resilience_module.RESILIENCE_CONFIG, initial_wait=0, max_wait=0)
+        with mock.patch.object(resilience_module, "RESILIENCE_CONFIG", config), \
+                mock.patch.object(resilience_module, "get_circuit_breaker", return_value=breaker):
+            @resilient("test", max_attempts=3)
+            async def call():
+                if errors:
+                    raise errors.pop(0)
+                return "response"
+            self.assertEqual(await call(), "response")
+        self.assertEqual(breaker.get_state()["state"], "closed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import asyncio
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import backend.cache as cache_module
+from backend.cache import AsyncCachedQueryFunc, LLMCache, SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_sync_callers_share_one_query(self):
+        singleflight = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def query():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return "response"
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as pool:
+            leader = pool.submit(singleflight.do, "key", "test", query)
+            started.wait()
+            waiters = [pool.submit(singleflight.do, "key", "test", query) for _ in range(4)]
+            results = [leader.result()] + [waiter.result() for waiter in waiters]
+        self.assertEqual(results, ["response"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(singleflight.get_stats()["test"], {"calls": 5, "saved_calls": 4})
+
+    def test_sync_waiters_get_the_leader_error(self):
+        singleflight = SingleFlight()
+        started = threading.Event()
+
+        def query():
+            started.set()
+            time.sleep(0.1)
+            raise ValueError("failed")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            leader = pool.submit(singleflight.do, "key", "test", query)
+            started.wait()
+            waiter = pool.submit(singleflight.do, "key", "test", query)
+            self.assertRaises(ValueError, leader.result)
+            self.assertRaises(ValueError, waiter.result)
+
+
+class AsyncSingleFlightTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_async_callers_share_one_query(self):
+        singleflight = SingleFlight()
+        calls = []
+
+        async def aquery():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "response"
+
+        results = await asyncio.gather(*(singleflight.ado("key", "test", aquery) for _ in range(10)))
+        self.assertEqual(results, ["response"] * 10)
+        self.assertEqual(len(calls), 1)
+
+    async def test_async_waiters_of_a_sync_leader(self):
+        singleflight = SingleFlight()
+        started = threading.Event()
+
+        def query():
+            started.set()
+            time.sleep(0.2)
+            return "response"
+
+        leader = asyncio.ensure_future(asyncio.to_thread(singleflight.do, "key", "test", query))
+        await asyncio.to_thread(started.wait)
+
+        async def aquery():
+            raise AssertionError("waiters must not query")
+
+        results = await asyncio.wait_for(
+            asyncio.gather(*(singleflight.ado("key", "test", aquery) for _ in range(5))), timeout=5)
+        self.assertEqual(results, ["response"] * 5)
+        self.assertEqual(await leader, "response")
+
+    async def test_cancelled_waiter_does_not_hang_the_flight(self):
+        singleflight = SingleFlight()
+        landed = asyncio.Event()
+
+        async def aquery():
+            await landed.wait()
+            return "response"
+
+        leader = asyncio.ensure_future(singleflight.ado("key", "test", aquery))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(singleflight.ado("key", "test", aquery))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        landed.set()
+        self.assertEqual(await leader, "response")
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+
+    async def test_waiters_do_not_exhaust_the_default_executor(self):
+        # more identical prompts in flight than default executor threads, with the disk tier on:
+        # the leader needs an executor thread to write the cache while the waiters wait
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=4))
+        with tempfile.TemporaryDirectory() as directory:
+            llm_cache = LLMCache(disk_path=os.path.join(directory, "llm_cache.sqlite"))
+            config = dict(cache_module.CACHE_CONFIG, enable=True, singleflight=True, call_sites=["json_reformat"])
+            with mock.patch.object(cache_module, "CACHE_CONFIG", config), \
+                    mock.patch.object(cache_module, "_llm_cache", llm_cache), \
+                    mock.patch.object(cache_module, "_singleflight", SingleFlight()):
+                calls = []
+
+                async def aquery(prompt):
+                    calls.append(prompt)
+                    await asyncio.sleep(0.1)
+                    return "response"
+
+                query_func = AsyncCachedQueryFunc(aquery, "test", "test-model")
+                results = await asyncio.wait_for(
+                    asyncio.gather(*(query_func("same prompt", call_site="json_reformat") for _ in range(10))),
+                    timeout=5)
+            llm_cache.conn.close()
+        self.assertEqual(results, ["response"] * 10)
+        self.assertEqual(calls, ["same prompt"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from iagents.stop import (BudgetPolicy, FactsResolvedPolicy, FanOutBudget, FanOutPolicy, NoProgressPolicy,
+                          build_stop_policies)
+
+
+def make_agent(master, known=(), unknown=(), plan="plan"):
+    return SimpleNamespace(master=master, infonav_plan=plan,
+                           mindfill_tool=SimpleNamespace(know_facts=list(known), unknown_facts=list(unknown)))
+
+
+def make_communication(instructor, assistant, history_tokens=0):
+    return SimpleNamespace(instructor=instructor, assistant=assistant,
+                           get_history_tokens=lambda: history_tokens)
+
+
+class StopPolicyTest(unittest.TestCase):
+
+    def test_facts_resolved(self):
+        policy = FactsResolvedPolicy()
+        self.assertIsNone(policy.check(make_communication(make_agent("a", ["x"]), make_agent("b", [], ["y"])), 1))
+        self.assertIsNotNone(policy.check(make_communication(make_agent("a", ["x"]), make_agent("b", ["y"])), 1))
+        # a plan without any marked fact has nothing to resolve
+        self.assertIsNone(policy.check(make_communication(make_agent("a"), make_agent("b")), 1))
+        self.assertIsNone(policy.check(make_communication(make_agent("a", ["x"]), make_agent("b", plan="")), 1))
+
+    def test_no_progress(self):
+        instructor, assistant = make_agent("a"), make_agent("b", [], ["y"])
+        communication = make_communication(instructor, assistant)
+        policy = NoProgressPolicy(patience=2)
+        policy.start(communication)
+        self.assertIsNone(policy.check(communication, 1))
+        instructor.mindfill_tool.know_facts.append("x")
+        self.assertIsNone(policy.check(communication, 2))
+        self.assertIsNone(policy.check(communication, 3))
+        self.assertIsNotNone(policy.check(communication, 4))
+
+    def test_budget(self):
+        communication = make_communication(make_agent("a"), make_agent("b"), history_tokens=100)
+        self.assertIsNone(BudgetPolicy(max_history_tokens=101).check(communication, 1))
+        self.assertIsNotNone(BudgetPolicy(max_history_tokens=100).check(communication, 1))
+        with mock.patch("iagents.stop.time.perf_counter", side_effect=[0.0, 5.0]):
+            policy = BudgetPolicy(max_seconds=5)
+            self.assertIsNotNone(policy.check(communication, 1))
+
+    def test_build_stop_policies(self):
+        self.assertEqual(build_stop_policies({"policies": []}), [])
+        policies = build_stop_policies({"policies": ["no_progress", "budget"], "patience": 3})
+        self.assertEqual([policy.name for policy in policies], ["no_progress", "budget"])
+        self.assertEqual(policies[0].patience, 3)
+        with self.assertRaises(ValueError):
+            build_stop_policies({"policies": ["unknown"]})
+
+
+class FanOutBudgetTest(unittest.TestCase):
+
+    def test_the_shared_token_budget_stops_every_sub_communication(self):
+        budget = FanOutBudget(max_history_tokens=100)
+        first = make_communication(make_agent("a"), make_agent("b"), history_tokens=60)
+        second = make_communication(make_agent("a"), make_agent("c"), history_tokens=50)
+        self.assertIsNone(FanOutPolicy(budget).check(first, 1))
+        self.assertIsNotNone(FanOutPolicy(budget).check(second, 1))
+        self.assertEqual(FanOutPolicy(budget).check(first, 2), budget.get_summary()["stop_reason"])
+
+    def test_a_resolved_sub_communication_stops_the_others(self):
+        budget = FanOutBudget()
+        resolved = make_communication(make_agent("a", ["x"]), make_agent("b", ["y"]))
+        self.assertIn("b's Agent", budget.update(resolved, 1))
+
+    def test_enough_facts(self):
+        budget = FanOutBudget(enough_facts=2)
+        self.assertIsNone(budget.update(make_communication(make_agent("a", ["x"]), make_agent("b", [], ["y"])), 1))
+        self.assertIsNotNone(budget.update(make_communication(make_agent("a", ["z"]), make_agent("c", [], ["y"])), 1))
+
+    def test_cancel_keeps_the_first_reason(self):
+        budget = FanOutBudget()
+        budget.cancel("first")
+        budget.cancel("second")
+        self.assertEqual(budget.get_summary()["stop_reason"], "first")
+
+
+if __name__ == "__main__":
+    unittest.main()